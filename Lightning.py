@@ -1,6 +1,10 @@
 import numpy as np
+import bisect
 import scipy.optimize as chisquarefit
+import scipy.sparse as sparse
+import scipy.sparse.linalg
 import copy
+import hashlib
 import warnings
 
 # Author: Ben Sheff
@@ -12,6 +16,16 @@ import warnings
 #
 # Known bugs: can get excessively slow fitting large segments to one another
 # or many segments together
+#
+# Segments are stitched in one of stitch_modes. "chain" fits each segment to
+# all of those left of it stitched together, one after another, so any error
+# carries on down the mirror. "global" fits every pair of overlapping
+# segments to each other, and then finds where all of them go at once by
+# least squares.
+
+
+# The ways StitchAll knows to stitch segments together
+stitch_modes = ["chain", "global"]
 
 
 class Lightning:
@@ -25,11 +39,29 @@ class Lightning:
     col_segments = -1
     segment_function = -1
     pixelsize = 0.5
+    fit_grid_points = 101  # Format is x0 tried across the pixel by
+    #                        FitSegments, at least 3
+    fit_uncertainty = [0, 0]  # Format is [x0, y0], one sigma, of the last
+    #                           FitSegments
+    stitch_mode = "chain"  # Format is one of stitch_modes
+    overlap_residuals = []  # Format is [[left index, right index, x0, y0]]
+    #                         of what a global stitch left of each overlap
     Total_RMS = 0
     last_fit_RMS = 0
+    __interpolant = None  # Format is [x, y of segment_function, x array,
+    #                       y array, x[i-1]-x[i] array], see __Interpolant
+    __fits = {}  # Format is {key: [FitSegments output, fit_uncertainty]},
+    #              see __Fit
+    __fits_used = set()  # Format is {key}, the fits the stitch going on used
+    __extents = None  # Format is [[first x], [running maximum of x array],
+    #                   largest |last x - first x|] of unstitched_segments,
+    #                   kept in order of first x, see __Extents
 
     def __init__(self, segment=[]):
         self.unstitched_segments = []
+        self.__fits = {}
+        self.__fits_used = set()
+        self.__extents = None
         self.AddSegment(segment)
         if self.unstitched_segments != []:
             self.SetSegmentFunction(0)
@@ -40,16 +72,26 @@ class Lightning:
     # speedflag, it removes the call to update other components of the obect.
     # It is for use only when adding a large number of segments at once, and
     # must be followed with the StitchAll method for proper functioning
+    # The segments are kept in order of where they start, so it goes in
+    # where it starts, found by bisection.
     def AddSegment(self, segment=[], speedflag=False):
         if segment == []:
             return
         self.segment_counter += 1
         counter = self.segment_counter
         deleted = []
+        starts, reaches, span = self.__Extents()
+        first = segment[0][0]
+        last = segment[0][len(segment[0]) - 1]
 
         # This loop checks if this segment is either contained by or contains
-        # any already posessed segment. If it does, it removes the old ones
-        for i in reversed(list(range(len(self.unstitched_segments)))):
+        # any already posessed segment. If it does, it removes the old ones.
+        # To within a millimeter at either end, no segment further than the
+        # longest one from this can be either, so only those starting
+        # between those bounds are looked at.
+        low = bisect.bisect_left(starts, min(first, last - span) - 2)
+        high = bisect.bisect_right(starts, max(first, last + span) + 2)
+        for i in reversed(list(range(low, high))):
             old_seg = self.unstitched_segments[i][0]
             length1 = len(old_seg) - 1
             length2 = len(segment[0]) - 1
@@ -62,6 +104,8 @@ class Lightning:
                     # self.RemoveSegment(counter)
                     deleted.append(i)
                     del self.unstitched_segments[i]
+                    del starts[i]
+                    del reaches[i]
 
         # for i in range(len(self.unstitched_segments)):
         #     if self.unstitched_segments[i][2] > counter:
@@ -69,7 +113,11 @@ class Lightning:
 
         temp = copy.deepcopy(segment)
         temp.append(counter)
-        self.unstitched_segments.append(temp)
+        position = bisect.bisect_right(starts, first)
+        self.unstitched_segments.insert(position, temp)
+        starts.insert(position, first)
+        reaches.insert(position, self.__Reach(temp[0]))
+        self.__extents[2] = max(span, abs(last - first))
 
         if not speedflag:
             self.StitchAll()
@@ -93,24 +141,41 @@ class Lightning:
     #     return self.segments[output]
 
     # This removes a segment from the unstitched list based on its index
-    # given by the order in which it was added.
+    # given by the order in which it was added. Those added after it move
+    # down one to take its place.
     def RemoveSegment(self, segment=-1):
         if segment == -1:
             segment = self.segment_counter
 
-        for i in range(len(self.unstitched_segments)):
-            if self.unstitched_segments[i][2] == segment:
-                del self.unstitched_segments[i]
-                self.segment_counter -= 1
-            else:
-                if self.unstitched_segments[i][2] > segment:
-                    self.unstitched_segments[i][2] -= 1
+        kept = [old_seg for old_seg in self.unstitched_segments
+                if old_seg[2] != segment]
+        if len(kept) < len(self.unstitched_segments):
+            self.segment_counter -= 1
+        for old_seg in kept:
+            if old_seg[2] > segment:
+                old_seg[2] -= 1
+        self.unstitched_segments = kept
 
+        self.__extents = None
         self.StitchAll()
 
+    # Removes every segment, keeping the fits of the last stitch (see __Fit)
+    # for when they are added again
+    def ClearSegments(self):
+        self.unstitched_segments = []
+        self.segments = -1
+        self.segment_counter = -1
+        self.__extents = None
+
     def SetPixelSize(self, pixel):
         self.pixelsize = pixel
 
+    # Chooses how StitchAll stitches segments together, from stitch_modes
+    def SetStitchMode(self, mode):
+        if mode not in stitch_modes:
+            raise ValueError("Unknown stitch mode: " + str(mode))
+        self.stitch_mode = mode
+
     def __UpdateCollectedSegments(self):
         self.col_segments = [[], []]
         for segment in self.segments:
@@ -120,6 +185,7 @@ class Lightning:
         self.col_segments.append(0)
 
     def SetSegmentFunction(self, segment, conglomerate_flag=False):
+        self.__interpolant = None
         try:
             tmp = self.unstitched_segments[segment]
             self.segment_function = tmp
@@ -141,42 +207,87 @@ class Lightning:
 
         return output
 
+    # Linearly interpolates segment_function, shifted over by x0 and up by
+    # y0, at x, which can be a number or a list of them. Beyond its ends, the
+    # end values are given as they are, without y0. Lists of x0 and y0 give
+    # each x its own shift.
     def LinearInterpolate(self, x, x0, y0):
         if type(x0) == list or type(x0) == np.ndarray:
             return [self.LinearInterpolate(x[i], x0[i], y0[i])
                     for i in range(len(x0))]
         if type(x) == list or type(x) == np.ndarray:
-            return [self.LinearInterpolate(_x, x0, y0) for _x in x]
-        x = x - x0
-        index = 1
+            return self.__Interpolate(x, x0, y0).tolist()
+        return float(self.__Interpolate([x], x0, y0)[0])
+
+    # LinearInterpolate for an array of x all at once, giving an array. Each
+    # x is interpolated from the first point of segment_function (after the
+    # first) at or beyond it, found by bisection on the running maximum of
+    # its x-values, which is the same point even where they aren't in order,
+    # as where stitched segments join. The arithmetic is done in the same
+    # order as always, so the results are the same to the last bit.
+    def __Interpolate(self, x, x0, y0):
+        grid, values, widths, reach = self.__Interpolant()
+        x = np.asarray(x, dtype=float) - x0
+        if len(grid) == 1:
+            return np.full(x.shape, values[0])
+        right = np.searchsorted(reach, x, "left") + 1
+        beyond = right == len(grid)
+        right[beyond] = len(grid) - 1
+        left = right - 1
+        output = ((values[left] * (x - grid[right]) -
+                   values[right] * (x - grid[left])) / widths[left] + y0)
+        output[beyond] = values[-1]
+        output[x < grid[0]] = values[0]
+        return output
+
+    # The arrays __Interpolate works from, made once for each
+    # segment_function rather than from its lists on every call. Format is
+    # [x, y, x[i] - x[i+1], running maximum of x after the first]
+    def __Interpolant(self):
         fit_seg = self.segment_function
-        # if x < fit_seg[0][0]-1:
-        #     return 9999999999999
-        length = len(fit_seg[0])
-        if fit_seg[0][0] > x:
-            return fit_seg[1][0]
-        while fit_seg[0][index] < x:
-            index += 1
-            if index == length:
-                return fit_seg[1][length-1]
-        return ((fit_seg[1][index-1] * (x - fit_seg[0][index]) -
-                 fit_seg[1][index] * (x - fit_seg[0][index-1])) /
-                (fit_seg[0][index-1] - fit_seg[0][index]) + y0)
+        cached = self.__interpolant
+        if (cached is None or cached[0] is not fit_seg[0] or
+                cached[1] is not fit_seg[1]):
+            grid = np.asarray(fit_seg[0], dtype=float)
+            cached = [fit_seg[0], fit_seg[1], grid,
+                      np.asarray(fit_seg[1], dtype=float),
+                      grid[:-1] - grid[1:], np.maximum.accumulate(grid[1:])]
+            self.__interpolant = cached
+        return cached[2:]
 
     # Function being minimized in the fitting script, the chi square error of
     # the current fit. Note if the fit exceeds the boundary (x0 beyond
-    # pixelsize), it returns an arbitrary large number
+    # pixelsize), it returns an arbitrary large number. All points are done
+    # at once, the running sum keeping the order of additions of summing
+    # point by point.
     def __FitError(self, params, X, Y, Err):
         x0 = params[0]
         y0 = params[1]
         if self.pixelsize < np.abs(x0):
             return 123456789098765432124.
-        chi2 = 0.0
-        for i in range(len(X)):
-            x = X[i]
-            y = self.LinearInterpolate(x, x0, y0)
-            chi2 = chi2 + (Y[i]-y)**2 / (len(X) * Err[i]**2)
-        return chi2
+        if len(X) == 0:
+            return 0.0
+        Y = np.asarray(Y, dtype=float)
+        Err = np.asarray(Err, dtype=float)
+        y = self.__Interpolate(X, x0, y0)
+        return float(np.cumsum((Y - y)**2 / (len(X) * Err**2))[-1])
+
+    # The chi square error of __FitError for every shift x0 in an array at
+    # once, each with the y0 that makes it least. For a given x0 that is the
+    # average difference of Y from segment_function over the points it
+    # covers, as points beyond its ends don't get y0 (see LinearInterpolate).
+    # Format is [chi^2 array, y0 array, number of points covered array]
+    def __FitProfile(self, x0, X, Y):
+        grid, values, widths, reach = self.__Interpolant()
+        x0 = np.asarray(x0, dtype=float)[:, np.newaxis]
+        difference = Y - self.__Interpolate(X, x0, 0)
+        top = reach[-1] if len(reach) > 0 else -np.inf
+        covered = (X - x0 >= grid[0]) & (X - x0 <= top)
+        count = np.sum(covered, axis=1)
+        y0 = np.sum(difference * covered, axis=1) / np.maximum(count, 1)
+        chi2 = np.sum((difference - y0[:, np.newaxis] * covered)**2,
+                      axis=1) / len(X)
+        return [chi2, y0, count]
 
     # This is designed to fit the current segment_function to the indicated
     # function, assuming it's on the left of segment_function. startoverlap
@@ -184,33 +295,47 @@ class Lightning:
     # segment_function. It will ignore any points left of startoverlap. Pixel
     # is the allowed range for the fit to move the segment along x, a value
     # of -1 makes it just use the last defined value (default 0.5 mm)
+    # Since the best y0 for any x0 is known directly (see __FitProfile), only
+    # x0 is searched for: over fit_grid_points shifts across the pixel all at
+    # once, then by Brent's method between the neighbours of the best. The
+    # uncertainty of the fit, from the curvature of chi^2 there, is left in
+    # fit_uncertainty. A pixel of zero or less only fits y0, at x0 = 0.
     def FitSegments(self, left_segment, startoverlap=0, pixel=-1):
         if pixel == -1:
             pixel = self.pixelsize
-        final_fit = [0.01, 0]
         self.pixelsize = pixel
-        chisquare = 123456789098765432123.
-        guess = final_fit.copy()
-        # This is the biggest time sink in any of my code:
-        for j in range(20):
-            guess[0] += 0.1
-            if guess[0] >= pixel:
-                guess[0] = -pixel + 0.05
-            current_range = [[], [], []]
-            for i in range(startoverlap, len(left_segment[0])):
-                current_range[0].append(left_segment[0][i])
-                current_range[1].append(left_segment[1][i])
-                current_range[2].append(1)
-            fit = chisquarefit.fmin(self.__FitError, guess,
-                                    args=tuple(current_range), disp=False)
-            newchi = self.__FitError(fit, current_range[0],
-                                     current_range[1], current_range[2])
-            if newchi < chisquare:
-                chisquare = newchi
-                final_fit = fit
-                guess = final_fit.copy()
-        final_fit = list(final_fit)
-        final_fit.append(chisquare)
+        X = np.array(left_segment[0][startoverlap:], dtype=float)
+        Y = np.array(left_segment[1][startoverlap:], dtype=float)
+        if len(X) == 0:
+            self.fit_uncertainty = [np.inf, np.inf]
+            return [0, 0, 0.0]
+        if pixel <= 0:
+            chi2, y0, count = self.__FitProfile([0], X, Y)
+            variance = chi2[0] * len(X) / max(len(X) - 1, 1)
+            self.fit_uncertainty = [0, np.sqrt(variance / max(count[0], 1))]
+            return [0, float(y0[0]), float(chi2[0])]
+
+        shifts = np.linspace(-pixel, pixel, max(self.fit_grid_points, 3))
+        best = np.argmin(self.__FitProfile(shifts, X, Y)[0])
+        step = shifts[1] - shifts[0]
+        x0 = chisquarefit.fminbound(
+            lambda x0: self.__FitProfile([x0], X, Y)[0][0],
+            shifts[max(best - 1, 0)], shifts[min(best + 1, len(shifts) - 1)],
+            xtol=step * 1e-4)
+        y0 = self.__FitProfile([x0], X, Y)[1][0]
+        final_fit = [float(x0), float(y0),
+                     self.__FitError([x0, y0], X, Y, np.ones(len(X)))]
+
+        # With chi^2 being the mean square residual, the variance of x0 is
+        # twice that of a residual over the curvature of the sum of squares
+        step = step / 10
+        chi2, y0, count = self.__FitProfile([x0 - step, x0, x0 + step], X, Y)
+        curvature = (chi2[0] - 2 * chi2[1] + chi2[2]) / step**2
+        variance = chi2[1] * len(X) / max(len(X) - 2, 1)
+        self.fit_uncertainty = [np.inf, np.sqrt(variance / max(count[1], 1))]
+        if curvature > 0:
+            self.fit_uncertainty[0] = np.sqrt(2 * variance /
+                                              (curvature * len(X)))
 
         if abs(final_fit[0]) > self.pixelsize-0.005:
             warnings.warn("Fitting railed to pixel width")
@@ -228,10 +353,10 @@ class Lightning:
             segment = copy.deepcopy(temp)
         except TypeError:
             self.AddSegment(segment)
-            segment_index = len(self.unstitched_segments)-1
+            segment_index = self.GetMostRecent()
         temp = self.__Stitch(segment)
-        self.unstitched_segments[segment_index][1] = temp[0][1]
-        self.unstitched_segments[segment_index][0] = temp[0][0]
+        self.unstitched_segments[segment_index][1] = temp[0][1].tolist()
+        self.unstitched_segments[segment_index][0] = temp[0][0].tolist()
         output = self.unstitched_segments[segment_index]
         self.unstitched_segments.remove(self.segment_function)
         self.__SortSegments()
@@ -242,11 +367,20 @@ class Lightning:
             return
         self.segments = []
         self.__SortSegments()
+        self.__fits_used = set()
+        reaches = self.__Extents()[1]
+        offsets = None
+        if self.stitch_mode == "global":
+            offsets = self.__SolveOffsets()
         self.conglomerate = self.unstitched_segments[0]
         for segment in range(len(self.unstitched_segments)):
             self.SetSegmentFunction(segment)
-            if segment > 0:
-                temp = self.__Stitch(self.conglomerate)
+            if segment > 0 and offsets is not None:
+                temp = self.__Stitch(self.conglomerate, offsets[segment],
+                                     reaches[segment])
+            elif segment > 0:
+                temp = self.__Stitch(self.conglomerate,
+                                     reach=reaches[segment])
             else:
                 temp = [copy.deepcopy(self.segment_function)]
                 temp.append([0, 0, 0])
@@ -255,51 +389,150 @@ class Lightning:
             self.segments.append([[x+temp[1][0] for x in data[0]],
                                   [y+temp[1][1] for y in data[1]],
                                   temp[1]])
+        # Kept as arrays while the segments go on, so each only costs the
+        # merge itself
+        if len(self.unstitched_segments) > 1:
+            self.conglomerate = [self.conglomerate[0].tolist(),
+                                 self.conglomerate[1].tolist()]
         self.SetSegmentFunction(self.conglomerate, True)
         self.__UpdateCollectedSegments()
         temp = [1 for i in self.col_segments[0]]
         self.conglomerate.append(self.__FitError((0, 0), self.col_segments[0],
                                                  self.col_segments[1], temp))
+        # Only the fits of this stitch are kept, those of segments since
+        # replaced or removed going
+        self.__fits = dict((key, self.__fits[key])
+                           for key in self.__fits_used)
         return self.conglomerate
 
-    def __Stitch(self, segment):
+    # FitSegments, remembered. Its result only depends on the points of the
+    # left segment it sees, segment_function, and the pixel and grid it
+    # searches, so the fit is kept under the hashes of those. Restitching
+    # after adding, replacing or removing one segment then only fits the
+    # overlaps whose points changed: none when the same segment is added
+    # again, as moving between segments does, and in the global stitch just
+    # those with the changed segment in them. In the chain stitch a segment
+    # is fit to all those left of it stitched together, so the ones right of
+    # a changed segment are fit again too.
+    def __Fit(self, segment, startoverlap):
+        key = (self.__Hash(segment[0][startoverlap:],
+                           segment[1][startoverlap:]),
+               self.__Hash(self.segment_function[0],
+                           self.segment_function[1]),
+               float(self.pixelsize), self.fit_grid_points)
+        self.__fits_used.add(key)
+        if key not in self.__fits:
+            fit = self.FitSegments(segment, startoverlap)
+            self.__fits[key] = [fit, list(self.fit_uncertainty)]
+        fit, uncertainty = self.__fits[key]
+        self.fit_uncertainty = list(uncertainty)
+        return list(fit)
+
+    # A hash of the contents of a segment's x and y
+    def __Hash(self, x, y):
+        digest = hashlib.sha1(np.asarray(x, dtype=float).tobytes())
+        digest.update(np.asarray(y, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    # Stitches segment_function onto the right of segment, fitting it unless
+    # the fit, [x0, y0, chi^2], is given. reach, the running maximum of the
+    # x-values of segment_function, is worked out unless given. Returns
+    # [[x, y] of the two together as arrays, the fit]
+    def __Stitch(self, segment, fit=None, reach=None):
         # First to find where along the left segment the overlap begins, then
         # calling the fitting function.
-        startoverlap = 0
-        while (startoverlap < len(segment[0]) and
-               segment[0][startoverlap] < self.segment_function[0][0]):
-            startoverlap += 1
-        if startoverlap < len(segment[0]):
-            x0, y0, chisquare = self.FitSegments(segment, startoverlap)
-            startoverlap = 0
-            while segment[0][startoverlap] < self.segment_function[0][0]+x0:
-                startoverlap += 1
+        x = np.asarray(segment[0], dtype=float)
+        y = np.asarray(segment[1], dtype=float)
+        start = self.segment_function[0][0]
+        startoverlap = self.__FirstNotBelow(x, start)
+        if fit is not None:
+            x0, y0, chisquare = fit
+        elif startoverlap < len(x):
+            x0, y0, chisquare = self.__Fit(segment, startoverlap)
         else:
             x0 = y0 = chisquare = 0
+        startoverlap = self.__FirstNotBelow(x, start + x0)
 
         # Getting the list of x-values for the combined region of the segments
-        endoverlap = 0
-        while (endoverlap < len(self.segment_function[0]) and
-               segment[0][len(segment[0])-1] >
-               self.segment_function[0][endoverlap]):
-            endoverlap += 1
-        xvalues = [segment[0][i] for i in range(len(segment[0]))]
-        for i in range(endoverlap, len(self.segment_function[0])):
-            xvalues.append(self.segment_function[0][i] + x0)
-        fitted_segment = self.LinearInterpolate(xvalues, x0, y0)
+        function_x = np.asarray(self.segment_function[0], dtype=float)
+        if reach is None:
+            reach = self.__Reach(function_x)
+        endoverlap = int(np.searchsorted(reach, x[-1]))
+        xvalues = np.concatenate((x, function_x[endoverlap:] + x0))
+        fitted_segment = self.__Interpolate(xvalues, x0, y0)
 
         # Finding the y-values along the combined region of the segments,
         # averaged where appropriate
-        output = []
-        for i in range(len(xvalues)):
-            if i >= startoverlap and i < len(segment[0]):
-                output.append((segment[1][i]+fitted_segment[i])/2)
-            if i >= len(segment[0]):
-                output.append(fitted_segment[i])
-            if i < startoverlap:
-                output.append(segment[1][i])
+        output = fitted_segment
+        output[startoverlap:len(x)] = (y[startoverlap:] +
+                                       fitted_segment[startoverlap:len(x)]) / 2
+        output[:startoverlap] = y[:startoverlap]
         return [[xvalues, output], [x0, y0, chisquare]]
 
+    # The first index of values not below limit, found as the loops over the
+    # points used to, so also where values aren't in order, or len(values)
+    def __FirstNotBelow(self, values, limit):
+        below = values < limit
+        if below.all():
+            return len(values)
+        return int(np.argmin(below))
+
+    # For the global stitch, measures the offsets between every pair of
+    # overlapping segments with FitSegments, the right one fit to the left,
+    # and finds those of every segment from all of them at once, by least
+    # squares with each weighted by its fit_uncertainty, the first segment
+    # staying put. With segments sorted by where they start, only those
+    # starting before a segment ends, found by bisection, are fit to it, and
+    # the points they overlap found by bisection on its x-values (see
+    # __Extents). Every
+    # segment's offset only appears in the equations of its own overlaps, so
+    # the sparse system is solved in time proportional to the number of
+    # segments along a mirror. What is left of each measurement goes in
+    # overlap_residuals. Format is [[x0, y0, chi^2 of the fit to the segment
+    # before it]]
+    def __SolveOffsets(self):
+        count = len(self.unstitched_segments)
+        starts, reaches = self.__Extents()[:2]
+        measured = []
+        for left in range(count):
+            for right in range(left + 1, bisect.bisect_left(
+                    starts, reaches[left][-1])):
+                self.SetSegmentFunction(right)
+                segment = self.unstitched_segments[left]
+                startoverlap = int(np.searchsorted(reaches[left],
+                                                   starts[right]))
+                if startoverlap < len(segment[0]):
+                    measured.append([left, right] +
+                                    self.__Fit(segment, startoverlap) +
+                                    self.fit_uncertainty)
+
+        offsets = np.zeros((count, 3))
+        self.overlap_residuals = []
+        if len(measured) == 0:
+            return offsets.tolist()
+        measured = np.array(measured, dtype=float)
+        pairs = measured[:, :2].astype(int)
+        incidence = sparse.csr_matrix(
+            (np.tile([-1.0, 1.0], len(pairs)),
+             (np.repeat(np.arange(len(pairs)), 2), pairs.ravel())),
+            shape=(len(pairs), count))
+        for axis in (0, 1):
+            weights = 1 / np.maximum(measured[:, 5 + axis], 1e-12)**2
+            free = incidence[:, 1:]
+            normal = free.T.dot(sparse.diags(weights, 0)).dot(free)
+            # A segment overlapping none of the others just stays where it is
+            normal = normal + sparse.identity(count - 1) * (
+                1e-12 * max(normal.diagonal().max(), 1e-300))
+            rhs = free.T.dot(weights * measured[:, 2 + axis])
+            offsets[1:, axis] = np.atleast_1d(
+                sparse.linalg.spsolve(normal.tocsc(), rhs))
+        residuals = incidence.dot(offsets[:, :2]) - measured[:, 2:4]
+        self.overlap_residuals = np.column_stack((pairs, residuals)).tolist()
+        for pair, fit in zip(pairs, measured):
+            if pair[1] == pair[0] + 1:
+                offsets[pair[1], 2] = fit[4]
+        return offsets.tolist()
+
     # This is a method to sort the segments by when they start
     def __SortSegments(self):
         self.unstitched_segments = list(self.unstitched_segments)
@@ -309,6 +542,29 @@ class Lightning:
                 temp = list(self.unstitched_segments[i][j])
                 self.unstitched_segments[i][j] = temp
         self.unstitched_segments.sort()
+        self.__extents = [[], [], 0]
+        for segment in self.unstitched_segments:
+            self.__extents[0].append(segment[0][0])
+            self.__extents[1].append(self.__Reach(segment[0]))
+            self.__extents[2] = max(self.__extents[2],
+                                    abs(segment[0][-1] - segment[0][0]))
+
+    # The index of where the unstitched segments are, kept up to date by the
+    # methods changing them, or made again by sorting them when they were
+    # changed from outside. Format is [[first x of each], [running maximum of
+    # x-values of each], largest distance between the first and last x of
+    # any], in order of first x. The first point of a segment at or beyond
+    # some x is the first one its running maximum reaches it at, even where
+    # its x-values aren't in order, so it can be found by bisection.
+    def __Extents(self):
+        if (self.__extents is None or
+                len(self.__extents[0]) != len(self.unstitched_segments)):
+            self.__SortSegments()
+        return self.__extents
+
+    # The running maximum of x-values, as an array
+    def __Reach(self, x):
+        return np.maximum.accumulate(np.asarray(x, dtype=float))
 
 
 # import matplotlib.pyplot as mpl
@@ -1,4 +1,15 @@
 import numpy as np
+import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Author: Ben Sheff
 # Made for the Optics group in the XSD Division of the APS at Argonne over
@@ -9,6 +20,22 @@ import numpy as np
 # This is more macro than class though, but to keep with the style of the rest
 # of my code, it is kept in object style, with the option to make Ascii-
 # converter objects that hold python lists.
+# Big arrays are better written with WriteColumns, which streams them to the
+# file a chunk at a time, but gives the same text ConvertToAscii would, and
+# read back with ReadColumns, which parses them a chunk at a time into one
+# array instead of lists.
+# It also reads the files mda2ascii makes from the LTP's scans: FindScanFiles
+# finds every scan file of a run, and ReadMdaFiles reads them all at once, each
+# with ReadMdaCached. That keeps what ReadMdaAscii parsed from each file in a
+# cache directory as a .npy array and a small .json header, so the file only
+# has to be parsed again once it changes. While the LTP is still measuring, a
+# ScanWatcher reads each scan file of a run as soon as it is finished.
+# The binary MDA files saveData writes, that mda2ascii makes those .asc files
+# from, can be read directly with ReadMda, or with ReadMdaScans into the same
+# form ReadMdaAscii gives for each .asc file. Either way, a whole run can be
+# held as one MdaDataset, with every column of every scan in a single array.
+# Lastly, WriteSession and ReadSession keep whole sessions in a binary file,
+# the arrays of which are memory-mapped when read back.
 
 
 class Medium:
@@ -121,6 +148,114 @@ def __Flatten(input_data_list):
             output_list += __Flatten(element)
     return output_list
 
+# ConvertToAscii writes numbers as str does numpy floats, which since numpy
+# 1.14 is the shortest repr, and before that 12 significant digits, with a
+# ".0" added to whole numbers.
+legacy_number_format = (str(np.float64(0.1) + np.float64(0.2)) !=
+                        repr(0.1 + 0.2))
+ascii_chunk_size = 2**16  # Format is numbers formatted and written at a time
+ascii_read_size = 2**22  # Format is bytes of text ReadColumns parses at once
+
+
+# Writes columns of numbers to the open file fileInQuestion in the same form
+# ConvertToAscii gives, headed by a row of labels. Each of columns is either
+# one column, or a 2-D array of them, one per row, and all are the same
+# length. Rows are formatted and written a chunk at a time, straight from the
+# arrays, so how much memory this takes doesn't depend on their size.
+def WriteColumns(fileInQuestion, labels, columns, split_term="\t"):
+    columns = [np.atleast_2d(column) for column in columns]
+    width = sum(len(column) for column in columns)
+    length = min(column.shape[1] for column in columns)
+    fileInQuestion.write("\n" + split_term.join(labels))
+    rows = max(1, ascii_chunk_size // max(width, 1))
+    if legacy_number_format:
+        row_format = "\n" + split_term.join(["%.12g"] * width)
+        separators = "\n" + re.escape(split_term)
+        whole_number = re.compile("(?<![^" + separators + "])(-?[0-9]+)(?![^" +
+                                  separators + "])")
+    else:
+        row_format = "\n" + split_term.join(["%r"] * width)
+    for start in range(0, length, rows):
+        end = min(start + rows, length)
+        block = np.empty((end - start, width))
+        position = 0
+        for column in columns:
+            block[:, position:position+len(column)] = column[:, start:end].T
+            position += len(column)
+        chunk = row_format * (end - start) % tuple(block.ravel().tolist())
+        if legacy_number_format:
+            # Numbers that came out as just digits are given their ".0"
+            chunk = whole_number.sub(r"\1.0", chunk)
+        fileInQuestion.write(chunk)
+
+
+# Reads the rest of the open file fileInQuestion as written by WriteColumns
+# or ConvertToAscii. Lines starting with "#" are kept as they are, and empty
+# ones skipped. The rest are parsed as numbers a chunk of ascii_read_size at a
+# time, all at once by numpy as long as the rows of the chunk are the same
+# length. Returns [comment lines, data, widths], data being [column, row]
+# with NaN where a row was cut short (or held something other than a number)
+# and widths the number of entries in each row.
+def ReadColumns(fileInQuestion, split_term="\t"):
+    comments = []
+    chunks = []
+    widths = []
+    width = 0
+    while True:
+        lines = fileInQuestion.readlines(ascii_read_size)
+        if len(lines) == 0:
+            break
+        rows = []
+        for line in lines:
+            if line.startswith("#"):
+                comments.append(line)
+            elif line.strip() != "":
+                rows.append(line)
+        if len(rows) == 0:
+            continue
+        counts = np.array([row.count(split_term) for row in rows]) + 1
+        width = max(width, counts.max())
+        values = np.zeros(0)
+        if counts.min() == counts.max():
+            text = "".join(rows)
+            if split_term.strip() != "":
+                text = text.replace(split_term, " ")
+            values = np.fromstring(text, sep=" ")
+        if len(values) == counts.sum():
+            chunk = values.reshape(len(rows), counts[0])
+        else:
+            # Rows of different lengths are filled out one at a time
+            counts = []
+            chunk = []
+            for row in rows:
+                entries = [entry for entry in row.strip("\n").split(
+                    split_term) if entry.strip() != ""]
+                counts.append(len(entries))
+                chunk.append([__ToNumber(entry) for entry in entries])
+            width = max([width] + counts)
+            chunk = [entries + [np.nan] * (width - len(entries)) for
+                     entries in chunk]
+            chunk = np.array(chunk, dtype=float).reshape(len(rows), width)
+        chunks.append(chunk)
+        widths.append(np.asarray(counts))
+
+    data = np.full((sum(len(chunk) for chunk in chunks), width), np.nan)
+    row = 0
+    for chunk in chunks:
+        data[row:row+len(chunk), :chunk.shape[1]] = chunk
+        row += len(chunk)
+    if len(widths) > 0:
+        widths = np.concatenate(widths)
+    return [comments, data.T, np.asarray(widths, dtype=int)]
+
+
+def __ToNumber(entry):
+    try:
+        return float(entry)
+    except ValueError:
+        return np.nan
+
+
 def Transpose(ls):
     output = []
     mx = 0
@@ -136,3 +271,559 @@ def Transpose(ls):
             except IndexError:
                 output[column].append(None)
     return output
+
+
+# Scan files are named as in Sheff_300mm_test0001_01_1.asc, with the scan
+# number second to last, written with however many digits it needs.
+scan_file_pattern = re.compile(r"^(.*_)(\d+)(_\d+\.asc)$")
+
+mda_threads = 8  # Format is the number of files ReadMdaFiles reads at once
+mda_cache_dir = os.path.join(os.path.expanduser("~"), ".omen_cache")  #
+#               Format is a directory path, or None to not cache at all
+mda_cache_size = 256 * 2**20  # Format is bytes the cache directory may use
+
+
+# Finds all the scan files belonging to the same run as filename, which can
+# be any one of them, by looking at what is actually there rather than trying
+# out names. Returns [[scan number, file name]] ordered by scan number.
+def FindScanFiles(filename):
+    match = scan_file_pattern.match(filename)
+    if match is None:
+        return [[1, filename]]
+    prefix, number, suffix = match.groups()
+    found = []
+    for name in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+        other = scan_file_pattern.match(name)
+        if (other is not None and other.group(1) == prefix and
+                other.group(3) == suffix):
+            found.append([int(other.group(2)), name])
+    return sorted(found)
+
+
+# Reads a file written by mda2ascii. Of the header, only the last block of
+# "# Column Descriptions:" is kept, that of the 1-D scan, and returned as
+# {column index: description}, the description being what follows the
+# bracketed label. The numbers after it are parsed all at once, and returned
+# as an array of [column, point]. A last line cut off before its end, as in a
+# scan still being written, is left out.
+def ReadMdaAscii(filename):
+    with open(filename, "r") as fileInQuestion:
+        return ParseMdaAscii(fileInQuestion.read())
+
+
+# The parsing half of ReadMdaAscii, given the text of the file
+def ParseMdaAscii(text):
+    descriptions = {}
+    position = text.rfind("# Column Descriptions:")
+    position = text.find("\n", position) + 1
+    while 0 < position < len(text):
+        end = text.find("\n", position)
+        if end == -1:
+            end = len(text)
+        line = text[position:end]
+        if line.strip() != "" and not line.startswith("#"):
+            break
+        column = re.match(r"#\s*(\d+)\s*\[[^\]]*\]\s*(.*)$", line)
+        if column is not None:
+            descriptions[int(column.group(1)) - 1] = column.group(2).strip()
+        position = end + 1
+    if position <= 0 or position >= len(text):
+        return [descriptions, np.zeros((len(descriptions), 0))]
+
+    body = text[position:text.rfind("\n") + 1]
+    columns = len(text[position:text.find("\n", position)].split())
+    values = np.fromstring(body, sep=" ")
+    points = len(values) // max(columns, 1)
+    return [descriptions, values[:points*columns].reshape(points, columns).T]
+
+
+# Reads all the given mda2ascii files at once on a pool of threads, leaving
+# the parsing itself to numpy. Returns ReadMdaCached's output for each file in
+# order, or None for those that could not be found. The cache is trimmed back
+# to mda_cache_size afterwards.
+def ReadMdaFiles(filenames, threads=mda_threads):
+    if len(filenames) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(threads, len(filenames))) as pool:
+        output = list(pool.map(__ReadIfFound, filenames))
+    TrimCache()
+    return output
+
+
+def __ReadIfFound(filename):
+    try:
+        return ReadMdaCached(filename)
+    except FileNotFoundError:
+        return None
+
+
+# As ReadMdaAscii, but going through the cache in mda_cache_dir. Each file has
+# its entry named by the hash of its path. The header records the size,
+# modification time and sha1 of the file the entry was made from. If the
+# size and time still match the entry is used as is, if not the file is
+# hashed, and only parsed again if its contents really changed. The data
+# comes back memory-mapped from the cache, read-only.
+def ReadMdaCached(filename):
+    if mda_cache_dir is None:
+        return ReadMdaAscii(filename)
+    status = os.stat(filename)
+    entry = os.path.join(mda_cache_dir, hashlib.sha1(
+        os.path.abspath(filename).encode("utf-8")).hexdigest())
+    try:
+        with open(entry + ".json", "r") as header_file:
+            header = json.load(header_file)
+        if [header["size"], header["mtime"]] != [status.st_size,
+                                                 status.st_mtime_ns]:
+            with open(filename, "rb") as fileInQuestion:
+                digest = hashlib.sha1(fileInQuestion.read()).hexdigest()
+            if digest != header["sha1"]:
+                raise ValueError("Source file changed")
+            header["size"] = status.st_size
+            header["mtime"] = status.st_mtime_ns
+            __WriteCacheFile(entry + ".json", json.dumps(header).encode())
+        data = np.load(entry + ".npy", mmap_mode="r")
+        # Marking the entry as recently used for TrimCache
+        os.utime(entry + ".npy")
+        return [dict((int(column), description) for column, description in
+                     header["columns"].items()), data]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # Parsing the same bytes that are hashed, so the entry can't be made
+    # from one version of the file and labelled with another
+    with open(filename, "rb") as fileInQuestion:
+        raw = fileInQuestion.read()
+    descriptions, data = ParseMdaAscii(raw.decode().replace("\r\n", "\n"))
+    header = {"source": os.path.abspath(filename), "size": status.st_size,
+              "mtime": status.st_mtime_ns,
+              "sha1": hashlib.sha1(raw).hexdigest(),
+              "columns": descriptions}
+    try:
+        os.makedirs(mda_cache_dir, exist_ok=True)
+        with open(entry + ".npy.tmp", "wb") as array_file:
+            np.save(array_file, data)
+        os.replace(entry + ".npy.tmp", entry + ".npy")
+        __WriteCacheFile(entry + ".json", json.dumps(header).encode())
+    except OSError:
+        # Not being able to cache only makes the next load slower
+        pass
+    return [descriptions, data]
+
+
+# Writes a file in the cache by way of a temporary one, so that a reader
+# never sees it half written
+def __WriteCacheFile(filename, contents):
+    with open(filename + ".tmp", "wb") as fileInQuestion:
+        fileInQuestion.write(contents)
+    os.replace(filename + ".tmp", filename)
+
+
+# Removes the least recently used entries from the cache until it takes up no
+# more than size bytes
+def TrimCache(size=mda_cache_size):
+    if mda_cache_dir is None or not os.path.isdir(mda_cache_dir):
+        return
+    entries = []
+    total = 0
+    for name in os.listdir(mda_cache_dir):
+        if not name.endswith(".npy"):
+            continue
+        entry = os.path.join(mda_cache_dir, name[:-4])
+        try:
+            used = os.stat(entry + ".npy")
+            entry_size = used.st_size
+            if os.path.exists(entry + ".json"):
+                entry_size += os.path.getsize(entry + ".json")
+        except OSError:
+            continue
+        entries.append([used.st_mtime, entry_size, entry])
+        total += entry_size
+    for used, entry_size, entry in sorted(entries):
+        if total <= size:
+            break
+        for extension in (".json", ".npy"):
+            try:
+                os.remove(entry + extension)
+            except OSError:
+                pass
+        total -= entry_size
+
+
+watch_interval = 0.5  # Format is seconds between looks at the directory
+watch_settle_time = 2.0  # Format is seconds a scan file has to go unchanged
+
+
+# Watches a run as the LTP measures it, from a thread of its own, reading
+# each of its scan files (see FindScanFiles) once finished. A file counts as
+# finished when it went unchanged in size and modification time since the
+# last look, and either a later scan of the run has appeared or settle_time
+# has passed. Scans are handed on in order of scan number, on the queue scans
+# as [scan number, file name, ReadMdaCached output], so that the thread using
+# them never waits on the disk. Scan numbers in skip are left out.
+class ScanWatcher(threading.Thread):
+    filename = ""  # Format is any scan file name of the run
+    interval = watch_interval  # Format is seconds
+    settle_time = watch_settle_time  # Format is seconds
+    scans = None  # Format is queue.Queue of [scan number, name, read]
+    done = set()  # Format is {scan number} handed on or skipped
+
+    def __init__(self, filename, skip=[], interval=watch_interval,
+                 settle_time=watch_settle_time):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.settle_time = settle_time
+        self.scans = queue.Queue()
+        self.done = set(skip)
+        self.__seen = {}  # Format is {name: [size, mtime, time first seen]}
+        self.__stop = threading.Event()
+
+    def run(self):
+        while not self.__stop.is_set():
+            self.Poll()
+            self.__stop.wait(self.interval)
+
+    # Stops watching, after any look at the directory under way
+    def Stop(self):
+        self.__stop.set()
+
+    # Takes one look at the directory, returning how many scans were handed on
+    def Poll(self):
+        found = [[number, name] for number, name in
+                 FindScanFiles(self.filename) if number not in self.done]
+        handed = 0
+        waiting = False
+        for i, [number, name] in enumerate(found):
+            try:
+                status = os.stat(name)
+            except OSError:
+                waiting = True
+                continue
+            now = time.time()
+            seen = self.__seen.get(name)
+            if seen is None or seen[:2] != [status.st_size,
+                                            status.st_mtime_ns]:
+                self.__seen[name] = [status.st_size, status.st_mtime_ns, now]
+                waiting = True
+            elif status.st_size == 0 or not (
+                    i + 1 < len(found) or now - seen[2] >= self.settle_time):
+                waiting = True
+            # Later scans still have their changes noted while waiting
+            if waiting:
+                continue
+            try:
+                self.scans.put([number, name, ReadMdaCached(name)])
+            except (OSError, ValueError):
+                pass
+            self.done.add(number)
+            del self.__seen[name]
+            handed += 1
+        return handed
+
+
+# The EPICS DBR types extra PVs in MDA files can have, and how each value is
+# stored. Format is {type code: numpy dtype}, chars and shorts taking up a
+# whole 4 bytes each in XDR.
+mda_extra_types = {29: ">i4", 30: ">f4", 32: ">i4", 33: ">i4", 34: ">f8"}
+
+
+# Steps through the bytes of an MDA file. MDA files are XDR, so big-endian
+# throughout, with ints and floats of 4 bytes and doubles of 8. Arrays are
+# read straight out of the bytes by numpy, and strings are counted strings,
+# given by their length (twice when not empty, once by MDA and once by XDR)
+# and padded out to 4 bytes.
+class XdrReader:
+    data = b""  # Format is the bytes being read
+    position = 0  # Format is the offset in data of the next thing to read
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def Int(self):
+        self.position += 4
+        return struct.unpack_from(">i", self.data, self.position - 4)[0]
+
+    def Float(self):
+        self.position += 4
+        return struct.unpack_from(">f", self.data, self.position - 4)[0]
+
+    def Array(self, dtype, count):
+        dtype = np.dtype(dtype)
+        output = np.frombuffer(self.data, dtype, count, self.position)
+        self.position += count * dtype.itemsize
+        return output
+
+    def String(self):
+        if self.Int() == 0:
+            return ""
+        length = self.Int()
+        output = self.data[self.position:self.position+length]
+        self.position += (length + 3) // 4 * 4
+        return output.decode("latin-1")
+
+
+# Reads an MDA file as written by saveData. Returns [header, extra PVs, scan]
+# where header is {"version", "scan_number", "rank", "dimensions",
+# "regular"}, the extra PVs are {name: [description, unit, value]} in the
+# order of the file, and scan is the outermost scan as from ReadMdaScan.
+def ReadMda(filename):
+    with open(filename, "rb") as fileInQuestion:
+        reader = XdrReader(fileInQuestion.read())
+    header = {"version": round(reader.Float(), 4),
+              "scan_number": reader.Int()}
+    header["rank"] = reader.Int()
+    header["dimensions"] = [int(dimension) for dimension in
+                            reader.Array(">i4", header["rank"])]
+    header["regular"] = reader.Int()
+    extra_position = reader.Int()
+    scan = ReadMdaScan(reader, reader.position)
+
+    extras = OrderedDict()
+    if extra_position > 0:
+        reader.position = extra_position
+        for i in range(reader.Int()):
+            name = reader.String()
+            description = reader.String()
+            dbr_type = reader.Int()
+            unit = ""
+            if dbr_type == 0:
+                value = reader.String()
+            elif dbr_type in mda_extra_types:
+                count = reader.Int()
+                unit = reader.String()
+                value = reader.Array(mda_extra_types[dbr_type], count)
+                if dbr_type == 32:
+                    # Chars hold a string, ending at the first null
+                    value = "".join(chr(char) for char in value).split(
+                        "\0")[0]
+                else:
+                    value = list(value)
+            else:
+                # Past a type we don't know we can't tell where the next is
+                break
+            extras[name] = [description, unit, value]
+    return [header, extras, scan]
+
+
+# Reads the scan starting at position, along with every scan below it, and
+# leaves reader after its data. Returns {"rank", "points" (requested),
+# "completed", "name", "time", "positioners": [[number, name, desc, step
+# mode, unit, readback name, readback desc, readback unit]], "detectors":
+# [[number, name, desc, unit]], "triggers": [[number, name, command]],
+# "positioner_data": [positioner, point], "detector_data": [detector, point],
+# "lower": [scan for each completed point]}
+def ReadMdaScan(reader, position):
+    reader.position = position
+    scan = {"rank": reader.Int(), "points": reader.Int(),
+            "completed": reader.Int()}
+    lower = []
+    if scan["rank"] > 1:
+        lower = list(reader.Array(">i4", scan["points"]))
+    scan["name"] = reader.String()
+    scan["time"] = reader.String()
+    counts = [reader.Int() for i in range(3)]
+    scan["positioners"] = [[reader.Int()] + [reader.String() for j in
+                                             range(7)]
+                           for i in range(counts[0])]
+    scan["detectors"] = [[reader.Int()] + [reader.String() for j in
+                                           range(3)]
+                         for i in range(counts[1])]
+    scan["triggers"] = [[reader.Int(), reader.String(), reader.Float()] for
+                        i in range(counts[2])]
+    points = scan["points"]
+    scan["positioner_data"] = reader.Array(">f8", counts[0]*points).reshape(
+        counts[0], points)
+    scan["detector_data"] = reader.Array(">f4", counts[1]*points).reshape(
+        counts[1], points)
+    # Scans that were planned but never written have no place in the file
+    scan["lower"] = [ReadMdaScan(reader, offset) for offset in
+                     lower[:scan["completed"]] if offset > 0]
+    return scan
+
+
+# Reads an MDA file into the form ReadMdaAscii gives for each of the .asc
+# files mda2ascii would make of it: a [{column index: description}, data] for
+# every 1-D scan, outermost scan point first. As in those files, the columns
+# are the point index, then the positioners, then the detectors, and only the
+# points actually taken are kept.
+def ReadMdaScans(filename):
+    return __ListMdaScans(ReadMda(filename)[2])
+
+
+# Reads a whole MDA file into an MdaDataset, shaped as the scan was asked for
+def ReadMdaDataset(filename):
+    header, extras, scan = ReadMda(filename)
+    dataset = MdaDataset(__ListMdaScans(scan), header["dimensions"][:-1])
+    dataset.header = header
+    dataset.extras = extras
+    return dataset
+
+
+# The 1-D scans below scan, in the form ReadMdaScans gives them
+def __ListMdaScans(scan):
+    output = []
+    scans = [scan]
+    while len(scans) > 0:
+        scan = scans.pop(0)
+        if scan["rank"] > 1:
+            scans = scan["lower"] + scans
+            continue
+        descriptions = {0: ""}
+        for positioner in scan["positioners"]:
+            descriptions[len(descriptions)] = ", ".join(
+                positioner[1:]).strip()
+        for detector in scan["detectors"]:
+            descriptions[len(descriptions)] = ", ".join(
+                detector[1:]).strip()
+        completed = scan["completed"]
+        data = np.empty((len(descriptions), completed))
+        data[0] = np.arange(1, completed + 1)
+        data[1:1+len(scan["positioners"])] = \
+            scan["positioner_data"][:, :completed]
+        data[1+len(scan["positioners"]):] = \
+            scan["detector_data"][:, :completed]
+        output.append([descriptions, data])
+    return output
+
+
+# Holds a whole run as it was taken, all in one array of [scan3 point, scan2
+# point, scan1 point, column]. Runs of fewer dimensions are given the missing
+# outer ones with a single point. The columns are those of the .asc files:
+# the point index, the positioners, then the detectors, and can be asked for
+# by PV name with Column. Whatever is taken out with Scans is a view of the
+# one array, so nothing is copied until it's changed.
+class MdaDataset:
+    data = np.zeros((0, 0, 0, 0))  # Format is [scan3 point, scan2 point,
+    #                                scan1 point, column]
+    descriptions = {}  # Format is {column: description, PV name first}
+    names = []  # Format is [PV name of each column]
+    scan_numbers = []  # Format is [number of each 1-D scan], as in the .asc
+    #                    file names, in the order of Scans
+    header = {}  # Format is as from ReadMda, if read from an MDA file
+    extras = OrderedDict()  # As header
+
+    # Takes the 1-D scans as [descriptions, data] from ReadMdaAscii or
+    # ReadMdaScans, outermost first, with shape the number of points of each
+    # outer scan. Outer points the run didn't get all the way through are
+    # left out, and scans cut short are matched by trimming the others.
+    def __init__(self, scans, shape=[], scan_numbers=None):
+        shape = ([1, 1] + [int(points) for points in shape])[-2:]
+        if scan_numbers is None:
+            scan_numbers = list(range(1, len(scans) + 1))
+        count = len(scans) // shape[1]
+        scans = scans[:count*shape[1]]
+        self.scan_numbers = list(scan_numbers[:len(scans)])
+        self.header = {}
+        self.extras = OrderedDict()
+        if len(scans) == 0:
+            self.data = np.zeros((0, shape[1], 0, 0))
+            self.descriptions = {}
+            self.names = []
+            return
+
+        self.descriptions = dict(scans[0][0])
+        columns = min(len(scan[1]) for scan in scans)
+        points = min(scan[1].shape[1] for scan in scans)
+        self.data = np.empty((count, shape[1], points, columns))
+        for i, scan in enumerate(scans):
+            self.data[i // shape[1], i % shape[1]] = \
+                scan[1][:columns, :points].T
+        self.names = [self.descriptions.get(column, "").split(",")[0].strip()
+                      for column in range(columns)]
+
+    # Finds the column of a PV. The name can be given in full, without its
+    # ".VAL", or as any part of it that picks out the PV (such as "Yavg" or
+    # "elapsedSecs"). As positioners come before detectors, a PV that is both
+    # is taken as the detector. Returns None if nothing matches.
+    def Column(self, name):
+        for matches in (lambda pv: pv == name,
+                        lambda pv: pv == name + ".VAL",
+                        lambda pv: name in pv):
+            found = [column for column, pv in enumerate(self.names)
+                     if pv != "" and matches(pv)]
+            if len(found) > 0:
+                return found[-1]
+        return None
+
+    # Returns the values of one column as [scan3 point, scan2 point, scan1
+    # point], a view of data. The column is given by its index or PV name.
+    def Detector(self, column):
+        return self.data[..., self.__Index(column)]
+
+    # As Detector, but with the outer scans run together into one list of
+    # 1-D scans, in the order of scan_numbers, as [scan, scan1 point]. It is
+    # still a view of data.
+    def Scans(self, column):
+        detector = self.Detector(column)
+        return detector.reshape(-1, detector.shape[-1])
+
+    def __Index(self, column):
+        if isinstance(column, str):
+            name = column
+            column = self.Column(name)
+            if column is None:
+                raise KeyError("No column for PV " + name)
+        return column
+
+
+# OMEN's binary session files start with this line, then a line of JSON
+# saying what is in them, padded with spaces so that the arrays after it
+# start on a multiple of session_alignment bytes. Each array is stored whole,
+# in C order, also starting on such a multiple, so it can be memory-mapped.
+session_magic = "# This is a session file for use by OMEN\n"
+session_alignment = 64  # Format is bytes
+
+
+# Writes a session file. header can hold anything JSON can (numpy numbers
+# included), and refers to the arrays by their index in arrays. Where each
+# array is, its shape and type are added to it under "arrays", Format is
+# [[offset, shape, dtype]].
+def WriteSession(filename, header, arrays):
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    header = dict(header)
+    header["arrays"] = []
+    offset = 0
+    for array in arrays:
+        header["arrays"].append([offset, list(array.shape), array.dtype.str])
+        offset += array.nbytes + (-array.nbytes % session_alignment)
+    text = json.dumps(header, default=__JsonValue).encode("utf-8")
+    start = len(session_magic) + len(text) + 1
+    text += b" " * (-start % session_alignment) + b"\n"
+    with open(filename, "wb") as fileInQuestion:
+        fileInQuestion.write(session_magic.encode("utf-8") + text)
+        for array in arrays:
+            fileInQuestion.write(array.data)
+            fileInQuestion.write(b"\0" * (-array.nbytes % session_alignment))
+
+
+def __JsonValue(value):
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(repr(value) + " can't be saved in a session")
+
+
+# Reads the header of a session file, and memory-maps the arrays with the
+# given indices, all of them by default. Nothing of an array is read from the
+# disk until that part of it is used. Returns [header, {index: array}], the
+# arrays being read-only, or None if this isn't a session file.
+def ReadSession(filename, indices=None):
+    with open(filename, "rb") as fileInQuestion:
+        if fileInQuestion.readline() != session_magic.encode("utf-8"):
+            return None
+        header = json.loads(fileInQuestion.readline().decode("utf-8"))
+        start = fileInQuestion.tell()
+    if indices is None:
+        indices = range(len(header["arrays"]))
+    arrays = {}
+    for index in indices:
+        offset, shape, dtype = header["arrays"][index]
+        if int(np.prod(shape)) == 0:
+            # There is nothing to map for an empty array
+            arrays[index] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[index] = np.memmap(filename, dtype=dtype, mode="r",
+                                      offset=start + offset,
+                                      shape=tuple(shape)).view(np.ndarray)
+    return [header, arrays]
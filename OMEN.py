@@ -1,10 +1,13 @@
 from PyQt4123456 import QtGui, QtCore
 import sys
-from Raven import Raven
+from Raven import Raven, integration_rules, resample_methods
 from Lightning import Lightning as SegS
 import pyqtgraph as pg
 import numpy as np
 import copy
+import queue
+import time
+import Medium
 
 
 # Author: Ben Sheff
@@ -23,6 +26,8 @@ import copy
 # average scan from each run, with a focus on combining runs (often called
 # segments) and finding relevant statistics. The latter is focused on
 # dealing with individual runs, filtering out bad scans, etc.
+# A run can also be watched live while the LTP measures it, each scan being
+# added as soon as its file is finished (see Live).
 class OMEN(QtGui.QMainWindow):
     interest = 0  # the active trace, be it individual run or full stitched
     runs = []  # runs will hold our global Raven objects
@@ -53,6 +58,22 @@ class OMEN(QtGui.QMainWindow):
     show_combo = True  # sets whether the combined segments run is shown
     use_fit_avg = False  # Toggles whether the average fit or by-run fits
     #                      are used
+    integration_rule = "left"  # Rule used when recalculating height or slope
+    polish_circle = False  # If true, circle fits are refined after solving
+    show_recomputes = False  # If true, the status bar shows what each action
+    #                          made the active trace recompute
+    recompute_counts = {}  # Format is {product: count} as of the last action
+    live_watcher = None  # The Medium.ScanWatcher of the run watched live
+    live_run = None  # The Raven object the live scans are added to
+    live_timer = 0  # Timer that takes the live scans off live_watcher
+    live_fps = 4  # The most times a second the live run is redrawn
+    live_batch = 200  # The most live scans added between two redraws
+    stitch_mode = "global"  # How segments are stitched, from Lightning's
+    #                         stitch_modes. Global, so editing a segment only
+    #                         fits its own overlaps again, not all those after
+    live_btn = 0  # To access the live button to change its name
+    __live_redraw = 0  # Earliest time.time() for the next live redraw
+    __live_pending = False  # If true, live scans were added since the redraw
     x_label = "Position"
     x_units = "m"
     y_label = "Slope"
@@ -61,7 +82,7 @@ class OMEN(QtGui.QMainWindow):
 
     __shortcuts = {"Exit":"Ctrl+Q", "Save":"Ctrl+S", "Save Avg":"",
                    "Save Eq":"Ctrl+Shift+S", "Load":"Ctrl+L", "Undo":"Ctrl+Z",
-                   "Wipe":"Ctrl+Shift+Z"}
+                   "Redo":"Ctrl+Alt+Z", "Wipe":"Ctrl+Shift+Z"}
     __shortcuts.update({"Window Resize":"Ctrl+Shift+W", "Autosize X":"Ctrl+X", 
                         "Autosize Y":"Ctrl+Y", "Increase Offset":"Ctrl++",
                         "Decrease Offset":"Ctrl+=", "Change Y Label":"Ctrl+Shift+Y",
@@ -84,7 +105,9 @@ class OMEN(QtGui.QMainWindow):
     modes_btn = 0  # To access the mode change button to change its name
     slope_btn = 0  # To access the status of the slope button to change it
     horizontalSlider = 0  # To access the filter slider's position
+    run_curves = {}  # Format is {scan index: [plotted curves for that scan]}
     RMS_btn = 0  # To access the status of the button to show 1 sigma bands
+    poly_btns = []  # To access the polynomial fit buttons to relabel them
     plotter = 0  # to access the plotting widget globally
     number_of_scans = 0  # Checks filter changed something before replotting
     leg = 0  # Allows the legend to be saved for live-updating
@@ -181,9 +204,12 @@ class OMEN(QtGui.QMainWindow):
         # mainMenu.addAction(test_btn)
 
     def SegmentMode(self, plot_menu):
+        if self.live_watcher is not None:
+            self.Live()
         if self.view_mode <= -2:
             self.__segments_are_slopes = self.show_slope
             self.segs = SegS()
+            self.segs.SetStitchMode(self.stitch_mode)
 
         self.view_mode = (self.view_mode + 5) % 2
         plot_menu.clear()
@@ -209,15 +235,20 @@ class OMEN(QtGui.QMainWindow):
         save_btn.setShortcut(self.__shortcuts["Save"])
         save_avg_btn = file_menu.addAction("Save Average", self.SaveAvg)
         save_avg_btn.setShortcut(self.__shortcuts["Save Avg"])
+        file_menu.addAction("Save Session", self.SaveSession)
         save_eq_btn = file_menu.addAction("Save Fit Data", self.SaveEquation)
         save_eq_btn.setShortcut(self.__shortcuts["Save Eq"])
         load_btn = file_menu.addAction("Load", self.Load)
         load_btn.triggered.connect(self.Plot)
         load_btn.setShortcut(self.__shortcuts["Load"])
         file_menu.addAction("New", self.New)
+        self.live_btn = file_menu.addAction("Watch Run Live", self.Live)
         undo_btn = file_menu.addAction("Undo", self.Undo)
         undo_btn.setShortcut(self.__shortcuts["Undo"])
         undo_btn.triggered.connect(self.Plot)
+        redo_btn = file_menu.addAction("Redo", self.Redo)
+        redo_btn.setShortcut(self.__shortcuts["Redo"])
+        redo_btn.triggered.connect(self.Plot)
         wipe_btn = file_menu.addAction("Wipe clean", self.Wipe)
         wipe_btn.setShortcut(self.__shortcuts["Wipe"])
         wipe_btn.triggered.connect(self.Plot)
@@ -342,7 +373,11 @@ class OMEN(QtGui.QMainWindow):
         functs = QtGui.QActionGroup(self, exclusive=True)
         # This adds the list of polynomials to choose from, it will give the
         # options of polynomials up to degree n-1 where n is number in range()
+        # Each option lists the residue RMS it would give, updated whenever
+        # the menu is opened
         polynomials = fit_menu.addMenu("&Polynomial degree:")
+        polynomials.aboutToShow.connect(self.PolynomialRMS)
+        self.poly_btns = []
         for degree in range(6):
             poly_btn = functs.addAction(QtGui.QAction("Degree " + str(degree),
                                                       self, checkable=True))
@@ -351,6 +386,7 @@ class OMEN(QtGui.QMainWindow):
             poly_btn.triggered.connect(self.Plot)
             poly_btn.uniqueId = str(degree)
             polynomials.addAction(poly_btn)
+            self.poly_btns.append(poly_btn)
         # This is a button in the above menu to choose a circle for the fit
         circle_btn = functs.addAction(QtGui.QAction("circle",
                                                     self, checkable=True,
@@ -362,6 +398,14 @@ class OMEN(QtGui.QMainWindow):
         if not(circle_btn.isChecked()):
             circle_btn.setChecked(True)  # Is the default fit
 
+        # Button to toggle refining the circle fit, slower but a bit better
+        # with noisy data
+        polish_btn = QtGui.QAction("Polish Circle Fit", self, checkable=True)
+        polish_btn.setChecked(self.polish_circle)
+        polish_btn.triggered.connect(self.PolishCircle)
+        polish_btn.triggered.connect(self.Plot)
+        fit_menu.addAction(polish_btn)
+
         compare_btn = functs.addAction(QtGui.QAction("Other Mirror",
                                                      self, checkable=True,
                                                      checked=False))
@@ -481,9 +525,11 @@ class OMEN(QtGui.QMainWindow):
         cursor_apply_btn.triggered.connect(self.Plot)
         cursor_apply_btn.setShortcut(self.__shortcuts["Set ROI"])
 
-        # Defining the cursor itself
+        # Defining the cursor itself, which shows what the region would leave
+        # as it is dragged
         self.cursor = pg.LinearRegionItem([0.1, 0.2])
         self.cursor.setZValue(-10)
+        self.cursor.sigRegionChanged.connect(self.__ShowROIResults)
 
     # This defines a menu to do more specific analysis things that don't fit
     # the theme of any other menu.
@@ -499,6 +545,33 @@ class OMEN(QtGui.QMainWindow):
         slope_recalc_btn.triggered.connect(self.Plot)
         slope_recalc_btn.setShortcut(self.__shortcuts["Recalc Slope"])
 
+        # A checkable, exclusive menu for the rule used by the two buttons
+        # above. Default is the left-sided Riemann sum
+        rules = QtGui.QActionGroup(self, exclusive=True)
+        rule_menu = adv_menu.addMenu("&Integration rule:")
+        for rule in integration_rules:
+            rule_btn = rules.addAction(QtGui.QAction(rule.capitalize(), self,
+                                                     checkable=True))
+            rule_btn.setChecked(rule == self.integration_rule)
+            rule_btn.triggered.connect(
+                lambda checked, rule=rule: self.SetIntegrationRule(rule))
+            rule_menu.addAction(rule_btn)
+
+        # A checkable, exclusive menu for how scans are resampled onto the
+        # average x-positions, if at all. Default is to take them as read
+        methods = QtGui.QActionGroup(self, exclusive=True)
+        resample_menu = adv_menu.addMenu("&Resample scans:")
+        for method in [None] + resample_methods:
+            label = "As read" if method is None else method.capitalize()
+            method_btn = methods.addAction(QtGui.QAction(label, self,
+                                                         checkable=True))
+            method_btn.setChecked(method == self.interest.resample_method)
+            method_btn.triggered.connect(
+                lambda checked, method=method: self.SetResampling(method))
+            method_btn.triggered.connect(self.Plot)
+            resample_menu.addAction(method_btn)
+        adv_menu.addAction("Show Scan Registration", self.ShowRegistration)
+
         # Button to shift over the data so the x-range is centered on zero
         zero_x_btn = adv_menu.addAction("Zero the Position", self.ZeroX)
         zero_x_btn.triggered.connect(self.Plot)
@@ -512,6 +585,14 @@ class OMEN(QtGui.QMainWindow):
         avg_fit_btn.setShortcut(self.__shortcuts["Fit Avg"])
         adv_menu.addAction(avg_fit_btn)
 
+        # Button to toggle showing how much each action recomputes, for
+        # debugging
+        recompute_btn = QtGui.QAction("Show Recompute Counts", self,
+                                      checkable=True)
+        recompute_btn.setChecked(self.show_recomputes)
+        recompute_btn.triggered.connect(self.ShowRecomputes)
+        adv_menu.addAction(recompute_btn)
+
         # Button to apply a calibration curve
         cal_btn = adv_menu.addAction("Apply Calibration", self.Calibrate)
         cal_btn.triggered.connect(self.Plot)
@@ -528,6 +609,14 @@ class OMEN(QtGui.QMainWindow):
         seg_right_btn.triggered.connect(self.Plot)
         seg_right_btn.setShortcut(self.__shortcuts["Right Seg"])
 
+        # Button to toggle stitching all the segments at once instead of each
+        # onto those before it
+        global_btn = QtGui.QAction("Global Stitching", self, checkable=True)
+        global_btn.setChecked(self.stitch_mode == "global")
+        global_btn.triggered.connect(self.UseGlobalStitching)
+        global_btn.triggered.connect(self.Plot)
+        adv_menu.addAction(global_btn)
+
     # This is the method that manages the actual plotting. Most of the plotting
     # itself is delegated to two other methods to segregate the two main modes
     # of operation in this tool.
@@ -537,6 +626,7 @@ class OMEN(QtGui.QMainWindow):
     def Plot(self):
         # First we need to clear out the window to make a new plot
         self.plotter.clear()
+        self.run_curves = {}
         self.leg.items = []  # The legend has to be cleared or it keeps growing
         # Now to do the plotting itself:
         if not(self.view_mode <= -2):
@@ -559,6 +649,7 @@ class OMEN(QtGui.QMainWindow):
         fontsize = {"color": color, "font-size": label_size}
         self.plotter.setLabel("left", self.y_label, units=self.y_units, **fontsize)
         self.plotter.setLabel("bottom", self.x_label, units=self.x_units, **fontsize)
+        self.__ReportRecomputes()
 
     # This is the method that does the actual plotting when dealing with
     # individual segments or runs. When combining segments, see PlotSegments.
@@ -567,15 +658,20 @@ class OMEN(QtGui.QMainWindow):
     def PlotRun(self):
         # First to parse out the data itself, be it height or slope. We also
         # need the scale to let pyqtgraph know the units to use.
+        # Every scan is read out, not just those passing the filter, so that
+        # moving the filter slider only has to show or hide curves.
         all_data = []
+        every_scan = list(range(len(self.interest.scan_list)))
         if self.show_height:
-            all_data.append((0.000000001, np.array(self.interest.GetHeights()),
+            all_data.append((0.000000001,
+                             np.array(self.interest.GetHeights(every_scan)),
                              np.array(self.interest.GetHeightAverage()),
                              np.array(self.interest.height_sigmas),
                              self.interest.height_results))
             rad_units = " km"
         if self.show_slope:
-            all_data.append((0.000001, np.array(self.interest.GetSlopes()),
+            all_data.append((0.000001,
+                             np.array(self.interest.GetSlopes(every_scan)),
                              np.array(self.interest.GetSlopeAverage()),
                              np.array(self.interest.slope_sigmas),
                              self.interest.slope_results))
@@ -595,7 +691,7 @@ class OMEN(QtGui.QMainWindow):
         # space given what is being plotted.
         residue_results = self.interest.residue_results
         if self.show_residue:
-            residue = np.array(self.interest.GetResidue())
+            residue = np.array(self.interest.GetResidue(every_scan))
             residue_avg = np.array(self.interest.residue_avg)
             residue_sigmas = np.array(self.interest.residue_sigmas)
             offset = data_results[2]
@@ -606,20 +702,25 @@ class OMEN(QtGui.QMainWindow):
                     offset += data_results[1]
             offset = offset*self.offset_scale + data_results[0]
         for scale, data, data_avg, data_sigmas, data_results in all_data:
-            # Plotting all the runs together
+            # Plotting all the runs together, hiding those filtered out
             if(self.show_raw_data):
+                passed = set(self.interest.filtered_list)
                 for i in range(len(data)):
                     # The following line sets color for each raw plot based on
                     # pyqtgraphs int-to-color alg., takes (color, num colors)
                     pen = pg.mkPen((2*self.scan_number -
-                                    self.interest.GetScanList()[i],
+                                    self.interest.scan_list[i],
                                     3*self.scan_number))
-                    self.plotter.plot(data[i][0]*0.001,
-                                      data[i][1]*scale, pen=pen)
+                    curves = [self.plotter.plot(data[i][0]*0.001,
+                                                data[i][1]*scale, pen=pen)]
                     if self.show_residue:
                         tmp = offset*scale
-                        self.plotter.plot(residue[i][0]*0.001,
-                                          residue[i][1]*scale + tmp, pen=pen)
+                        curves.append(self.plotter.plot(residue[i][0]*0.001,
+                                                        residue[i][1]*scale +
+                                                        tmp, pen=pen))
+                    for curve in curves:
+                        curve.setVisible(i in passed)
+                    self.run_curves.setdefault(i, []).extend(curves)
 
             # # Plotting the fit to the data, along with setting its legend entry
             if(self.show_fit):
@@ -628,6 +729,8 @@ class OMEN(QtGui.QMainWindow):
                 name += "Residue P-V = {1:.3g}"
                 if self.currentfit == 9 or self.currentfit == 2:
                     temp = " | R = {0:.4g}" + rad_units
+                    if self.currentfit == 9:
+                        temp = " | R = {0:.4g} km"  # Circles are always km
                     name += temp.format(self.interest.radius)
             # Uncomment below, and comment matching text above for legend to
             # list the fit:
@@ -749,6 +852,8 @@ class OMEN(QtGui.QMainWindow):
             name += "Residue P-V = {1:.3g}"
             if self.currentfit == 9 or self.currentfit == 2:
                 temp = " | R = {0:.4g}" + rad_units
+                if self.currentfit == 9:
+                    temp = " | R = {0:.4g} km"  # Circles are always km
                 name += temp.format(self.interest.radius)
             name = name.format(residue_results[1], residue_results[2])
             self.plotter.plot(np.array(self.interest.GetFitAverage()[0])*0.001,
@@ -810,6 +915,22 @@ class OMEN(QtGui.QMainWindow):
         else:
             self.interest.Save(name)
 
+    # Saves everything in the binary session format, which loads back faster
+    # and exactly, start point included
+    def SaveSession(self):
+        tmp = self.interest.default_file.format(0).split(".as")[0] + ".omen"
+        name = QtGui.QFileDialog.getSaveFileName(self, "Save As:", tmp,
+                                                 ".omen")
+        if name == "":
+            return
+        if self.view_mode == 1:
+            for i, segment in enumerate(self.runs):
+                tmp = name.split(".")
+                tmp.insert(1, "{0:04d}.")
+                segment.SaveSession((tmp[0] + tmp[1] + tmp[2]).format(i))
+        else:
+            self.interest.SaveSession(name)
+
     # Saves the current Average, so you can do further analysis elsewhere :(
     def SaveAvg(self):
         tmp = self.interest.default_file.format(0)
@@ -828,6 +949,8 @@ class OMEN(QtGui.QMainWindow):
         name = QtGui.QFileDialog.getOpenFileName(self, "Load:")
         if name == "":
             return
+        if self.live_watcher is not None:
+            self.Live()
 
         self.runs.append(Raven([]))
         self.run_num = len(self.runs) - 1
@@ -871,22 +994,99 @@ class OMEN(QtGui.QMainWindow):
         self.AutoY()
         self.horizontalSlider.setSliderPosition(0)
 
+    # Watches a run as the LTP measures it, given any of its scan files,
+    # adding each scan as soon as its file is finished (see
+    # Medium.ScanWatcher). The files are found and read on a thread of their
+    # own, while a timer adds what was read to the run here, without fitting
+    # or integrating the others again (see Raven.AddScan). Redraws are put
+    # together, to at most live_fps a second, and slowed down further when
+    # they start taking up much of the time, so the window keeps responding
+    # however many scans the run goes on to. Choosing it again stops watching.
+    def Live(self):
+        if self.live_watcher is not None:
+            self.live_timer.stop()
+            self.live_watcher.Stop()
+            self.live_watcher = None
+            self.live_btn.setText("Watch Run Live")
+            return
+        if self.view_mode > -2:
+            QtGui.QMessageBox.warning(self, "Mode Error",
+                                      "Runs can only be watched live " +
+                                      "before using segments mode")
+            return
+        name = QtGui.QFileDialog.getOpenFileName(self, "Any scan of the run:")
+        if name == "":
+            return
+
+        self.live_run = Raven([])
+        self.live_run.default_file = name
+        self.live_watcher = Medium.ScanWatcher(name)
+        self.live_watcher.start()
+        self.live_timer = QtCore.QTimer(self)
+        self.live_timer.timeout.connect(self.__TakeLiveScans)
+        self.live_timer.start(1000 // self.live_fps)
+        self.live_btn.setText("Stop Watching")
+
+    # Adds the scans read since the last time to the live run, up to
+    # live_batch of them, and redraws if due. The batch is recorded for undo
+    # once, before its first scan.
+    def __TakeLiveScans(self):
+        added = 0
+        while added < self.live_batch:
+            try:
+                number, name, read = self.live_watcher.scans.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self.live_run.AddRawScan(number, read, added == 0)
+                added += 1
+            except ValueError:
+                self.statusBar().showMessage("Left out " + name + ", it " +
+                                             "doesn't match the other scans")
+        if added > 0 and self.live_run not in self.runs:
+            # Its first scan, which adds it after the runs already open and
+            # makes it the one looked at
+            self.runs.append(self.live_run)
+            self.run_num = len(self.runs) - 1
+            self.interest = self.live_run
+            self.ReFit()
+            self.AutoX()
+            self.__live_redraw = 0
+        self.__live_pending = self.__live_pending or added > 0
+        if not self.__live_pending or time.time() < self.__live_redraw:
+            return
+
+        self.__live_pending = False
+        self.scan_number = len(self.interest.scan_list)
+        start = time.time()
+        self.Plot()
+        self.__live_redraw = time.time() + max(1 / self.live_fps,
+                                               4 * (time.time() - start))
+
     # Opens a new instance of this analysis engine.
     def New(self):
         self.disciples.append(OMEN(self))
         self.disciples[len(self.disciples)-1].show()
 
-    # Undoes the last significant change. You can only undo one change, since
-    # it currently works by saving the entirety of the data, not the changes
+    # Undoes the last significant change. Changes can be undone one after
+    # another, as far back as the history's memory budget allows
     def Undo(self):
-        self.interest.Undo()
-        self.ReFit()
-        self.AutoX()
+        if self.interest.Undo():
+            self.ReFit()
+            self.AutoX()
+
+    # Re-does the last change undone
+    def Redo(self):
+        if self.interest.Redo():
+            self.ReFit()
+            self.AutoX()
 
     # Undoes everything you've done since loading the file(s), restoring the
     # data to its original state. This can be undone with the Undo method
     def Wipe(self):
         self.interest.ReturnToStartPoint()
+        self.ReFit()
+        self.AutoX()
 
     # Quits the program
     def Exit(self):
@@ -990,6 +1190,11 @@ class OMEN(QtGui.QMainWindow):
         self.currentfit = 9
         self.ReFit()
 
+    # Toggles refining circle fits by Levenberg-Marquardt
+    def PolishCircle(self):
+        self.polish_circle = not self.polish_circle
+        self.ReFit()
+
     def CompareMirrors(self):
         name = QtGui.QFileDialog.getOpenFileName(self, "Comparison:")
         if name == "":
@@ -1018,16 +1223,14 @@ class OMEN(QtGui.QMainWindow):
         # Fit the comparison run to the active one:
         comparison_data = []
         original_data = []
+        original_data.append(list(self.interest.GetX()))
+        comparison_data.append(list(comparison_run.GetX()))
         if self.show_slope:
-            original_data.append(self.interest.GetSlopes()[0][0])
-            original_data.append(self.interest.GetSlopeAverage())
-            comparison_data.append(comparison_run.GetSlopes()[0][0])
-            comparison_data.append(comparison_run.GetSlopeAverage())
+            original_data.append(list(self.interest.GetSlopeAverage()))
+            comparison_data.append(list(comparison_run.GetSlopeAverage()))
         else:
-            original_data.append(self.interest.GetHeights()[0][0])
-            original_data.append(self.interest.GetHeightAverage())
-            comparison_data.append(comparison_run.GetHeights()[0][0])
-            comparison_data.append(comparison_run.GetHeightAverage())
+            original_data.append(list(self.interest.GetHeightAverage()))
+            comparison_data.append(list(comparison_run.GetHeightAverage()))
         # Since stitching will only adjust data on the right side, we must
         # force the new data to be on the right
         while comparison_data[0][0] <= original_data[0][0]:
@@ -1042,15 +1245,8 @@ class OMEN(QtGui.QMainWindow):
 
         # Then we have to make this the function the Raven object
         # thinks it's fitted on, to retain nice features like residue finding
-        if self.__segments_are_slopes:
-            x = self.interest.GetSlopes()
-        else:
-            x = self.interest.GetHeights()
-        self.interest.fit_function = [[funct[0],
-                                       fitter.LinearInterpolate(funct[0], 0, -self.interest.offset[1])]
-                                      for funct in x]
-        self.interest.fit_avg = [[i - self.interest.offset[0] for i in x[0][0]],
-                                  fitter.LinearInterpolate(x[0][0], 0, -self.interest.offset[1])]
+        self.interest.SetFit(fitter.LinearInterpolate(self.interest.GetX(), 0,
+                                                      -self.interest.offset[1]))
         self.ReFit()
 
 
@@ -1068,6 +1264,17 @@ class OMEN(QtGui.QMainWindow):
         self.currentfit = int(degree)
         return self.ReFit()
 
+    # Labels each polynomial degree in the fit menu with the residue RMS it
+    # would leave on the plotted data
+    def PolynomialRMS(self):
+        data_type = int(self.show_height)%2
+        rms = self.interest.GetPolynomialRMS(data_type, len(self.poly_btns)-1)
+        for degree, poly_btn in enumerate(self.poly_btns):
+            name = "Degree " + str(degree)
+            if degree < len(rms):
+                name += " | Residue RMS = {0:.3g}".format(rms[degree])
+            poly_btn.setText(name)
+
     # Fits a polynomial to the current data and to the average of the data.
     # Now obsolete
     # def Polynomial(self, degree):
@@ -1084,12 +1291,7 @@ class OMEN(QtGui.QMainWindow):
     # of a fraction of the total width should be added ad additional space
     # at the edges
     def AutoX(self, padding=0):
-        if self.show_height:
-            x = self.interest.GetHeights()[0][0]
-        else:
-            x = self.interest.GetSlopes()[0][0]
-        xmax = x[len(x)-1]
-        xmin = x[0]
+        xmin, xmax = self.interest.GetXRange()
         self.plotter.setXRange(*(0.001*xmin, 0.001*xmax), padding=padding)
 
     # Adjusts the Y-axis to be a reasonable scale, padding is set to default,
@@ -1214,13 +1416,18 @@ class OMEN(QtGui.QMainWindow):
         if value <= 0:
             value += 0.000000001
         self.filter_rigor = 1./(1. - value) - 1
-        number_of_scans = len(self.interest.filtered_list)
         if self.show_height:
-            self.interest.FilterHeights(self.filter_rigor)
+            added, removed = self.interest.FilterHeights(self.filter_rigor)
         else:
-            self.interest.FilterSlopes(self.filter_rigor)
-        if number_of_scans != len(self.interest.filtered_list):
-            self.Plot()
+            added, removed = self.interest.FilterSlopes(self.filter_rigor)
+        # Only the curves of scans that changed need to be touched
+        for index in added:
+            for curve in self.run_curves.get(index, []):
+                curve.setVisible(True)
+        for index in removed:
+            for curve in self.run_curves.get(index, []):
+                curve.setVisible(False)
+        self.__ReportRecomputes()
 
     # Applies the selected filter and strength to the data, allowing iterative
     # filtering
@@ -1249,11 +1456,30 @@ class OMEN(QtGui.QMainWindow):
         self.ReFit()
         self.AutoX(0.01)
 
+    # Shows the RMS and peak-to-valley of the average, and of its residue,
+    # over just the region of interest in the status bar. These come from the
+    # averages as they are (see Raven.GetROIResults), so keep up with the
+    # cursor being dragged.
+    def __ShowROIResults(self):
+        if not self.view_cursor:
+            return
+        results = self.interest.GetROIResults(
+            list(1000*np.array(self.cursor.getRegion())))
+        if results is None:
+            self.statusBar().clearMessage()
+            return
+        data, units = results[0], "urad"
+        if self.show_height:
+            data, units = results[1], "nm"
+        message = "ROI: RMS {0:.3g} {2}, P-V {1:.3g} {2} | Residue RMS "
+        message += "{3:.3g} {2}, P-V {4:.3g} {2}"
+        self.statusBar().showMessage(message.format(data[1], data[2], units,
+                                                    results[2][1],
+                                                    results[2][2]))
+
     # Resets the region of interest to be the middle third of the data span
     def CursorRes(self):
-        temp = len(self.interest.GetSlopes()[0][0])-1
-        xmax = self.interest.GetSlopes()[0][0][temp]
-        xmin = self.interest.GetSlopes()[0][0][0]
+        xmin, xmax = self.interest.GetXRange()
         xmax = 2*(xmax*0.001-xmin*0.001) / 3 + xmin*0.001
         xmin = (xmax-xmin*0.001) / 2 + xmin*0.001
         self.cursor.setRegion([xmin, xmax])
@@ -1270,9 +1496,7 @@ class OMEN(QtGui.QMainWindow):
     # NEEDS UPDATE: only sets active Raven to zero
     # Sets the middle of the x-range to be zero, shifting everything over
     def ZeroX(self):
-        temp = len(self.interest.GetSlopes()[0][0])-1
-        xmax = self.interest.GetSlopes()[0][0][temp]
-        xmin = self.interest.GetSlopes()[0][0][0]
+        xmin, xmax = self.interest.GetXRange()
         offset = (xmax + xmin) / 2000
         self.interest.ZeroX(offset * 1000)
         self.AutoX()
@@ -1307,20 +1531,93 @@ class OMEN(QtGui.QMainWindow):
 
     # Re-calculates the height data based on the current available slope data
     def ReCalcH(self):
+        self.interest.SetIntegrationRule(self.integration_rule)
         self.interest.AcquireAnalysisVariables()
         self.ReFit()
 
     # Re-calculates the height data based on the current available slope data
     def ReCalcS(self):
+        self.interest.SetIntegrationRule(self.integration_rule)
         self.interest.AcquireSlopes()
         self.ReFit()
 
+    # Chooses the integration rule for the next height or slope recalculation
+    def SetIntegrationRule(self, rule):
+        self.integration_rule = rule
+
+    # Resamples the scans of the run looked at onto the average x-positions,
+    # by method, or takes them as read again for None
+    def SetResampling(self, method):
+        if self.interest.dataset is None:
+            QtGui.QMessageBox.warning(self, "No Raw Data",
+                                      "Only runs loaded from the LTP's own " +
+                                      "files can be resampled")
+            return
+        self.interest.SetResampling(method)
+        self.ReFit()
+
+    # Shows how far off the average x-positions those of each scan were when
+    # read, worst first
+    def ShowRegistration(self):
+        registration = [[largest, rms, average, scan] for scan, [
+            average, rms, largest] in self.interest.registration.items()]
+        if len(registration) == 0:
+            QtGui.QMessageBox.information(self, "Scan Registration",
+                                          "No scans were read with their " +
+                                          "x-positions")
+            return
+        message = "Scan: average, RMS, largest x-offset (um)\n"
+        for largest, rms, average, scan in sorted(registration)[::-1][:30]:
+            message += "{0}: {1:.3g}, {2:.3g}, {3:.3g}\n".format(
+                scan + 1, average * 1000, rms * 1000, largest * 1000)
+        if len(registration) > 30:
+            message += "({0} more)".format(len(registration) - 30)
+        QtGui.QMessageBox.information(self, "Scan Registration", message)
+
+    # Toggles the status bar display of how much each action recomputes
+    def ShowRecomputes(self):
+        self.show_recomputes = not self.show_recomputes
+        self.recompute_counts = dict(self.interest.recompute_counts)
+        if not self.show_recomputes:
+            self.statusBar().clearMessage()
+
+    # Shows how many times each derived product of the active trace was
+    # worked out since the last report, if show_recomputes is on
+    def __ReportRecomputes(self):
+        if not self.show_recomputes:
+            return
+        counts = self.interest.recompute_counts
+        message = "Recomputed:"
+        for product in sorted(counts):
+            message += " {0} {1},".format(product, counts[product] -
+                                          self.recompute_counts.get(product, 0))
+        self.statusBar().showMessage(message.rstrip(","))
+        self.recompute_counts = dict(counts)
+
     # Changes the fitting to use the average fit instead of the fits on each
     # run
     def UseFitAvg(self):
         self.use_fit_avg = not self.use_fit_avg
         self.ReFit()
 
+    # Changes the stitching between fitting each segment to those before it
+    # and solving for all of them together, restitching if in segment mode
+    def UseGlobalStitching(self):
+        if self.stitch_mode == "global":
+            self.stitch_mode = "chain"
+        else:
+            self.stitch_mode = "global"
+        if self.view_mode < 0:
+            return
+        self.__UpdateAllSegments()
+        if self.stitch_mode == "global" and self.segs.overlap_residuals != []:
+            worst = max(self.segs.overlap_residuals,
+                        key=lambda residual: abs(residual[3]))
+            self.statusBar().showMessage(
+                "Largest overlap residual: segments {0} and {1}, x {2:.3g}, "
+                "y {3:.3g}".format(worst[0] + 1, worst[1] + 1, worst[2],
+                                   worst[3]))
+
     # Shifts the segment of interest
     def ShiftSegment(self, direction):
         if self.view_mode < 0:
@@ -1358,7 +1655,7 @@ class OMEN(QtGui.QMainWindow):
         self.interest.UseFitAverage(self.use_fit_avg)
         data_type = int(self.show_height)%2
         if self.currentfit == 9:
-            self.interest.FitCircle(data_type)
+            self.interest.FitCircle(data_type, self.polish_circle)
         if self.currentfit >= 0 and self.currentfit <= 5:
             self.interest.FitPolynomial(self.currentfit, data_type)
         if self.currentfit == 8:
@@ -1366,17 +1663,10 @@ class OMEN(QtGui.QMainWindow):
             self.interest.Reset()
 
         if self.view_mode == 1:
-            f = SegS(copy.deepcopy(self.interest.fit_avg))
+            f = SegS(self.interest.GetFitAverage())
             for segment in self.runs:
-                if self.__segments_are_slopes:
-                    x = segment.GetSlopes()[0][0]
-                else:
-                    x = segment.GetHeights()[0][0]
-                segment.fit_function = [[funct[0], f.LinearInterpolate(funct[0],
-                                         -segment.offset[0], -segment.offset[1])]
-                                        for funct in segment.fit_function]
-                segment.fit_avg = [[i - segment.offset[0] for i in x],
-                                   f.LinearInterpolate(x, 0, -segment.offset[1])]
+                segment.SetFit(f.LinearInterpolate(segment.GetX(), 0,
+                                                   -segment.offset[1]))
 
     # This handles updating the Lightning
     # object to reflect the current data
@@ -1388,12 +1678,10 @@ class OMEN(QtGui.QMainWindow):
 
         active = self.runs[self.run_num]
         if self.__segments_are_slopes:
-            bad_segs = self.segs.AddSegment([[x-active.offset[0] for x in
-                                              active.GetSlopes()[0][0]],
+            bad_segs = self.segs.AddSegment([list(active.GetX(False)),
                                              active.slope_avg])
         else:
-            bad_segs = self.segs.AddSegment([[x-active.offset[0] for x in
-                                              active.GetHeights()[0][0]],
+            bad_segs = self.segs.AddSegment([list(active.GetX(False)),
                                              active.height_avg])
 
         if remove_redundencies:
@@ -1427,19 +1715,16 @@ class OMEN(QtGui.QMainWindow):
                 self.run_num -= 1
 
     def __UpdateAllSegments(self):
-        self.segs = SegS()
+        self.segs.ClearSegments()
+        self.segs.SetStitchMode(self.stitch_mode)
         for segment in self.runs:
             if self.__segments_are_slopes:
-                self.segs.AddSegment([[x-segment.offset[0] for x in
-                                       segment.GetSlopes()[0][0]],
-                                      [y-segment.offset[1] for y in
-                                       segment.GetSlopeAverage()]],
+                self.segs.AddSegment([list(segment.GetX(False)),
+                                      list(segment.slope_avg)],
                                      True)
             else:
-                self.segs.AddSegment([[x-segment.offset[0] for x in
-                                       segment.GetHeights()[0][0]],
-                                      [y-segment.offset[1] for y in
-                                       segment.GetHeightAverage()]],
+                self.segs.AddSegment([list(segment.GetX(False)),
+                                      list(segment.height_avg)],
                                      True)
         self.segs.StitchAll()
         for i, segment in enumerate(self.runs):
@@ -1448,7 +1733,7 @@ class OMEN(QtGui.QMainWindow):
 
     def test(self):
         for i, seg in enumerate(self.runs):
-            print(seg.GetSlopes()[0][0][0])
+            print(seg.GetXRange()[0])
             print(self.segs.segments[i])
 
 if __name__ == "__main__":
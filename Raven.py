@@ -2,7 +2,7 @@ import scipy.optimize as chisquarefit
 import numpy as np
 from Lightning import Lightning
 import Medium
-import copy
+from collections import OrderedDict
 
 # Author: Ben Sheff
 # Made for the Optics Group in Division XSD of the APS
@@ -12,15 +12,19 @@ import copy
 #
 # Some of this documentation is a bit outdated at the moment
 # This loops over all the available data files. For each one it reads in the
-# data, parses it into a list of lists, and plots those lists.
+# data, and stores it column-wise: one x-vector shared by every scan, and one
+# 2-D array (scans x positions) for each quantity (slope, height, fit, residue)
+# so that every method below works on whole arrays rather than looping over
+# individual points in python.
 # It then has a series of useful methods for fitting the data, both on the
 # average curve and all the curves individually, and methods to remove the
 # fit. There are also filters described in detail below.
 #
 # Important things to note / bugs
-# The integrated data (heights), is done using simple left-sided Riemann
-# summation. This leads to a resolution limitation, but it's to the same degree
-# as the original slope data. There is also some error in the exact data
+# The integrated data (heights), is done by default using simple left-sided
+# Riemann summation, though trapezoid and Simpson rules can be chosen with
+# SetIntegrationRule. This leads to a resolution limitation, but it's to the
+# same degree as the original slope data. There is also some error in the exact data
 # positions as the x-positions delineate the leftmost end of the rectangle used
 # to get the height listed at that point. In the case of the final point, it is
 # a right-handed sum, as a left-handed one is impossible. It is of note that
@@ -28,89 +32,114 @@ import copy
 # will cause substantial distortions. The  differentiation code is roughly
 # the inverse of the integraton code, but not exactly
 # As of yet, the most methods in this and other classes assume all scans for
-# the same segment have the same set of x-coordinates. Fixing this should be
-# relatively simple, have the averaging methods also average the x-coordinates,
-# and carry their x-coordinates with them. Then update all classes that use
-# this to use x from the average data itself instead of raw data. You could
-# do it more rigorously by interpolating the scans, and choosing one set of x
-# coordinates at random to be the averaged version. The errors from this should
-# be small. Empirically, they appear to be negligible
+# the same segment have the same set of x-coordinates, those of the first.
+# The errors from this should be small. Empirically, they appear to be
+# negligible, and registration holds how far each scan's x-positions are off
+# from the average ones to check that. Where they aren't, SetResampling has
+# the scans interpolated onto one grid of x-positions as they are loaded, all
+# scans at once (see Resample), after which they really do share them.
 # There is some degree of error in the fitting functions. The polynomial fit
 # is using a function explicitly designed to do polynomial fitting, and is
-# quite good, but the circle one can be pretty aweful at times.
+# quite good. The circle fit is algebraic, which is exact for a clean circle
+# but slightly favors smaller circles with noise; polish_circle refines it.
 #
-# Some methods:             * = may cause memory leaks due to use of copy class
-# __init__(filename, num_scans) Reads in slope data from files derived from
-#                               filename, iterating file indices in num_scans
+# Some methods:
+# __init__(filename, num_scans) Reads in slope data from the scan files of
+#                               the run filename belongs to, all those found
+#                               or just the indices in num_scans
 # AcquireAnalysisData()(AAV)Calculates the Height data by integrating slopes
 # AcquireSlopes()           Calculates Slope data by differentiating heights
-# UpdateStats()             Gets avg/RMS of slope/height. Calls AnalyzeAverages
+# SetIntegrationRule(rule)  Chooses the rule used by AAV and AcquireSlopes
+# SetSlopeDetector(name)    Takes slopes from another detector of the run, by
+#                               PV name, without reading the files again
+# SetResampling(method, grid) Interpolates the scans of the run onto one grid
+#                               of x-positions, or takes them as read again
+# GetRegistration(scans)    Returns how far the x-positions of the scans in
+#                               filtered_list (or scans) were off the grid
+# UpdateStats()             Gets avg/RMS of slope/height/residue, along with
+#                               the results of AnalyzeAverages
 # AnalyzeAverages()         Gets avg/RMS/peak-to-valley of slope/height/residue
 # ResetFilter()             Sets the list of scans passing filter to all scans
 # ApproveFilter()           Removes the scans not in filtered_list (not passing
 #                               the filter) from the data
+# AddScan(slopes, x, index, undo) Adds one scan to the data, integrating and
+#                               fitting only it and updating the stats as it
+#                               goes
+# AddRawScan(number, read, undo) As AddScan, for a scan file read by Medium
+# RemoveScan(index)         Takes one scan out again, updating the stats
 # Reset()                   Recalculates averages, RMS's, and filters
-# SetUndo()*                Sets backups for slopes, heights, and scan_list*
-# Undo()                    Uses backups from SetUndo
-# SetStartPoint()*          Sets second backup for slopes, heights, scan_list*
-# ReturnToStartPoint()      Uses backups from SetStartPoint
+# SetUndo()                 Records slopes, heights, fits, and scan_list in
+#                               the undo history
+# Undo()                    Steps back through the history from SetUndo
+# Redo()                    Steps forward again through what Undo undid
+# SetStartPoint()           Pins the current data as a long-term backup
+# ReturnToStartPoint()      Uses backup from SetStartPoint, can be undone
+# SetHistoryBudget(budget)  Sets the bytes of old data the history may keep
 # SetROI(list region=[start, end]) Removes any data with x-value outside region
-# FitCircle(data_type)      Fits a circle to data clarified in data_type
+# GetROIResults(region)     Returns what SetROI(region) would leave as the
+#                               results, without changing anything
+# FitCircle(data_type, polish) Fits a circle to data clarified in data_type
 # FitPolynomial(degree, data_type) Fits a degree degree polynomial to data_type
-# UpdateResidue()*          Recalculates residue, subtracting the fit from data
-#                               chosen in fit_data_type, and gets related stats
+# GetPolynomialRMS(data_type) Residue RMS each polynomial degree would leave
+# UpdateResidue()           Recalculates residue, subtracting the fit from data
+#                               chosen in fit_data_type
+# (Stats, residue and deviations are also worked out by themselves whenever
+#   read after their data changed, so the methods above rarely need calling)
 # SubtractFit()             Sets data from fit_data_type to the current residue
 # PrepFilter()              Finds integrated positive deviation in standard
 #                               deviations beyond 1 for slope and height data
 # FilterHeights(rigor)      Removes any scan with height_deviation above the
 #                               limit from filtered_list. Updates filter_rigor
-#                               deviations beyond 1 for slope and height data
+#                               and returns the scans added and removed
 # FilterSlopes(rigor)       Removes any scan with slope_deviation above the
 #                               limit from filtered_list. Updates filter_rigor
+#                               and returns the scans added and removed
 # AddCalibration(raven)     Updates all internal data to reflect a given
 #                               calibration curve, including fit.
 # Save(filename)            Saves slopes, heights, fit_function, fit_avg, and
 #                               scan_list to filename so work can be recreated
 # SaveAvg(filename)         Saves only the position and data for the active avg
-# Load(filename)            Loads data from either raw files or OMEN-made ones
-# GetSlopes()               Returns those slope traces with indices in
-#                               filtered_list, after adding the offset
-# GetHeights()              Returns those height traces with indices in
-#                               filtered_list, after adding the offset
+# SaveSession(filename)     Saves everything, start point included, in OMEN's
+#                               binary session format
+# Load(filename)            Loads data from either raw files (mda2ascii's or
+#                               the binary .mda) or OMEN-made ones, sessions
+#                               (.omen) included
+# SetFit(fit_avg, fit_function) Replaces the fit with externally made curves
+# GetSlopes(scans)          Returns a TraceView of the slope traces with
+#                               indices in filtered_list (or scans), which
+#                               adds the offset only to what is read from it
+# GetHeights(scans)         As GetSlopes, for the height traces
 # GetScanList()             Returns scan indices with indices in filtered_list
-# GetResidue()              Returns residue traces with indices in
-#                               filtered_list, after adding the offset
+# GetResidue(scans)         As GetSlopes, for the residue traces
+# GetX(offset)              Returns the shared x-positions, after adding offset
+#                           unless offset is False
+# GetXRange()               Returns [first, last] of those x-positions
 # SetOffset()               Sets the offset to be applied to all data
 #
 #
 # Note variables have further clarification in the class itself.
 # Useful Variables:         Created in:         Purpose:
 # default_file              __init__            Initial file input for data
-# slope_sigmas              __FindSlopeRMSOverScans         RMS of position
-#                                                       over scans
-# slope_avg                 __FindSlopeAverageOverScans Avg position over scans
-# height_sigmas             __FindHeightRMSOverScans        RMS integrated data
-#                                                   at each position over scans
-# height_avg                __FindHeightAverageOverScans    Avg integrated data
-#                                                   at each position over scans
+# slope_sigmas              UpdateStats         RMS of position over scans
+# slope_avg                 UpdateStats         Avg position over scans
+# height_sigmas             UpdateStats         RMS integrated data at each
+#                                                   position over scans
+# height_avg                UpdateStats         Avg integrated data at each
+#                                                   position over scans
 # scan_list                 __init__            The original indices of scans
 # slope_results             AnalyzeAverages     Data about the avg slope trace
 # height_results            AnalyzeAverages     Data about the avg height trace
-# FOO_last where x is any   SetUndo             Holds old data before recent
-#   variable above                                  action, so you can undo
-# FOO_initial where x is    SetStartPoint       Allows for easier large-scale
-#   any variable above                              undo-ing of actions
+# scan_list_initial         SetStartPoint       scan_list at the start point
+# history_budget            SetHistoryBudget    Bytes of old data undo keeps
 # fit_function              FitFOO              Data for plot of fits
 # fit_avg                   FitFOO              As fit_function, but fit to avg
 # read_fit                  FitFOO              Printable for fitted function
 # fit_data_type             FitFOO              Records which data is fitted
 # residue                   UpdateResidue       Holds active data minus fit
-# residue_avg               __FindResidueAverageOverScans   Avg of the residue
-#                                                   over scans
-# residue_sigmas            __FindResidueRMSOverScans       RMS of the residue
-#                                                   over scans
-# residue_results           AnalyzeAverages/UpdateResidue   Data about the avg
-#                                                   residue trace
+# residue_avg               UpdateStats         Avg of the residue over scans
+# residue_sigmas            UpdateStats         RMS of the residue over scans
+# residue_results           AnalyzeAverages     Data about the avg residue
+#                                                   trace
 # slope_deviation           PrepFilter          Holds level of deviation: slope
 #                                                   each run, for faster filter
 # height_deviation          PrepFilter          Holds level of deviation height
@@ -119,106 +148,151 @@ import copy
 #                                                   deviation is inverse
 # filtered_list             FilterFOO/ResetFilter   Holds indices in current
 #                                                   data list of allowed runs
-# radius                    FitCircle           Radius of mirror, from avg run
+# radius                    FitCircle           Signed radius of mirror in km,
+#                                                   from avg run
 # offset                    SetOffset           The offset applied to all data
+# dataset                   __init__            The whole raw run as loaded,
+#                                                   every detector included
+# slope_detector            SetSlopeDetector    PV name of the detector that
+#                                                   gives the slopes
+# resample_method           SetResampling       How the scans are resampled
+#                                                   onto a grid, if they are
+# resample_grid             SetResampling       The grid they are resampled
+#                                                   onto, if not the average
+# registration              __Register          Jitter of the x-positions of
+#                                                   each scan as read
 #
 #
 # Finally, private variables that are still pretty important:
 # Variable:                 Created in:         Purpose:
+# __x                       __init__            x-positions shared by all scans
+# __scan_x                  __init__            x-positions as read for each scan
 # __slopes                  __init__            All the raw data
 # __heights                 AAV                 Integrated raw data
+# __history                 Load                Undo/redo History, holding
+#                                                   the start point as well
+# __products                __Derive            Derived products (residue,
+#                                                   stats, deviations) along
+#                                                   with what they came from
+# recompute_counts          __Derive            How many times each product
+#                                                   has been worked out
 
 
 class Raven:
     # Setting up some attributes.
-    __slopes = []   # Format is [ScanNumber, {0:x (followed by index), 1:y
-    #                  (followed by index)]
-    __slopes_last = []  # Format is [ScanNumber, {0:x (followed by index), 1:y
-    #                  (followed by index)]
-    __slopes_initial = []  # Format is [ScanNumber, {0:x (followed by index),
-    #                   1:y (followed by index)]
-    __heights = []  # Format is [ScanNumber, {0:x, 1:y}]
-    __heights_last = []  # Format is [ScanNumber, {0:x, 1:y}]
-    __heights_initial = []  # Format is [ScanNumber, {0:x, 1:y}]
-    slope_sigmas = []  # Format is [position-index]
-    slope_avg = []  # Format is [position-index]
-    height_sigmas = []  # Format is [position-index]
-    height_avg = []  # Format is [position-index]
+    __x = np.zeros(0)  # Format is [position-index], shared by every scan
+    __scan_x = np.zeros((0, 0))  # Format is [ScanNumber, position-index]
+    __slopes = np.zeros((0, 0))  # Format is [ScanNumber, position-index]
+    __heights = np.zeros((0, 0))  # Format is [ScanNumber, position-index]
     fit_data_type = 0  # Format is {1:height data, 0:slope data}
-    residue = []   # Format is [ScanNumber, {0:x, 1:y] since I use the term a
-    #                   lot, I'll clarify again, residue = data minus fit
-    residue_avg = []  # Format is [position-index]
-    residue_sigmas = []  # Format is [position-index]
-    slope_results = []  # Format is [{0:average, 1:RMS, 2:p-v}]
-    height_results = []  # Format is [{0:average, 1:RMS, 2:p-v}]
-    residue_results = []  # Format is [{0:average, 1:RMS, 2:p-v}]
     default_file = "C:\\Users\\Ben Sheff\\Documents\\Argonne\\"
     # default_file += "Test Data\\Sheff_300mm_test0001_01_1.asc"
     #default_file += "\\Flat_Mirror_Segments\\Flat_Mirror0001_01_1.asc"
     default_file += "\\Flat_Mirror_Full\\Flat_Mirror_full_03_1.asc"
     scan_list = list(range(99))  # Format is [index]
-    scan_list_last = list(range(99))  # Format is [index]
     scan_list_initial = list(range(99))  # Format is [index]
-    fit_function = []  # Format is [ScanNumber, {0:x (followed by index), 1:y
-    #                  (followed by index)]
-    fit_function_last = []  # Format is [ScanNumber, {0:x (followed by index),
-    #                  1:y (followed by index)]
-    fit_function_initial = []  # Format is [ScanNumber, {0:x (followed by
-    #                  index), 1:y (followed by index)]
-    fit_avg = []  # Format is [{0:x (followed by index), 1:y
-    #                  (followed by index)]
+    fit_function = np.zeros((0, 0))  # Format is [ScanNumber, position-index]
+    fit_avg = np.zeros(0)  # Format is [position-index]
     read_fit = ""  # Format is whatever seems good for reading the function
-    slope_deviation = []  # Format is [ScanNumber]
-    height_deviation = []  # Format is [ScanNumber]
     filter_rigor = 0.0000000001  # Format is positive real number
     filtered_list = list(range(99))  # Format is [index]
     radius = 0  # Format is just a number
+    polish_circle = False  # Format is bool, refines FitCircle if True
     offset = [0, 0]  # Format is [x-offset, y-offset]
-
+    integration_rule = "left"  # Format is one of integration_rules
+    dataset = None  # Format is Medium.MdaDataset, or None if not from the LTP
+    slope_detector = "ltp:ElcomatAM1:Yavg.VAL"  # Format is PV name, or part
+    resample_method = None  # Format is one of resample_methods, or None
+    resample_grid = None  # Format is [position-index], or None for the
+    #                       average x-positions of the scans
+    registration = {}  # Format is {index: [average, RMS, largest]} of the
+    #                    x-positions of the scan less the average ones, in mm
+    __resampling = None  # Format is [x, grid, ResampleWeights(x, grid)]
+
+    history_budget = 512 * 2**20  # Format is bytes of old data undo may keep
+    __history = None  # History of states for Undo, Redo and the start point
+    recompute_counts = {}  # Format is {product: times it was worked out}
+    __products = {}  # Format is {product: [inputs, version, value]}
+    __filter_rank = None  # The ranking filtered_list last came from, if any
+    __filter_count = 0  # How many scans of __filter_rank passed
     __current_value = -1  # This is just to account for the way python does scope
     __use_fit_avg = False  # This toggles if the subtracted fit is average or
     #                        run-by-run fitting
-
-    # Initializing the object by grabbing the files and reading out slopes. It
-    # requires filename to be a format string to which it adds a 2 digit number
-    def __init__(self, filename=default_file, num_scans=scan_list):
+    __last_fit = None  # Format is [method, argument] of the last fit of every
+    #                    scan, or None for a fit made elsewhere
+    __buffers = {}  # Format is {data name: ScanBuffer} for AddScan
+
+    # The products derived from the data, and what each is derived from. Data
+    # arrays are never changed in place (see History), so the arrays
+    # themselves serve as the version of the data. Products carry a version
+    # counter, bumped each time they are worked out, for those depending on
+    # them. A product is only worked out again when read after an input of
+    # it changed.
+    __graph = {"residue": ["slopes", "heights", "fit_function", "fit_avg",
+                           "fit_data_type", "use_fit_avg"],
+               "stats": ["slopes", "heights"],
+               "residue_stats": ["residue"],
+               "deviation": ["slopes", "heights", "stats"]}
+
+    # The derived products themselves, as read-only attributes
+    residue = property(lambda self: self.__Derive("residue"))  # Format is
+    #                   [ScanNumber, position-index] since I use the term a
+    #                   lot, I'll clarify again, residue = data minus fit
+    slope_avg = property(lambda self: self.__Derive("stats")[1][0])  # Format
+    #                    is [position-index]
+    height_avg = property(lambda self: self.__Derive("stats")[1][1])  # Format
+    #                     is [position-index]
+    slope_sigmas = property(lambda self: self.__Derive("stats")[2][0])  # As
+    #                       slope_avg
+    height_sigmas = property(lambda self: self.__Derive("stats")[2][1])  # As
+    #                        height_avg
+    slope_results = property(lambda self: self.__Derive("stats")[3][0])  #
+    #                   Format is [{0:average, 1:RMS, 2:p-v}]
+    height_results = property(lambda self: self.__Derive("stats")[3][1])  #
+    #                   Format is [{0:average, 1:RMS, 2:p-v}]
+    residue_avg = property(lambda self: self.__Derive("residue_stats")[1])  #
+    #                   Format is [position-index]
+    residue_sigmas = property(lambda self:
+                              self.__Derive("residue_stats")[2])  # Format
+    #                   is [position-index]
+    residue_results = property(lambda self:
+                               self.__Derive("residue_stats")[3])  # Format
+    #                   is [{0:average, 1:RMS, 2:p-v}]
+    height_deviation = property(lambda self: self.__Derive("deviation")[0])
+    #                   Format is [ScanNumber]
+    slope_deviation = property(lambda self: self.__Derive("deviation")[1])
+    #                   Format is [ScanNumber]
+
+    # Initializing the object by grabbing the files and reading out slopes.
+    # filename can be any one scan file of the run, the others are found
+    # alongside it (see Medium.FindScanFiles).
+    def __init__(self, filename=default_file, num_scans=__current_value):
+        self.recompute_counts = {}
+        self.__products = {}
+        self.__buffers = {}
+        self.registration = {}
         if filename == []:
             return
         self.Load(filename, num_scans)
 
     # The name is a relic of older, more compact versions of this software.
     # This method really just integrates the slope to get height data, and sets
-    # up basic stats by the Reset() method
-    def AcquireAnalysisVariables(self):
-        self.SetUndo()
-        self.__heights = []
-        __slope_avg_by_scan = [0 for scan in self.__slopes]
+    # up basic stats by the Reset() method. undo=False leaves recording the
+    # change to the caller, for those that changed the slopes first.
+    def AcquireAnalysisVariables(self, undo=True):
+        if undo:
+            self.SetUndo()
+        positions = self.__slopes.shape[1]
 
         # First we need to get the integrated data. This works best if we first
-        # remove the average of the slope data, so:
-        for scan in enumerate(self.__slopes):
-            for y_slope in enumerate(scan[1][1]):
-                x_range = len(self.__slopes[scan[0]][0])
-                __slope_avg_by_scan[scan[0]] += y_slope[1] / x_range
-
-        # This loop will find the height data by integrating slope data after
-        # subtracting the average slope
-        for scan in enumerate(self.__slopes):
-            average = __slope_avg_by_scan[scan[0]]
-            integration = 0.0
-            riemann_width = 0.0
-            integrated_scan = []
-            for y_slope in enumerate(np.delete(scan[1][1], len(scan[1][1])-1)):
-                riemann_width = (scan[1][0][y_slope[0]+1] -
-                                 scan[1][0][y_slope[0]])
-                integration += ((y_slope[1]-average)*riemann_width)
-                integrated_scan.append(integration)
-            # To match up the x-coordinates, we now add a right-handed riemann
-            # square to fill out the last coordinate
-            temp = len(scan[1][1])-1
-            integration += (scan[1][1][temp]-average)*riemann_width
-            integrated_scan.append(integration)
-            self.__heights.append([list(scan[1][0]), integrated_scan])
+        # remove the average of the slope data. The running sum keeps the same
+        # order of additions as summing point by point would.
+        average = np.cumsum(self.__slopes / positions, axis=1)[:, -1:]
+
+        # Now the height data, by integrating the slope data after subtracting
+        # the average slope, all scans at once with the chosen rule.
+        self.__heights = Integrate(self.__scan_x, self.__slopes - average,
+                                   self.integration_rule)
 
         # Now for the some averages and RMS's for height and slope. In
         # previous versions of this code, these integrated together for speed
@@ -226,35 +300,13 @@ class Raven:
         # problems, and doesn't save all that much time.
         self.Reset()
 
-    # Counterpart to AcquireAnalysisVariables. It differentiates heights by
-    # taking the height at two adjacent points, and dividing the difference
-    # by the difference in position. It is left hand focused, so each point is
-    # the slope to the one on the right, except the final point, which is
-    # identical to the penultimate one.
+    # Counterpart to AcquireAnalysisVariables. It differentiates heights for
+    # all scans at once, using the rule in integration_rule. See Differentiate
+    # below for how each rule treats the ends of the scan.
     def AcquireSlopes(self):
         self.SetUndo()
-        self.__slopes = []
-
-        # This loop will find the slope data by differentiating slope data
-        for scan in enumerate(self.__heights):
-            riemann_width = 0.0
-            differentiated_scan = []
-            print(scan[1][1][0], scan[1][0][1]-scan[1][0][0])
-            derivative = scan[1][1][0] / (scan[1][0][1] - scan[1][0][0])
-            differentiated_scan.append(derivative)
-            for index in range(len(scan[1][1]) - 2):
-                riemann_width = (scan[1][0][index+2] -
-                                 scan[1][0][index+1])
-                derivative = ((scan[1][1][index+1] - scan[1][1][index])
-                              / riemann_width)
-                differentiated_scan.append(derivative)
-
-            # To match up the x-coordinates, we now add a right-handed slope
-            # to fill out the last coordinate
-            temp = len(scan[1][1])-1
-            derivative = (scan[1][1][temp]-scan[1][1][temp-1])/riemann_width
-            differentiated_scan.append(derivative)
-            self.__slopes.append([list(scan[1][0]), differentiated_scan])
+        self.__slopes = Differentiate(self.__scan_x, self.__heights,
+                                      self.integration_rule)
 
         # Now for the some averages and RMS's for height and slope. In
         # previous versions of this code, these integrated together for speed
@@ -263,208 +315,374 @@ class Raven:
         self.Reset()
 
     # Recalculating all of the averages, RMS's, and the stats for average run.
+    # This happens by itself whenever they are read after a change, so this
+    # only makes sure they are current now.
     def UpdateStats(self):
-        self.__FindHeightAverageOverScans()
-        self.__FindHeightRMSOverScans()
-        self.__FindSlopeAverageOverScans()
-        self.__FindSlopeRMSOverScans()
-        self.AnalyzeAverages()
+        self.__Derive("stats")
+        self.__Derive("residue_stats")
 
     # Resets the list of runs passing the filter to be all runs
     def ResetFilter(self):
         self.filtered_list = list(range(len(self.__slopes)))
+        self.__filter_rank = None
 
     # Sets the data to just those passed the filter, by only keeping runs with
     # indices in filtered_list
     def ApproveFilter(self):
         self.SetUndo()
         self.scan_list = [self.scan_list[i] for i in self.filtered_list]
-        self.__slopes = [self.__slopes[i] for i in self.filtered_list]
-        self.__heights = [self.__heights[i] for i in self.filtered_list]
+        self.__scan_x = self.__scan_x[self.filtered_list]
+        self.__slopes = self.__slopes[self.filtered_list]
+        self.__heights = self.__heights[self.filtered_list]
+        self.fit_function = self.fit_function[self.filtered_list]
+        self.Reset()
+
+    # Adds one scan of slopes, at x-positions x (the shared ones by default),
+    # as the last scan of the data, with index in scan_list (one past the
+    # highest there by default). Only the new scan is integrated and, with
+    # the method of the last FitCircle or FitPolynomial, fit; the averages,
+    # sigmas and results follow by a Welford step of RunningStats rather than
+    # going over every scan again. The deviations of all scans move with the
+    # average, so those are still worked out again when next filtering.
+    # undo=False leaves recording the change to the caller, so a batch of
+    # scans can be undone as one without recording (and trimming the
+    # history) for every scan.
+    def AddScan(self, slopes, x=None, index=__current_value, undo=True):
+        slopes = np.asarray(slopes, dtype=float)
+        if x is None:
+            x = self.__x
+        x = np.asarray(x, dtype=float)
+        if index == -1:
+            index = max(self.scan_list + [-1]) + 1 if len(self.__slopes) else 0
+        # A first scan is as good as loading one, as for a run still being
+        # measured (see OMEN's live mode)
+        if len(self.__slopes) == 0:
+            self.__SetData(x, [slopes])
+            self.fit_function = self.__slopes
+            self.fit_avg = self.__slopes[0]
+            self.scan_list = [index]
+            self.AcquireAnalysisVariables(False)
+            self.__history = History(self.history_budget)
+            self.SetStartPoint()
+            return
+        if slopes.shape != self.__x.shape:
+            raise ValueError("A scan needs " + str(len(self.__x)) +
+                             " slopes to be added, not " + str(len(slopes)))
+        if x.shape != self.__x.shape:
+            raise ValueError("A scan needs " + str(len(self.__x)) +
+                             " positions to be added, not " + str(len(x)))
+        stats = self.__Derive("stats")[0]
+        residue_stats = self.__Derive("residue_stats")[0]
+        residue = self.residue
+        if undo:
+            self.SetUndo()
+
+        # The same steps AcquireAnalysisVariables and the fit take, for one
+        average = np.cumsum(slopes / len(slopes))[-1]
+        heights = Integrate(x, slopes - average, self.integration_rule)
+        data = slopes if self.fit_data_type == 0 else heights
+        fit = self.__FitScan(x, data)
+        residue_row = data - (self.fit_avg if self.__use_fit_avg else fit)
+
+        self.__scan_x = self.__Append("scan_x", self.__scan_x, x)
+        self.__slopes = self.__Append("slopes", self.__slopes, slopes)
+        self.__heights = self.__Append("heights", self.__heights, heights)
+        self.fit_function = self.__Append("fit_function", self.fit_function,
+                                          fit)
+        self.scan_list = self.scan_list + [index]
+        stats = stats.Copy()
+        stats.AddScan(np.array([slopes, heights]))
+        residue_stats = residue_stats.Copy()
+        residue_stats.AddScan(residue_row)
+        self.__Update("stats", self.__StatsProduct(stats))
+        self.__Update("residue", self.__Append("residue", residue,
+                                               residue_row))
+        self.__Update("residue_stats", self.__StatsProduct(residue_stats))
         self.Reset()
 
-    # A useful method to recalculate everything after you make a change.
-    # Specifically, this does the residue, RMS/avg of runs, stats of avg run,
-    # and the deviations of each run's slope and height.
+    # Adds a scan as read from scan file number (see Medium.ReadMdaCached and
+    # Medium.ScanWatcher) with AddScan, its slopes from the column of
+    # slope_detector. It isn't added to dataset, which is let go, so changing
+    # detector needs the run loaded again. undo is as for AddScan.
+    def AddRawScan(self, number, read, undo=True):
+        dataset = Medium.MdaDataset([read], [], [number])
+        column = dataset.Column(self.slope_detector)
+        if column is None:
+            column = 4  # Where the LTP has put the slopes so far
+        x, slopes = dataset.Scans(1), dataset.Scans(column)
+        if len(self.__slopes) > 0:
+            x, slopes = self.__Register(x, slopes, [number - 1], self.__x)
+        self.AddScan(slopes[0], x[0], number - 1, undo)
+        self.dataset = None
+
+    # Takes the scan at position index of the data out again. As with
+    # AddScan, its part in the averages, sigmas and results is undone
+    # without going over the other scans.
+    def RemoveScan(self, index):
+        count = len(self.__slopes)
+        stats = self.__Derive("stats")[0].Copy()
+        residue_stats = self.__Derive("residue_stats")[0].Copy()
+        residue = self.residue
+        stats.RemoveScan(np.array([self.__slopes[index],
+                                   self.__heights[index]]))
+        residue_stats.RemoveScan(residue[index])
+        self.SetUndo()
+
+        # The last scan leaves by a view of the others, any other by copying
+        if index in (-1, count - 1):
+            keep = slice(0, count - 1)
+        else:
+            keep = np.delete(np.arange(count), index)
+        self.__scan_x = self.__scan_x[keep]
+        self.__slopes = self.__slopes[keep]
+        self.__heights = self.__heights[keep]
+        self.fit_function = self.fit_function[keep]
+        self.scan_list = list(self.scan_list)
+        del self.scan_list[index]
+        # With no scans left, the products are best worked out from nothing
+        if count > 1:
+            self.__Update("stats", self.__StatsProduct(stats))
+            self.__Update("residue", residue[keep])
+            self.__Update("residue_stats", self.__StatsProduct(residue_stats))
+        self.Reset()
+
+    # Fits one scan as the last FitCircle or FitPolynomial fit every scan.
+    # After a fit made elsewhere (see SetFit) the fit to the average stands
+    # in, as it does there.
+    def __FitScan(self, x, data):
+        if self.__last_fit is None:
+            return self.fit_avg
+        method, argument = self.__last_fit
+        if method == "polynomial":
+            Q = PolynomialBasis(self.__x, argument)[0][:, :argument+1]
+            return np.dot(Q, np.dot(data, Q))
+        if self.fit_data_type == 1:
+            fitter, polisher, model = (FitHeightCircles, PolishHeightCircle,
+                                       HeightCircle)
+        else:
+            fitter, polisher, model = (FitSlopeCircles, PolishSlopeCircle,
+                                       SlopeCircle)
+        fit = fitter(x, data)
+        if argument:
+            fit = polisher(x, data, fit)
+        return model(x, *fit)
+
+    # Adds a row to one of the data arrays for AddScan through its ScanBuffer
+    def __Append(self, name, scans, scan):
+        if name not in self.__buffers:
+            self.__buffers[name] = ScanBuffer()
+        return self.__buffers[name].Append(scans, scan)
+
+    # Sets a product to a value worked out from the current data by other
+    # means than its finder, as AddScan and RemoveScan do. It counts as
+    # another version, but not as a recompute.
+    def __Update(self, product, value):
+        inputs = [self.__Input(name) for name in self.__graph[product]]
+        self.__products[product] = [inputs, self.__products[product][1] + 1,
+                                    value]
+
+    # A useful method to call after you make a change. The residue, RMS/avg
+    # of runs, stats of avg run, and the deviations of each run's slope and
+    # height all follow the data by themselves, so this just resets the filter
     def Reset(self):
-        self.UpdateResidue()
-        self.UpdateStats()
         self.ResetFilter()
-        self.PrepFilter()
 
-    # This method saves an old version of the data from before the last action
+    # This method saves the data from before an action onto the undo history.
+    # Nothing is copied: every action replaces arrays instead of changing them,
+    # so the history just holds on to the (now read-only) arrays it replaced.
     def SetUndo(self):
-        self.__slopes_last = copy.deepcopy(self.__slopes)
-        self.__heights_last = copy.deepcopy(self.__heights)
-        self.fit_function_last = copy.deepcopy(self.fit_function)
-        self.scan_list_last = copy.deepcopy(self.scan_list)
+        self.__history.Record(self.__GetState())
 
-    # Enacting the undo
+    # Enacting the undo, returns False if there was nothing left to undo
     def Undo(self):
-        self.__slopes = self.__slopes_last
-        self.__heights = self.__heights_last
-        self.fit_function = copy.deepcopy(self.fit_function_last)
-        self.scan_list = self.scan_list_last
+        state = self.__history.Undo(self.__GetState())
+        if state is None:
+            return False
+        self.__SetState(state)
         self.Reset()
-        self.SetUndo()
+        return True
+
+    # Re-doing the last action undone, returns False if there was none
+    def Redo(self):
+        state = self.__history.Redo(self.__GetState())
+        if state is None:
+            return False
+        self.__SetState(state)
+        self.Reset()
+        return True
 
     # Setting a long-term reference point
     def SetStartPoint(self):
-        self.__slopes_initial = copy.deepcopy(self.__slopes)
-        self.__heights_initial = copy.deepcopy(self.__heights)
-        self.fit_function_initial = copy.deepcopy(self.fit_function)
-        self.scan_list_initial = copy.deepcopy(self.scan_list)
+        self.__history.Pin(self.__GetState())
+        self.scan_list_initial = list(self.scan_list)
 
-    # Using the long-term reference point
+    # Using the long-term reference point. This can itself be undone.
     def ReturnToStartPoint(self):
-        self.__slopes = self.__slopes_initial
-        self.__heights = self.__heights_initial
-        self.fit_function = copy.deepcopy(self.fit_function_initial)
-        self.scan_list = self.scan_list_initial
+        self.SetUndo()
+        self.__SetState(self.__history.pinned)
         self.Reset()
-        self.SetStartPoint()
+
+    # Sets how many bytes of old data the undo history may hold on to
+    def SetHistoryBudget(self, budget):
+        self.history_budget = budget
+        self.__history.budget = budget
+        self.__history.Trim(self.__GetState())
+
+    # The data an action can change, as kept by the undo history
+    def __GetState(self):
+        return {"x": self.__x, "scan_x": self.__scan_x,
+                "slopes": self.__slopes, "heights": self.__heights,
+                "fit_function": self.fit_function, "fit_avg": self.fit_avg,
+                "scan_list": self.scan_list}
+
+    # Puts back data from __GetState
+    def __SetState(self, state):
+        self.__x = state["x"]
+        self.__scan_x = state["scan_x"]
+        self.__slopes = state["slopes"]
+        self.__heights = state["heights"]
+        self.fit_function = state["fit_function"]
+        self.fit_avg = state["fit_avg"]
+        self.scan_list = list(state["scan_list"])
 
     # Method to set an offset to apply to all outputs from this class
     def SetOffset(self, xoffset=0, yoffset=0):
         self.offset = [xoffset, yoffset]
 
-    # Method to define a region of interest, and cut off outside data
+    # Method to define a region of interest, and cut off outside data. The
+    # region is found on the shared x-positions (see __ROI), and the same
+    # columns are then kept in every array, products included: the residue,
+    # and the averages and sigmas at each point, are the same for the points
+    # kept, so only the results of the averages and the deviations have to
+    # be worked out again.
     def SetROI(self, region):
         self.SetUndo()
-        if self.__slopes == []:
+        if self.__slopes.size == 0:
             return
-        if self.__slopes[0] == []:
+        keep = self.__ROI(region)
+        if keep is None:
             return
-        indices_to_remove = []
-        for index in range(len(self.__slopes[0][0])):
-            if self.__slopes[0][0][index] < region[0]:
-                indices_to_remove.append(index)
-            if self.__slopes[0][0][index] > region[1]:
-                indices_to_remove.append(index)
-        for scan in self.__slopes:
-            for i in reversed(indices_to_remove):
-                del scan[0][i]
-                del scan[1][i]
-        temp = indices_to_remove.pop()
-        if temp != len(self.__heights[0][0]):
-            indices_to_remove.append(temp)
-        for scan in self.__heights:
-            for i in reversed(indices_to_remove):
-                del scan[0][i]
-                del scan[1][i]
+        stats, residue, residue_stats = [self.__Current(product) for product
+                                         in ("stats", "residue",
+                                             "residue_stats")]
+        self.__x = self.__x[keep]
+        self.__scan_x = self.__scan_x[:, keep]
+        self.__slopes = self.__slopes[:, keep]
+        self.__heights = self.__heights[:, keep]
+        self.fit_function = self.fit_function[:, keep]
+        self.fit_avg = self.fit_avg[keep]
+        if stats is not None:
+            self.__Update("stats", self.__StatsProduct(stats[0].Select(keep)))
+        if residue is not None:
+            self.__Update("residue", residue[:, keep])
+            if residue_stats is not None:
+                self.__Update("residue_stats", self.__StatsProduct(
+                    residue_stats[0].Select(keep)))
         self.Reset()
 
-    # Method to set some x-value as zero and shift x accordingly
+    # The results of the averages (as slope_results, height_results and
+    # residue_results) of just the points SetROI(region) would keep, found
+    # from the averages as they are, so quick enough to follow a cursor.
+    # Format is [slope_results, height_results, residue_results], or None
+    # if no points are in region
+    def GetROIResults(self, region):
+        keep = self.__ROI(region)
+        if keep is None:
+            return None
+        slope_results, height_results = (
+            self.__Derive("stats")[0].Select(keep).GetResults())
+        return [slope_results, height_results,
+                self.__Derive("residue_stats")[0].Select(keep).GetResults()]
+
+    # The points of the shared x-positions within region. When they are in
+    # order, as they nearly always are, the points are found by bisection
+    # and given as a slice, so the data is cut down to views of itself,
+    # otherwise as a mask. None if no points are in region
+    def __ROI(self, region):
+        x = self.__x
+        if np.all(x[1:] >= x[:-1]):
+            start = np.searchsorted(x, region[0], "left")
+            end = np.searchsorted(x, region[1], "right")
+            if start >= end:
+                return None
+            return slice(start, end)
+        keep = (x >= region[0]) & (x <= region[1])
+        if not keep.any():
+            return None
+        return keep
+
+    # Method to set some x-value as zero and shift x accordingly. When all
+    # scans share the x-positions (see RepeatRows), only those are shifted.
     def ZeroX(self, zero=0):
         self.SetUndo()
-        if self.__slopes == []:
-            return
-        if self.__slopes[0] == []:
+        if self.__slopes.size == 0:
             return
         if zero == 0:
-            temp = self.__slopes[0][0]
-            zero = (temp[len(temp)-1]-temp[0])/2
-        thingstozero = [self.__slopes, self.__heights,
-                        self.fit_function, self.fit_avg]
-        for data in thingstozero:
-            for ScanNumber in range(len(data)):
-                try:
-                    for position in range(len(list(data[ScanNumber][0]))):
-                        data[ScanNumber][0][position] -= zero
-                except TypeError:
-                    if ScanNumber == 0:
-                        for position in range(len(list(data[0]))):
-                            data[0][position] -= zero
+            zero = (self.__x[-1]-self.__x[0])/2
+        self.__x = self.__x - zero
+        if self.__scan_x.strides[0] == 0:
+            self.__scan_x = RepeatRows(self.__x, len(self.__scan_x))
+        else:
+            self.__scan_x = self.__scan_x - zero
         self.Reset()
 
     # Fits circles to data and the average of the data
     # data_type=1 means fit to height, data_type=0 means fit to slope
-    # Currently it fits by two iterations, but the fitter is not very good.
-    # It tends to fall fairly easily into local minima, or rail to large radius
-    # Could be fixed by hardcoding initial guesses based on three widely spaced
-    # points in data_avg
-    def FitCircle(self, data_type=__current_value):
+    # Heights get the algebraic circle fit and slopes a straight line (the
+    # slope of a circle being nearly linear), both solved directly for all
+    # scans at once, see FitHeightCircles and FitSlopeCircles below. If polish
+    # is True (default polish_circle), each fit is then refined by
+    # Levenberg-Marquardt, starting from the direct solution. The radius is
+    # signed, positive for a concave (valley shaped) mirror.
+    def FitCircle(self, data_type=__current_value, polish=__current_value):
         if data_type == -1:
             data_type = self.fit_data_type
         else:
             self.fit_data_type = data_type
+        if polish == -1:
+            polish = self.polish_circle
         data = []
         data_avg = []
         if data_type == 1:
             data = self.__heights
             data_avg = self.height_avg
-            data_results = self.height_results
+            fitter, polisher, model = (FitHeightCircles, PolishHeightCircle,
+                                       HeightCircle)
         if data_type == 0:
             data = self.__slopes
             data_avg = self.slope_avg
-            data_results = self.slope_results
-        self.fit_function = []
-        self.read_fit = ""
+            fitter, polisher, model = (FitSlopeCircles, PolishSlopeCircle,
+                                       SlopeCircle)
+
+        fits = fitter(self.__scan_x, data)
+        fit = fitter(self.__x, data_avg)
+        if polish:
+            fits = np.array([polisher(x, scan, guess) for x, scan, guess in
+                             zip(self.__scan_x, data, fits)])
+            fit = polisher(self.__x, data_avg, fit)
+        self.fit_function = model(self.__scan_x, *fits.T[:, :, np.newaxis])
+        self.fit_avg = model(self.__x, *fit)
 
-        for scan in data:
-            fit = []
-            x0 = scan[0][int(len(scan[0])/2)]
-            y0 = 50/(data_results[2])
-            if y0 > 100000:
-                y0 = 100000
-                
-            R = y0
-            while True:
-              try:
-                fit1 = chisquarefit.curve_fit(self.__circle, scan[0],
-                                              scan[1], [x0, y0, R])
-                fit2 = chisquarefit.curve_fit(self.__negcircle, scan[0],
-                                              scan[1], [x0, y0, R])
-
-                chiR1 = np.sqrt(abs(np.diag(fit1[1])))[1]
-                chiR2 = np.sqrt(abs(np.diag(fit2[1])))[1]
-                if chiR1 <= chiR2:
-                    fit = [chisquarefit.curve_fit(self.__circle, data[0][0],
-                                                  data_avg, fit1[0]), fit2, 0]
-                if chiR2 < chiR1:
-                    fit = [chisquarefit.curve_fit(self.__negcircle, data[0][0],
-                                                  data_avg, fit2[0]), fit1, 1]
-
-                if min(chiR1, chiR2) > 1000000000:
-                    raise RuntimeError("Fit had a problem")
-
-                fit_y = [pow(-1, fit[2])*self.__circle(x, fit[0][0][0],
-                                                       fit[0][0][1], fit[0][0][2])
-                         for x in scan[0]]
-                self.fit_function.append([copy.deepcopy(scan[0]), fit_y])
-                break
-              except RuntimeError:
-                y0 *= 10
-
-        x0 = scan[0][int(len(data[0][0])/2)]
-        y0 = abs(y0)
-        R = y0
-        fit = []
-        fit1 = chisquarefit.curve_fit(self.__circle, data[0][0],
-                                      data_avg, [x0, y0, R])
-        fit2 = chisquarefit.curve_fit(self.__negcircle, data[0][0],
-                                      data_avg, [x0, y0, R])
-        chiR1 = np.sqrt(abs(np.diag(fit1[1])))[1]
-        chiR2 = np.sqrt(abs(np.diag(fit2[1])))[1]
-        if chiR1 <= chiR2:
-            fit = [chisquarefit.curve_fit(self.__circle, data[0][0],
-                                          data_avg, fit1[0]), fit2, 0]
-        if chiR2 < chiR1:
-            fit = [chisquarefit.curve_fit(self.__negcircle, data[0][0],
-                                          data_avg, fit2[0]), fit1, 1]
-        sign = pow(-1, fit[2])
-        fit_y = [sign*self.__circle(x, fit[0][0][0], fit[0][0][1],
-                                    fit[0][0][2]) for x in data[0][0]]
-        self.fit_avg = [copy.deepcopy(data[0][0]), fit_y]
-        self.read_fit = "sqrt({0:.6g}^2 - (x-{1:.6g})^2) - {2:.6g}"
-        self.read_fit = self.read_fit.format(fit[0][0][2], fit[0][0][0],
-                                             fit[0][0][1])
-        self.radius = fit[0][0][2]
-        self.UpdateResidue()
+        if data_type == 1:
+            x0, y0, R, sign = fit
+            self.read_fit = "sqrt({0:.6g}^2 - (x-{1:.6g})^2) - {2:.6g}"
+            self.radius = sign * R
+        else:
+            # A line a*x + b in microradians against mm is a circle of radius
+            # 1/a km, centered at -b/a mm
+            a, b = fit
+            with np.errstate(divide="ignore", invalid="ignore"):
+                R, x0, y0 = 1 / a, -b / a, 0
+            self.read_fit = "(x-{1:.6g})/{0:.6g}"
+            self.radius = R
+        self.read_fit = self.read_fit.format(R, x0, y0)
+        self.__last_fit = ["circle", polish]
         return self.read_fit
 
     # Fits given degree polynomials to data and average of the data,
     # data_type=1 means fit to height, data_type=0 means fit to slope
+    # Every scan is fit on the shared x-positions, so one factorization of the
+    # polynomial basis (see PolynomialBasis) fits them all in one go.
     def FitPolynomial(self, degree=0, data_type=__current_value):
         if data_type == -1:
             data_type = self.fit_data_type
@@ -480,55 +698,152 @@ class Raven:
             data_avg = self.slope_avg
         self.read_fit = ""
 
-        self.fit_function = []
-        for i, scan in enumerate(data):
-            self.fit_function.append([copy.deepcopy(scan[0]), []])
-            fit = np.poly1d(np.polyfit(scan[0], scan[1], degree))
-            for datum in scan[0]:
-                self.fit_function[i][1].append(fit(datum))
-
-        self.fit_avg = [copy.deepcopy(data[0][0]), []]
-        coefs = np.polyfit(data[0][0], data_avg, degree)
-        fit = np.poly1d(coefs)
-        self.fit_avg[1] = [fit(x) for x in data[0][0]]
-        coefs = list(coefs)
+        Q, R, mid, scale = PolynomialBasis(self.__x, degree)
+        Q = Q[:, :degree+1]
+        self.fit_function = np.dot(np.dot(data, Q), Q.T)
+        projection = np.dot(data_avg, Q)
+        self.fit_avg = np.dot(Q, projection)
+
+        # The coefficients come out for (x-mid)/scale, so they are converted
+        # back to plain powers of x for printing, highest power first
+        coefs = np.linalg.solve(R[:degree+1, :degree+1], projection)
+        coefs = np.polynomial.Polynomial(coefs, domain=[mid - scale,
+                                                        mid + scale])
+        coefs = list(coefs.convert().coef[::-1])
+        coefs = [0.] * (degree + 1 - len(coefs)) + coefs
         constant = coefs.pop(degree)
         for i, coef in enumerate(coefs):
             self.read_fit += "{0:.6g}x^{1:d} + ".format(coef, degree-i)
         self.read_fit += "{0:.6g}".format(constant)
         if degree == 2:
             self.radius = 1 / (2 * coefs[0])
-        self.UpdateResidue()
+        self.__last_fit = ["polynomial", degree]
         return self.read_fit
 
+    # Finds what the residue RMS (as in residue_results) would be for each
+    # polynomial fit up to max_degree, without fitting any of them. The bases
+    # of lower degrees are the first columns of the highest's, so a single
+    # factorization covers them all. Format is [RMS for degree 0, 1, ...]
+    def GetPolynomialRMS(self, data_type=__current_value, max_degree=5):
+        if data_type == -1:
+            data_type = self.fit_data_type
+        data_avg = self.slope_avg
+        if data_type == 1:
+            data_avg = self.height_avg
+        max_degree = min(max_degree, len(self.__x) - 1)
+        Q = PolynomialBasis(self.__x, max_degree)[0]
+        projection = np.dot(data_avg, Q)
+        rms = []
+        for degree in range(max_degree + 1):
+            residue = data_avg - np.dot(Q[:, :degree+1],
+                                        projection[:degree+1])
+            rms.append(float(np.sqrt(np.mean((residue -
+                                               np.mean(residue))**2))))
+        return rms
+
+    # Chooses the rule AAV and AcquireSlopes use, from integration_rules
+    def SetIntegrationRule(self, rule):
+        if rule not in integration_rules:
+            raise ValueError("Unknown integration rule: " + str(rule))
+        self.integration_rule = rule
+
     def UseFitAverage(self, use_fit_avg="toggle"):
         if use_fit_avg == "toggle":
             self.__use_fit_avg = not self.__use_fit_avg
         else:
             self.__use_fit_avg = use_fit_avg
 
-    # Method to remove subtract the fit and save the residue in residue
+    # Replaces the fit with one made elsewhere (like another mirror's trace),
+    # given along the shared x-positions. Without fits for each scan, every
+    # scan is given the fit to the average.
+    def SetFit(self, fit_avg, fit_function=None):
+        self.fit_avg = np.array(fit_avg, dtype=float)
+        if fit_function is None:
+            fit_function = np.tile(self.fit_avg, (len(self.__slopes), 1))
+        self.fit_function = np.array(fit_function, dtype=float)
+        self.__last_fit = None
+
+    # Method to remove subtract the fit and save the residue in residue. Like
+    # UpdateStats, this only makes sure residue is current now.
     def UpdateResidue(self):
+        self.__Derive("residue")
+
+    # Works out the residue product, the data minus the fit
+    def __FindResidue(self):
         data = []
         if self.fit_data_type == 1:
             data = self.__heights
         if self.fit_data_type == 0:
             data = self.__slopes
-        self.residue = copy.deepcopy(data)
-        for scan in range(len(data)):
-            for pos in range(len(data[scan][1])):
-                if self.__use_fit_avg:
-                    fit = self.fit_avg[1]
-                else:
-                    fit = self.fit_function[scan][1]
-                self.residue[scan][1][pos] -= fit[pos]
-        self.__FindResidueAverageOverScans()
-        self.__FindResidueRMSOverScans()
-        self.residue_results = self.__FindResults(self.residue_avg)
+        if self.__use_fit_avg:
+            return data - self.fit_avg
+        return data - self.fit_function
+
+    # Works out the stats product for slopes and heights together, so each
+    # point is only visited once. Format is [RunningStats, averages, sigmas,
+    # results], each but the first as [{0:slope, 1:height}]
+    def __FindStats(self):
+        return self.__StatsProduct(RunningStats(np.swapaxes(
+            np.array([self.__slopes, self.__heights]), 0, 1)))
+
+    # Works out the residue_stats product, as __FindStats for the residue
+    def __FindResidueStats(self):
+        return self.__StatsProduct(RunningStats(self.residue))
+
+    # The stats products in full from their RunningStats
+    def __StatsProduct(self, stats):
+        return [stats, stats.mean, stats.GetSigmas(), stats.GetResults()]
+
+    # Gets a product, working it out again only if one of its inputs changed
+    # since it last was. Each time it is worked out is added to
+    # recompute_counts.
+    def __Derive(self, product):
+        value = self.__Current(product)
+        if value is not None:
+            return value
+        old = self.__products.get(product)
+        inputs = [self.__Input(name) for name in self.__graph[product]]
+        finders = {"residue": self.__FindResidue,
+                   "stats": self.__FindStats,
+                   "residue_stats": self.__FindResidueStats,
+                   "deviation": self.__FindDeviations}
+        version = 0 if old is None else old[1] + 1
+        self.__products[product] = [inputs, version, finders[product]()]
+        self.recompute_counts[product] = (
+            self.recompute_counts.get(product, 0) + 1)
+        return self.__products[product][2]
+
+    # A product as it was last worked out, if none of its inputs changed
+    # since, or None. Nothing is worked out here.
+    def __Current(self, product):
+        old = self.__products.get(product)
+        if old is None:
+            return None
+        for name, last in zip(self.__graph[product], old[0]):
+            if name in self.__graph:
+                if (self.__Current(name) is None or
+                        self.__products[name][1] != last):
+                    return None
+                continue
+            new = self.__Input(name)
+            if not (new is last or (not isinstance(new, np.ndarray) and
+                                    new == last)):
+                return None
+        return old[2]
+
+    # The current version of an input to a product. Data is its own version,
+    # while products give their version counter.
+    def __Input(self, name):
+        if name in self.__graph:
+            self.__Derive(name)
+            return self.__products[name][1]
+        return {"slopes": self.__slopes, "heights": self.__heights,
+                "fit_function": self.fit_function, "fit_avg": self.fit_avg,
+                "fit_data_type": self.fit_data_type,
+                "use_fit_avg": self.__use_fit_avg}[name]
 
     # Once you like your fit, this subtracts it from the data
     def SubtractFit(self):
-        self.UpdateResidue()
         self.SetUndo()
         if self.fit_data_type == 1:
             self.__heights = self.residue
@@ -538,75 +853,6 @@ class Raven:
             self.FilterSlopes()
         self.Reset()
 
-    # Finds the RMS of the slope over all scans at a given position
-    def __FindSlopeRMSOverScans(self):
-        self.slope_sigmas = np.array(range(len(self.__slopes[0][0])))*0.
-        for scan in self.__slopes:
-            for y_slope in enumerate(scan[1]):
-                temp = (y_slope[1]-self.slope_avg[y_slope[0]])**2
-                self.slope_sigmas[y_slope[0]] += temp/len(self.__slopes)
-        self.slope_sigmas = list(np.sqrt(self.slope_sigmas))
-
-    # Finds the RMS of the height over all scans at a given position
-    def __FindHeightRMSOverScans(self):
-        temp = len(self.__heights[0][1])
-        self.height_sigmas = np.array(range(temp))*0.
-        for scan in self.__heights:
-            for y_slope in enumerate(scan[1]):
-                temp = (y_slope[1]-self.height_avg[y_slope[0]])**2
-                self.height_sigmas[y_slope[0]] += temp/len(self.__heights)
-        self.height_sigmas = list(np.sqrt(self.height_sigmas))
-
-    # Finds the RMS of the residue over all scans at a given position
-    def __FindResidueRMSOverScans(self):
-        temp = len(self.residue[0][1])
-        self.residue_sigmas = np.array(range(temp))*0.
-        for scan in self.residue:
-            for y_slope in enumerate(scan[1]):
-                temp = (y_slope[1]-self.residue_avg[y_slope[0]])**2
-                self.residue_sigmas[y_slope[0]] += temp/len(self.residue)
-        self.residue_sigmas = list(np.sqrt(self.residue_sigmas))
-
-    # Finds the average residue over all scans at a given position
-    def __FindResidueAverageOverScans(self):
-        self.residue_avg = [0 for residue in self.residue[0][0]]
-        for scan in self.residue:
-            for residue in enumerate(scan[1]):
-                self.residue_avg[residue[0]] += residue[1] / len(self.residue)
-
-    # Finds the average height over all scans at a given position
-    def __FindHeightAverageOverScans(self):
-        self.height_avg = [0 for height in self.__heights[0][0]]
-        for scan in self.__heights:
-            for height in enumerate(scan[1]):
-                self.height_avg[height[0]] += height[1] / len(self.__heights)
-
-    # Finds the average slope over all scans at a given position
-    def __FindSlopeAverageOverScans(self):
-        self.slope_avg = [0 for slope in self.__slopes[0][0]]
-        for scan in self.__slopes:
-            for slope in enumerate(scan[1]):
-                self.slope_avg[slope[0]] += slope[1] / len(self.__slopes)
-
-    # Finds the average, RMS, and peak-to-valley of the chosen averaged data
-    def __FindResults(self, averaged_data):
-        length = len(averaged_data)
-        average = 0.0
-        std = 0.0
-        p2v = averaged_data[0]
-        valley = p2v
-        for datum in averaged_data:
-            average += datum / length
-            if datum > p2v:
-                p2v = datum
-        for datum in averaged_data:
-            std += (datum - average)**2 / length
-            if valley > datum:
-                valley = datum
-        p2v -= valley
-        std = np.sqrt(std)
-        return [average, std, p2v]
-
     # Removing outlier datasets:
 
     # This method takes the height at each point, and if that is more than a
@@ -615,73 +861,81 @@ class Raven:
     # beyond the number (number of points in scan)/(7*inputted rigor), then
     # the scan is cut from the list of allowed scans' indices (filtered_list)
     # in FilterFOO
+    # The deviations are also ranked here, so FilterFOO only has to find where
+    # its limit falls in the ranking. As with UpdateStats, this happens by
+    # itself when needed, so this only makes sure it is current.
     def PrepFilter(self):
-        self.height_deviation = []
-        self.slope_deviation = []
-        for scan in self.__heights:
-            counter = 0
-            for x in range(len(scan[1])):
-                if (abs(scan[1][x]-self.height_avg[x])
-                        > (1.*self.height_sigmas[x])):
-                    counter += ((abs(scan[1][x]-self.height_avg[x]) -
-                                 (1.*self.height_sigmas[x]))
-                                / self.height_sigmas[x])
-            self.height_deviation.append(counter)
-        for scan in self.__slopes:
-            counter = 0
-            for x in range(len(scan[1])):
-                if (abs(scan[1][x]-self.slope_avg[x])
-                        > (1.*self.slope_sigmas[x])):
-                    counter += (abs(scan[1][x]-self.slope_avg[x]) -
-                                (1.*self.slope_sigmas[x]))/self.slope_sigmas[x]
-            self.slope_deviation.append(counter)
+        self.__Derive("deviation")
+
+    # Works out the deviation product, Format is [height_deviation,
+    # slope_deviation, height ranking, slope ranking]
+    def __FindDeviations(self):
+        height_deviation = self.__FindDeviation(self.__heights,
+                                                self.height_avg,
+                                                self.height_sigmas)
+        slope_deviation = self.__FindDeviation(self.__slopes,
+                                               self.slope_avg,
+                                               self.slope_sigmas)
+        return [height_deviation, slope_deviation,
+                self.__RankDeviation(height_deviation),
+                self.__RankDeviation(slope_deviation)]
+
+    # Sorts the scans from least to most deviant, Format is
+    # [scan indices in order, deviations in order]
+    def __RankDeviation(self, deviation):
+        order = np.argsort(deviation, kind="mergesort")
+        return [order, deviation[order]]
+
+    # Tallies, for each scan, the standard deviations beyond 1 of every point
+    def __FindDeviation(self, data, data_avg, data_sigmas):
+        excess = np.abs(data - data_avg) - data_sigmas
+        with np.errstate(divide="ignore", invalid="ignore"):
+            excess = np.where(excess > 0, excess / data_sigmas, 0.)
+        return np.sum(excess, axis=1)
 
     # Takes the deviations found in height_deviation and compares them to a
     # limit, and cuts out indices of any found too deviant from list of allowed
-    # more clarification in PrepFilter
+    # more clarification in PrepFilter. Returns [added, removed], the indices
+    # of scans that came into or dropped out of filtered_list.
     def FilterHeights(self, rigor=__current_value):
-        if rigor == -1:
-            rigor = self.filter_rigor
-        else:
-            self.filter_rigor = rigor
-        self.ResetFilter()
-        max_deviation = len(self.__slopes[0][0]) / (7*rigor)
-        for i, deviation in reversed(list(enumerate(self.height_deviation))):
-            if deviation > max_deviation:
-                del self.filtered_list[i]
+        return self.__Filter(self.__Derive("deviation")[2], rigor)
 
     # Takes the deviations found in slope_deviation and compares them to a
     # limit, and cuts out indices of any found too deviant from list of allowed
-    # more clarification in PrepFilter
+    # more clarification in PrepFilter. Returns [added, removed] as above.
     def FilterSlopes(self, rigor=__current_value):
+        return self.__Filter(self.__Derive("deviation")[3], rigor)
+
+    # Does the work for FilterFOO. The scans passing are always the first few
+    # of the ranking, so a binary search for the limit finds them, and when
+    # the last filter used the same ranking, the change is just the stretch
+    # of the ranking between the old and new limits.
+    def __Filter(self, rank, rigor):
         if rigor == -1:
             rigor = self.filter_rigor
         else:
             self.filter_rigor = rigor
-        self.ResetFilter()
-        max_deviation = len(self.__slopes[0][0]) / (7*rigor)
-        for i, deviation in reversed(list(enumerate(self.slope_deviation))):
-            if deviation > max_deviation:
-                del self.filtered_list[i]
-
-    # Circle Functions for fitting above
-    def __circle(self, x, x0, y0, R):
-        out = (R * 1000)**2 - ((x-x0) * 0.001)**2
-        # out += (abs(out) - out)*123412345678909876543212345 # This is so tiny
-        #                                                 circles don't happen.
-        out = (abs(out) + out) * 0.5
-        return -1000000000*(np.sqrt(out) - y0)
-
-    # Negative of the above circle function, since I was getting errors when I
-    # tried to fit negative __circle()
-    def __negcircle(self, x, x0, y0, R):
-        return -1 * self.__circle(x, x0, y0, R)
-
-    # Method to find the RMS, peak to peak, and average of the average scan
+        max_deviation = self.__slopes.shape[1] / (7*rigor)
+        order, deviation = rank
+        count = int(np.searchsorted(deviation, max_deviation, side="right"))
+        if self.__filter_rank is rank:
+            added = order[self.__filter_count:count].tolist()
+            removed = order[count:self.__filter_count].tolist()
+        else:
+            passed = set(order[:count].tolist())
+            old = set(self.filtered_list)
+            added = sorted(passed - old)
+            removed = sorted(old - passed)
+        self.__filter_rank = rank
+        self.__filter_count = count
+        if added or removed:
+            self.filtered_list = np.sort(order[:count]).tolist()
+        return [added, removed]
+
+    # Method to find the RMS, peak to peak, and average of the average scan.
+    # These come with the rest of the stats, see UpdateStats.
     def AnalyzeAverages(self):
-        self.slope_results = self.__FindResults(self.slope_avg)
-        self.height_results = self.__FindResults(self.height_avg)
-        self.residue_results = self.__FindResults(self.residue_avg)
+        self.UpdateStats()
 
     # This will add another Raven file as a calibration curve, and apply it. It
     # assumes the calibration curve is for slope data, and recalculates height
@@ -689,55 +943,38 @@ class Raven:
     # refitting is recommended in whatever is using this file.
     def AddCalibration(self, raven):
         self.SetUndo()
-        calibration_curve = [raven.GetSlopeAverage(), raven.GetSlopes()[0][0]]
-        calibration_curve[0].insert(0, raven.GetSlopes()[0][0][0]-1)
-        calibration_curve[1].insert(0, raven.GetSlopes()[0][0][0]-1)
+        calibration_curve = [list(raven.GetSlopeAverage()),
+                             list(raven.GetX())]
+        xrange = raven.GetXRange()
+        calibration_curve[0].insert(0, xrange[0]-1)
+        calibration_curve[1].insert(0, xrange[0]-1)
         calibration_curve[0].insert(0, -1000)
         calibration_curve[1].insert(0, -1000)
-        length = len(raven.GetSlopes()[0][0])-1
-        calibration_curve[0].append(raven.GetSlopes()[0][0][length])
-        calibration_curve[1].append(raven.GetSlopes()[0][0][length])
+        calibration_curve[0].append(xrange[1])
+        calibration_curve[1].append(xrange[1])
         calibration_curve[0].append(1000)
         calibration_curve[1].append(1000)
         interp_curve = Lightning(calibration_curve)
-        self.__slopes = [[scan[0],
-                          interp_curve.LinearInterpolate(scan[1], 0, 0)]
-                         for scan in self.__slopes]
-        self.fit_function = [[scan[0],
-                              interp_curve.LinearInterpolate(scan[1], 0, 0)]
-                             for scan in self.__slopes]
-        self.fit_avg = [self.fit_avg[0],
-                        interp_curve.LinearInterpolate(self.fit_avg[1], 0, 0)]
+        self.__slopes = np.array([interp_curve.LinearInterpolate(scan, 0, 0)
+                                  for scan in self.__slopes])
+        self.fit_function = np.array([interp_curve.LinearInterpolate(scan,
+                                                                     0, 0)
+                                      for scan in self.fit_function])
+        self.fit_avg = np.array(interp_curve.LinearInterpolate(self.fit_avg,
+                                                               0, 0))
         self.AcquireAnalysisVariables()
 
     # Method to save everything
     def Save(self, filename=__current_value):
         if filename == -1:
             filename = self.default_file.format(0).split(".as")[0]+"_out.asc"
-        fileInQuestion = open(filename, "w")
-        output = []
-        output.append(copy.deepcopy(self.__slopes))
-        for i, scan in enumerate(output[0]):
-            if i == 0:
-                scan[0].insert(0, "# X-position")
-                scan[1].insert(0, "Slope, scan " + str(i))
-            else:
-                del scan[0]
-                scan[0].insert(0, "Slope, scan " + str(i))
-
-        output.append(copy.deepcopy(self.__heights))
-        for i, scan in enumerate(output[1]):
-            del scan[0]
-            scan[0].insert(0, "Height, scan " + str(i))
-
-        output.append(copy.deepcopy(self.fit_function))
-        for i, scan in enumerate(output[2]):
-            del scan[0]
-            scan[0].insert(0, "Fitted Function Value, scan " + str(i))
-
-        output.append(copy.deepcopy(self.fit_avg))
-        del output[3][0]
-        output[3][0].insert(0, "Fitted Function to Average")
+        labels = ["# X-position"]
+        labels += ["Slope, scan " + str(i) for i in range(len(self.__slopes))]
+        labels += ["Height, scan " + str(i) for i in
+                   range(len(self.__heights))]
+        labels += ["Fitted Function Value, scan " + str(i) for i in
+                   range(len(self.fit_function))]
+        labels.append("Fitted Function to Average")
 
         output_string = "# This is a bulk file for use by OMEN\n"
         output_string += "# List of Available Scans: "
@@ -747,43 +984,85 @@ class Raven:
         output_string += str(self.offset[1]) + " " + str(self.fit_data_type)
         output_string += "\n\n\n"
 
-        output_string += Medium.ConvertToAscii(output)
-
-        fileInQuestion.write(output_string)
+        # The data is streamed out straight from the arrays, see WriteColumns
+        with open(filename, "w") as fileInQuestion:
+            fileInQuestion.write(output_string)
+            Medium.WriteColumns(fileInQuestion, labels,
+                                [self.__scan_x[0], self.__slopes,
+                                 self.__heights, self.fit_function,
+                                 self.fit_avg])
 
     # Method to save just the average, active data
     def SaveAvg(self, filename=__current_value):
         if filename == -1:
             filename = self.default_file.format(0).split(".as")[0]+"_avg.asc"
-        fileInQuestion = open(filename, "w")
-        output = []
         if self.fit_data_type == 1:
-            output.append(copy.deepcopy(self.GetHeights()[0][0]))
-            output.append(copy.deepcopy(self.GetHeightAverage()))
-            output[1].insert(0, "# Mirror Height")
+            labels = ["# X-position", "# Mirror Height"]
+            average = self.GetHeightAverage()
         if self.fit_data_type == 0:
-            output.append(copy.deepcopy(self.GetSlopes()[0][0]))
-            output.append(copy.deepcopy(self.GetSlopeAverage()))
-            output[1].insert(0, "# Mirror Slope")
-        output[0].insert(0, "# X-position")
+            labels = ["# X-position", "# Mirror Slope"]
+            average = self.GetSlopeAverage()
         output_string = "# This is an averaged file generated by OMEN\n"
         output_string += "# Internal Note: " + str(self.offset[0]) + " "
         output_string += str(self.offset[1]) + " " + str(self.fit_data_type)
         output_string += "\n\n\n"
-        output_string += Medium.ConvertToAscii(output)
 
-        fileInQuestion.write(output_string)
+        with open(filename, "w") as fileInQuestion:
+            fileInQuestion.write(output_string)
+            Medium.WriteColumns(fileInQuestion, labels,
+                                [self.GetX(), average])
+
+    # Method to save the whole session in OMEN's binary format (see
+    # Medium.WriteSession). Unlike Save, it keeps everything exactly: the
+    # x-positions of each scan, the start point, scan_list, offsets and fit,
+    # and the stats of the averages, so those don't need working out again.
+    # Arrays the start point shares with the current data are stored once.
+    def SaveSession(self, filename=__current_value):
+        if filename == -1:
+            filename = self.default_file.format(0).split(".as")[0]+"_out.omen"
+        stats = self.__Derive("stats")[0]
+        arrays = [stats.mean, stats.m2]
+        header = {"offset": self.offset, "fit_data_type": self.fit_data_type,
+                  "read_fit": self.read_fit, "radius": self.radius,
+                  "integration_rule": self.integration_rule,
+                  "stats": {"count": stats.count, "mean": 0, "m2": 1}}
+        start_point = self.__history.pinned
+        if start_point is None:
+            start_point = self.__GetState()
+        for label, state in (("state", self.__GetState()),
+                             ("start_point", start_point)):
+            header[label] = {"scan_list": state["scan_list"]}
+            for key in ("x", "scan_x", "slopes", "heights", "fit_function",
+                        "fit_avg"):
+                index = len(arrays)
+                for i, array in enumerate(arrays):
+                    if array is state[key]:
+                        index = i
+                if index == len(arrays):
+                    arrays.append(state[key])
+                header[label][key] = index
+        Medium.WriteSession(filename, header, arrays)
 
     # Method to load data from a file
-    def Load(self, filename=__current_value, num_scans=scan_list):
+    def Load(self, filename=__current_value, num_scans=__current_value):
         if filename == -1:
             filename = self.default_file.format(0).split(".as")[0]+"_out.asc"
         try:
-            fileInQuestion = open(filename.format(1), "r")
-            # Based on the first line, it detrmines the file format
-            currentline = fileInQuestion.readline()
+            # Binary MDA files straight from the LTP are known by their name
+            if filename.endswith(".mda"):
+                fileInQuestion = open(filename, "rb")
+                currentline = "mda"
+            elif filename.endswith(".omen"):
+                fileInQuestion = open(filename, "rb")
+                currentline = fileInQuestion.readline().decode("latin-1")
+            else:
+                fileInQuestion = open(filename.format(1), "r")
+                # Based on the first line, it detrmines the file format
+                currentline = fileInQuestion.readline()
             temp = "# This is a"  # Sadly a needed line for style guidelines
             if not(currentline.startswith("## mda2ascii ") or
+                   currentline == "mda" or
+                   currentline == Medium.session_magic or
                    currentline == temp+" bulk file for use by OMEN\n" or
                    currentline == temp+"n averaged file generated by OMEN\n"):                raise FileNotFoundError("Bad File")
         except FileNotFoundError:
@@ -792,6 +1071,7 @@ class Raven:
             currentline = "not a file"
 
         output = 0
+        start_point = None
         # Clearing house and preparing the defaults
         self.clear()
         try:
@@ -800,16 +1080,11 @@ class Raven:
         except:
             self.default_file = filename
 
-        # This assumes any file starting with "## mda2ascii " came from the LTP
-        if currentline.startswith("## mda2ascii "):
-            name = list(filename)
-            del name[len(name) - 7]
-            del name[len(name) - 7]
-            name.insert(len(name) - 6, "{0:02d}")
-            formatted_name = ""
-            for char in name:
-                formatted_name += char
-            self.__LoadRawFile(formatted_name, num_scans)
+        # This assumes any file starting with "## mda2ascii ", or any MDA file,
+        # came from the LTP
+        if currentline.startswith("## mda2ascii ") or currentline == "mda":
+            fileInQuestion.close()
+            self.__LoadRawFile(filename, num_scans)
             output = 1
 
         # Since I have more control over my format, this is more specific,
@@ -822,100 +1097,194 @@ class Raven:
         if currentline == temp + "n averaged file generated by OMEN\n":
             output = 3
 
+        if currentline == Medium.session_magic:
+            fileInQuestion.close()
+            start_point = self.__LoadSession(filename)
+            output = 4
+
         # This is if a user inputs a list instead of a file
         if currentline == "not a file":
-            self.__slopes.append(copy.deepcopy(filename))
-            self.__heights.append(copy.deepcopy(filename))
-            self.fit_function.append(copy.deepcopy(filename))
+            self.__SetData(filename[0], [filename[1]])
+            self.__heights = self.__slopes
+            self.fit_function = self.__slopes
+            self.fit_avg = self.__slopes[0]
             self.default_file = ""
 
+        # Nothing from before or during loading is worth undoing back to
         self.Reset()
-        self.SetUndo()
+        self.__history = History(self.history_budget)
         self.SetStartPoint()
+        # Except that a session brings its own start point along
+        if start_point is not None:
+            self.__history.Pin(start_point)
+            self.scan_list_initial = list(start_point["scan_list"])
 
         return output
 
-    # Private Method to read in data outputted by the EPICS LTP software
-    def __LoadRawFile(self, filename=__current_value, num_scans=scan_list):
+    # Stores x-positions and data for each scan in the columnar format. Given
+    # a single set of x-positions, it is shared by all of the scans.
+    def __SetData(self, x, slopes):
+        slopes = np.asarray(slopes, dtype=float)
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            x = RepeatRows(x, len(slopes))
+        self.__scan_x = x
+        self.__x = x[0]
+        self.__slopes = slopes
+
+    # Private Method to read in data outputted by the EPICS LTP software. All
+    # the scan files of the run are found by looking in the directory, so
+    # there is no limit on how many there are, and are read in parallel, from
+    # the cache if they were read before (see Medium.ReadMdaCached). Scan
+    # file n has index n-1 in scan_list, and num_scans picks out the indices
+    # wanted, all of them by default. An MDA file holds the whole run itself,
+    # and is read directly instead, its nth 1-D scan standing in for file n.
+    # Either way every column of the run is kept in dataset.
+    def __LoadRawFile(self, filename=__current_value, num_scans=__current_value):
         if filename == -1:
             filename = self.default_file
-        self.scan_list = list(num_scans)
-        bad_indices = []
-        for index, j in enumerate(self.scan_list):
-            try:
-                fileInQuestion = open(filename.format(j+1), "r")
-                output = "\n"
-
-                ltp_data_location = 4
-                ltp_data_text = ""
-                # This loops is to get past header text. If any operations
-                # using the header text are needed, insert them here.
-                while((output.startswith("#") or output.startswith("\n")) or
-                       output.startswith("     ")):
-                    output = fileInQuestion.readline()
-                    if output.endswith("ltp:ElcomatAM1:Yavg.VAL, Y Average, microra\n"):
-                        ltp_data_text = output
-
-                if ltp_data_text != "":
-                    ltp_data_text = ltp_data_text.split(" ")
-                    index = 0
-                    for possible_value in ltp_data_text:
-                        try:
-                            temp = int(possible_value) - 1
-                            ltp_data_location = temp
-                            break
-                        except ValueError:
-                            continue
-
-                # This loop is acquiring the actual data
-                prelim_data = []
-                while(output.endswith("\n")):
-                    prelim_data.append(output.split("\n")[0].split(" "))
-                    output = fileInQuestion.readline()
-                intermediate_step = np.array(prelim_data, dtype=list)
-                data = intermediate_step.astype(np.float).T
-                x = list(data[1])
-                y = list(data[ltp_data_location])
-
-                # Time to save this to the master list
-                self.__slopes.append([x, y])
-                fileInQuestion.close()
-            except FileNotFoundError:
-                # Remove the bad files
-                bad_indices.append(index)
-        for index in reversed(bad_indices):
-            del self.scan_list[index]
+        wanted = None
+        if num_scans != -1:
+            wanted = set(index + 1 for index in num_scans)
+        if filename.endswith(".mda"):
+            self.dataset = Medium.ReadMdaDataset(filename)
+        else:
+            found = [scan for scan in Medium.FindScanFiles(filename) if
+                     wanted is None or scan[0] in wanted]
+            reads = Medium.ReadMdaFiles([scan[1] for scan in found])
+            # Files gone missing in the meantime are just left out
+            kept = [i for i, read in enumerate(reads) if
+                    read is not None and read[1].size > 0]
+            self.dataset = Medium.MdaDataset([reads[i] for i in kept], [],
+                                             [found[i][0] for i in kept])
+        self.scan_list = [number - 1 for number in self.dataset.scan_numbers
+                          if wanted is None or number in wanted]
+        self.__UseDataset()
+
+    # Takes the x-positions, and the slopes from the column of slope_detector,
+    # of the scans in scan_list out of dataset. When those are the first scans
+    # of dataset in order, as after loading, they are views of it, not copies.
+    def __UseDataset(self):
+        rows = [self.dataset.scan_numbers.index(scan + 1) for scan in
+                self.scan_list]
+        if rows == list(range(len(rows))):
+            rows = slice(0, len(rows))
+        column = self.dataset.Column(self.slope_detector)
+        if column is None:
+            column = 4  # Where the LTP has put the slopes so far
 
         self.fit_data_type = 0
-        if len(self.__slopes) > 0:
+        if len(self.scan_list) > 0:
+            self.__SetData(*self.__Register(self.dataset.Scans(1)[rows],
+                                            self.dataset.Scans(column)[rows],
+                                            self.scan_list))
             self.fit_function = self.__slopes
-            self.AcquireAnalysisVariables()
+            self.fit_avg = self.__slopes[0]
+            self.AcquireAnalysisVariables(False)
+
+    # Chooses the detector slopes come from, by PV name or a part of it (see
+    # Medium.MdaDataset.Column), and takes them from dataset anew, without
+    # reading any files. The scans are taken as they were loaded, so any ROI,
+    # ZeroX or calibration has to be done again. This can be undone.
+    def SetSlopeDetector(self, name):
+        if self.dataset is None or self.dataset.Column(name) is None:
+            raise ValueError("Unknown detector: " + str(name))
+        self.SetUndo()
+        self.slope_detector = name
+        self.__UseDataset()
+
+    # Chooses how the scans of the run are resampled onto one grid of
+    # x-positions when taken from dataset, from resample_methods, or None to
+    # keep the x-positions they were read at. The grid is the average
+    # x-positions of the scans unless given. As with SetSlopeDetector, the
+    # scans are taken from dataset anew, and this can be undone. Without a
+    # dataset, this is only used by the next load.
+    def SetResampling(self, method, grid=None):
+        if method is not None and method not in resample_methods:
+            raise ValueError("Unknown resampling method: " + str(method))
+        self.resample_method = method
+        self.resample_grid = grid
+        if grid is not None:
+            self.resample_grid = np.asarray(grid, dtype=float)
+        if self.dataset is not None:
+            self.SetUndo()
+            self.__UseDataset()
+
+    # Notes in registration how far off the average x-positions (reference,
+    # if given) those of each scan in x are, the scans having the indices
+    # given, and resamples data along x onto the grid if resample_method is
+    # set. The positions of the grid along x are kept, so that taking other
+    # data along the same x (as SetSlopeDetector does) doesn't find them
+    # again. Returns [x, data] as they are to be used.
+    def __Register(self, x, data, indices, reference=None):
+        if reference is None:
+            reference = np.mean(x, axis=0)
+        if reference.shape == x.shape[1:]:
+            jitter = x - reference
+            for index, average, rms, largest in zip(
+                    indices, np.mean(jitter, axis=1), np.std(jitter, axis=1),
+                    np.max(np.abs(jitter), axis=1)):
+                self.registration[index] = [average, rms, largest]
+        if self.resample_method is None:
+            return [x, data]
+
+        grid = reference if self.resample_grid is None else self.resample_grid
+        cached = self.__resampling
+        if (cached is None or not np.array_equal(cached[0], x) or
+                not np.array_equal(cached[1], grid)):
+            cached = [x, grid, ResampleWeights(x, grid)]
+            self.__resampling = cached
+        return [RepeatRows(grid, len(x)),
+                Resample(x, data, cached[2], self.resample_method)]
+
+    # Private Method to read in a session from SaveSession. The arrays are
+    # memory-mapped rather than read, and the stats of the averages come with
+    # them, so only the data actually looked at is read from the disk (the
+    # averages alone need none of the scans). Returns the start point saved.
+    def __LoadSession(self, filename):
+        header, arrays = Medium.ReadSession(filename)
+        states = []
+        for label in ("state", "start_point"):
+            state = dict((key, arrays[index]) for key, index in
+                         header[label].items() if key != "scan_list")
+            state["scan_list"] = header[label]["scan_list"]
+            states.append(state)
+        self.__SetState(states[0])
+        self.offset = header["offset"]
+        self.fit_data_type = header["fit_data_type"]
+        self.read_fit = header["read_fit"]
+        self.radius = header["radius"]
+        self.integration_rule = header["integration_rule"]
+
+        stats = RunningStats()
+        stats.count = header["stats"]["count"]
+        stats.mean = arrays[header["stats"]["mean"]]
+        stats.m2 = arrays[header["stats"]["m2"]]
+        self.__products["stats"] = [[self.__slopes, self.__heights], 0,
+                                    [stats, stats.mean, stats.GetSigmas(),
+                                     stats.GetResults()]]
+        return states[1]
 
     # Private Method to read in data created by OMEN
     def __LoadBulkFile(self, fileInQuestion):
         self.scan_list = [0]
-        output = ""
-        currentline = fileInQuestion.readline()
-        while currentline.endswith("\n"):
-            if currentline.startswith("#") or currentline.startswith("\n"):
-                if currentline.startswith("# List of Available Scans: "):
-                    temp = currentline.split(", ")
-                    temp[0] = temp[0].split(" ")
-                    temp[0] = int(temp[0][len(temp[0])-1])
-                    self.scan_list = []
-                    for element in temp:
-                        try:
-                            self.scan_list.append(int(element))
-                        except:
-                            continue
-                if currentline.startswith("# Internal Note: "):
-                    temp = currentline.split(" ")
-                    self.offset[0] = temp[len(temp)-3]
-                    self.offset[1] = temp[len(temp)-2]
-                    self.fit_data_type = int(temp[len(temp)-1])
-            else:
-                output += currentline
-            currentline = fileInQuestion.readline()
+        comments, data, widths = Medium.ReadColumns(fileInQuestion)
+        for currentline in comments:
+            if currentline.startswith("# List of Available Scans: "):
+                temp = currentline.split(", ")
+                temp[0] = temp[0].split(" ")
+                temp[0] = int(temp[0][len(temp[0])-1])
+                self.scan_list = []
+                for element in temp:
+                    try:
+                        self.scan_list.append(int(element))
+                    except:
+                        continue
+            if currentline.startswith("# Internal Note: "):
+                temp = currentline.split(" ")
+                self.offset[0] = temp[len(temp)-3]
+                self.offset[1] = temp[len(temp)-2]
+                self.fit_data_type = int(temp[len(temp)-1])
         try:
             self.offset[0] = int(self.offset[0])
             self.offset[1] = int(self.offset[1])
@@ -923,16 +1292,10 @@ class Raven:
             self.offset[0] = 0
             self.offset[1] = 0
 
-        temp = Medium.ConvertToList(output)
-        data = []
-        data_index = 0
-        for datum in range(len(temp)):
-            while True:
-                try:
-                    temp[datum].remove(None)
-                except:
-                    break
-            data.append(list(np.array(temp[datum]).astype(float)))
+        # Columns cut short are matched by trimming the others to them, so
+        # only the rows with every column are kept
+        length = np.sum(widths >= len(data))
+        data = data[:, :length]
 
         # First the X-positions:
         x = data[0]
@@ -941,109 +1304,655 @@ class Raven:
         # case, some features are effectively disabled, since OMEN isn't really
         # designed for single-run, single-scan analysis.
         if len(data) == 2:
-            self.fit_function.append([copy.deepcopy(x), data[1]])
-            self.fit_avg.append([copy.deepcopy(x), data[1]])
+            self.__SetData(x, data[1:2])
+            self.fit_function = data[1:2]
+            self.fit_avg = data[1]
             if self.fit_data_type == 0:
-                self.__slopes.append([copy.deepcopy(x), data[1]])
                 self.AcquireAnalysisVariables()
             else:
-                self.__heights.append([copy.deepcopy(x), data[1]])
+                self.__heights = data[1:2]
                 self.AcquireSlopes()
         else:
-            data_index += 1
-            # Now the data:
-            for i in range(len(self.scan_list)):
-                self.__slopes.append([copy.deepcopy(x), data[data_index]])
-                data_index += 1
-
-            for i in range(len(self.scan_list)):
-                temp = [x[j] for j in range(len(data[data_index]))]
-                self.__heights.append([temp, data[data_index]])
-                data_index += 1
-
-            if data_index == len(data):
-                data_index = 1 + self.fit_data_type
-            for i in range(len(self.scan_list)):
-                temp = [x[j] for j in range(len(data[data_index]))]
-                self.fit_function.append([temp, data[data_index]])
-                data_index += 1
-
-                data_index -= 1
-            temp = [x[j] for j in range(len(data[data_index]))]
-            self.fit_avg = [temp, data[data_index]]
+            # Now the data, in blocks of one column per scan:
+            scans = len(self.scan_list)
+            self.__SetData(x, data[1:1+scans])
+            self.__heights = data[1+scans:1+2*scans]
+            if len(data) > 1+2*scans:
+                self.fit_function = data[1+2*scans:1+3*scans]
+                self.fit_avg = data[len(data)-1]
+            else:
+                self.fit_function = data[1+scans*self.fit_data_type:
+                                         1+scans*(1+self.fit_data_type)]
+                self.fit_avg = self.fit_function[0]
 
     # wiping data, in case there are memory problems or leaks somewhere
     def clear(self):
-        self.__slopes = []
-        self.__heights = []
-        self.__slopes_last = []
-        self.__heights_last = []
-        self.__slopes_initial = []
-        self.__heights_initial = []
-        self.slope_sigmas = []
-        self.slope_avg = []
-        self.height_sigmas = []
-        self.height_avg = []
-        self.residue = []
-        self.residue_avg = []
-        self.residue_sigmas = []
-        self.residue_results = []
-        self.height_results = []
-        self.slope_results = []
+        self.__x = np.zeros(0)
+        self.__scan_x = np.zeros((0, 0))
+        self.__slopes = np.zeros((0, 0))
+        self.__heights = np.zeros((0, 0))
+        self.__history = History(self.history_budget)
+        self.__products = {}
+        self.__buffers = {}
+        self.__last_fit = None
+        self.dataset = None
+        self.registration = {}
         self.default_file = "C:\\Users\\Ben Sheff\\Documents\\Argonne\\"
         self.default_file += "Test Data\\Sheff_300mm_test0001_01_1.asc"
         self.scan_list = list(range(99))
-        self.slope_deviation = []
-        self.height_deviation = []
-        self.fit_function = []
-        self.fit_function_last = []
-        self.fit_avg = []
-        self.read_fit = ""
+        self.fit_function = np.zeros((0, 0))
+        self.fit_avg = np.zeros(0)
         self.read_fit = ""
-        self.slope_deviation = []
-        self.height_deviation = []
         self.filter_rigor = 0.0000000001
         self.filtered_list = list(range(99))
+        self.__filter_rank = None
         self.radius = 0
         self.offset = [0, 0]
 
-    # Returns the slope data that passed the filter plus offsets
-    def GetSlopes(self):
-        return [[[x + self.offset[i] for x in data] for
-                 i, data in enumerate(self.__slopes[index])] for
-                index in self.filtered_list]
+    # Returns the slope data that passed the filter plus offsets. The indices
+    # of other scans to return instead can be given in scans. Nothing is
+    # copied here, see TraceView for how the offsets are added when read.
+    def GetSlopes(self, scans=__current_value):
+        if scans == -1:
+            scans = self.filtered_list
+        return TraceView(self.__scan_x, self.__slopes, scans, self.offset)
 
     # NEEDS UPDATE: make output x values alongside, update Plottingtool and
     # GetHeightAverage accordingly
     # Returns the averaged slope data plus offsets
     def GetSlopeAverage(self):
-        return [avg + self.offset[1] for avg in self.slope_avg]
+        return self.slope_avg + self.offset[1]
 
-    # Returns the height data that passed the filter plus offsets
-    def GetHeights(self):
-        return [[[x + self.offset[i] for x in data] for
-                 i, data in enumerate(self.__heights[index])] for
-                index in self.filtered_list]
+    # Returns the height data that passed the filter plus offsets, or for the
+    # scans given, as GetSlopes
+    def GetHeights(self, scans=__current_value):
+        if scans == -1:
+            scans = self.filtered_list
+        return TraceView(self.__scan_x, self.__heights, scans, self.offset)
 
     # Returns the averaged height data plus offsets
     def GetHeightAverage(self):
-        return [avg + self.offset[1] for avg in self.height_avg]
+        return self.height_avg + self.offset[1]
 
-    # Returns the residue data that passed the filter plus offsets
-    def GetResidue(self):
-        return [[[x + self.offset[i] for x in data] for
-                 i, data in enumerate(self.residue[index])] for
-                index in self.filtered_list]
+    # Returns the residue data that passed the filter plus offsets, or for the
+    # scans given, as GetSlopes
+    def GetResidue(self, scans=__current_value):
+        if scans == -1:
+            scans = self.filtered_list
+        return TraceView(self.__scan_x, self.residue, scans, self.offset)
 
     # Returns the averaged slope data plus offsets
     def GetResidueAverage(self):
-        return [avg + self.offset[1] for avg in self.residue_avg]
+        return self.residue_avg + self.offset[1]
 
     # Returns the fit to the average, plus offsets
     def GetFitAverage(self):
-        return [[avg + self.offset[i] for avg in self.fit_avg[i]] for
-                i in range(len(self.fit_avg))]
+        return [self.__x + self.offset[0], self.fit_avg + self.offset[1]]
+
+    # Returns the x-positions shared by all the scans, plus offset unless
+    # offset is False, which gives them exactly as they are without it
+    def GetX(self, offset=True):
+        if not offset:
+            return self.__x
+        return self.__x + self.offset[0]
+
+    # Returns the first and last of the shared x-positions, plus offset,
+    # without touching the rest of them
+    def GetXRange(self):
+        return [self.__x[0] + self.offset[0], self.__x[-1] + self.offset[0]]
 
     # Returns the indices of the data that passed the filter
     def GetScanList(self):
         return [self.scan_list[index] for index in self.filtered_list]
+
+    # Returns the registration (see __Register) of the scans with indices in
+    # filtered_list, or in scans, with None for those loaded without it.
+    # Format is [[average, RMS, largest]] in mm.
+    def GetRegistration(self, scans=__current_value):
+        if scans == -1:
+            scans = self.filtered_list
+        return [self.registration.get(self.scan_list[i]) for i in scans]
+
+
+# Stands in for the nested lists of [x-positions, data] traces the Raven
+# getters used to build. It only holds on to the arrays, the indices of the
+# scans asked for and the offsets, and adds the offsets to just the rows that
+# are read. Indexing it gives [x, data] arrays for one scan, slicing gives
+# another view, and np.array(view) gives every scan at once in a single array
+# of shape (scans, 2, positions).
+class TraceView:
+    x = np.zeros((0, 0))  # Format is [scan, position]
+    data = np.zeros((0, 0))  # Format is [scan, position]
+    indices = np.zeros(0, dtype=int)  # Format is [index of scan in data]
+    offset = [0, 0]  # Format is [x offset, data offset]
+
+    def __init__(self, x, data, indices, offset=[0, 0]):
+        self.x = x
+        self.data = data
+        self.indices = np.asarray(indices, dtype=int)
+        self.offset = list(offset)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TraceView(self.x, self.data, self.indices[i], self.offset)
+        index = self.indices[i]
+        return [self.x[index] + self.offset[0],
+                self.data[index] + self.offset[1]]
+
+    def __iter__(self):
+        for i in range(len(self.indices)):
+            yield self[i]
+
+    # Lets numpy read the whole view, adding the offsets by broadcasting
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            dtype = self.data.dtype
+        traces = np.empty((len(self.indices), 2, self.data.shape[-1]),
+                          dtype=dtype)
+        traces[:, 0] = self.x[self.indices] + self.offset[0]
+        traces[:, 1] = self.data[self.indices] + self.offset[1]
+        return traces
+
+
+# Factorizations of polynomial bases, most recently used last, as made by
+# PolynomialBasis. Format is {(x-positions as bytes, degree): [Q, R, mid,
+# scale]}
+polynomial_cache = OrderedDict()
+polynomial_cache_size = 16  # Format is the number of factorizations kept
+
+
+# The QR factorization of the polynomial basis up to degree on x-positions x.
+# Powers are taken of (x-mid)/scale, which runs from -1 to 1, to keep the
+# basis well conditioned, and the columns go from the constant upwards, so
+# the first n columns of Q are the basis for degree n-1. Refits on the same
+# positions are common, so factorizations are cached, dropping the least
+# recently used once there are more than polynomial_cache_size.
+# Format is [Q, R, mid, scale]
+def PolynomialBasis(x, degree):
+    x = np.asarray(x, dtype=float)
+    key = (x.tobytes(), degree)
+    if key in polynomial_cache:
+        basis = polynomial_cache.pop(key)
+    else:
+        mid = (np.max(x) + np.min(x)) / 2
+        scale = (np.max(x) - np.min(x)) / 2
+        if scale == 0:
+            scale = 1.
+        powers = np.vander((x - mid) / scale, degree + 1)[:, ::-1]
+        Q, R = np.linalg.qr(powers)
+        basis = [Q, R, mid, scale]
+    polynomial_cache[key] = basis
+    while len(polynomial_cache) > polynomial_cache_size:
+        polynomial_cache.popitem(last=False)
+    return basis
+
+
+# The rules Integrate and Differentiate know about. "left" is the original
+# left-sided Riemann sum, kept bit-for-bit as it always was.
+integration_rules = ["left", "trapezoid", "simpson"]
+
+
+# Stands one row of x-positions in for every one of count scans, without
+# copying it, as a read-only view that repeats the row.
+def RepeatRows(row, count):
+    rows = np.lib.stride_tricks.as_strided(row, (count, len(row)),
+                                           (0, row.strides[0]))
+    rows.setflags(write=False)
+    return rows
+
+
+# The methods Resample knows about. "cubic" is a cubic Hermite spline with
+# the slopes at each point from its neighbours (see Differentiate), so it
+# needs nothing solved and still passes through every point.
+resample_methods = ["linear", "cubic"]
+
+
+# Finds where each point of grid falls along every row of x, for Resample.
+# Every row is searched at once, each being moved onto [2i, 2i+1] first so
+# that together they make one sorted array. Rows of x have to increase.
+# Returns [indices, weights], the index of the point to the left in each row
+# and how far on to the next one the grid point is, clamped at the ends as
+# np.interp does. Format of both is [ScanNumber, grid-index]
+def ResampleWeights(x, grid):
+    x = np.asarray(x, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    scans, points = x.shape
+    low = np.minimum(x[:, :1], grid[0])
+    span = np.maximum(x[:, -1:], grid[-1]) - low
+    span[span == 0] = 1
+    shift = 2 * np.arange(scans)[:, np.newaxis]
+    flat = ((x - low) / span + shift).ravel()
+    found = np.searchsorted(flat, ((grid - low) / span + shift).ravel(),
+                            side="right").reshape(scans, len(grid))
+    indices = np.clip(found - 1 - shift // 2 * points, 0, points - 2)
+    rows = np.arange(scans)[:, np.newaxis]
+    left = x[rows, indices]
+    width = x[rows, indices + 1] - left
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = np.where(width > 0, (grid - left) / width, 0)
+    return [indices, np.clip(weights, 0, 1)]
+
+
+# Interpolates every row of y, along the matching row of x, onto the grid
+# given to ResampleWeights(x, grid) by its output weights, all rows at once.
+# The weights only depend on x, so can be kept for any other data along it.
+# Format is [ScanNumber, grid-index]
+def Resample(x, y, weights, method="linear"):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    indices, t = weights
+    rows = np.arange(len(y))[:, np.newaxis]
+    left = y[rows, indices]
+    right = y[rows, indices + 1]
+    if method == "linear":
+        return left + t * (right - left)
+    if method != "cubic":
+        raise ValueError("Unknown resampling method: " + str(method))
+    slopes = Differentiate(x, y, "trapezoid")
+    width = x[rows, indices + 1] - x[rows, indices]
+    return ((1 + 2 * t) * (1 - t)**2 * left + t**2 * (3 - 2 * t) * right +
+            t * (1 - t) * width * ((1 - t) * slopes[rows, indices] -
+                                   t * slopes[rows, indices + 1]))
+
+
+# Integrates every row of y along the matching row of x in one pass. x may be
+# a single row shared by all of y. With the "left" rule, each point holds the
+# sum up to the right edge of its rectangle, the last rectangle borrowing the
+# width before it. With "trapezoid" and "simpson", each point holds the
+# integral from the first point, so the first point is always zero. Simpson
+# integrates the parabola through each interval and the one after it (the one
+# before it, for the last interval), so uneven spacing is handled properly.
+def Integrate(x, y, rule="left"):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    width = np.diff(x, axis=-1)
+    if rule == "left":
+        width = np.concatenate((width, width[..., -1:]), axis=-1)
+        return np.cumsum(y * width, axis=-1)
+    if rule == "trapezoid" or (rule == "simpson" and y.shape[-1] < 3):
+        area = (y[..., :-1] + y[..., 1:]) * width / 2
+    elif rule == "simpson":
+        area = np.zeros(y.shape[:-1] + (y.shape[-1] - 1,))
+        # Each interval but the last looks ahead to the next point
+        a = width[..., :-1]
+        b = a + width[..., 1:]
+        area[..., :-1] = (a * (3 * b - a) / (6 * b) * y[..., :-2] +
+                          a * (3 * b - 2 * a) / (6 * (b - a)) * y[..., 1:-1] -
+                          a ** 3 / (6 * b * (b - a)) * y[..., 2:])
+        # The last interval is the mirror image, looking back a point
+        a = width[..., -1]
+        b = a + width[..., -2]
+        area[..., -1] = (a * (3 * b - a) / (6 * b) * y[..., -1] +
+                         a * (3 * b - 2 * a) / (6 * (b - a)) * y[..., -2] -
+                         a ** 3 / (6 * b * (b - a)) * y[..., -3])
+    else:
+        raise ValueError("Unknown integration rule: " + str(rule))
+    heights = np.zeros(y.shape)
+    heights[..., 1:] = np.cumsum(area, axis=-1)
+    return heights
+
+
+# Counterpart to Integrate. The "left" rule is the original one, where each
+# point is the slope to the point on its right, except the first, which is
+# taken from zero, and the last, which repeats the one before it. The other
+# rules use second order central differences, which allow for uneven spacing,
+# and one-sided differences at the two ends.
+def Differentiate(x, y, rule="left"):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    width = np.diff(x, axis=-1) * np.ones(y.shape[:-1] + (1,))
+    slopes = np.zeros(y.shape)
+    if rule == "left":
+        slopes[..., 0] = y[..., 0] / width[..., 0]
+        slopes[..., 1:-1] = np.diff(y, axis=-1)[..., :-1] / width[..., 1:]
+        slopes[..., -1] = (y[..., -1] - y[..., -2]) / width[..., -1]
+    elif rule in integration_rules:
+        step = np.diff(y, axis=-1)
+        left = width[..., :-1]
+        right = width[..., 1:]
+        slopes[..., 1:-1] = ((step[..., 1:] * left / right +
+                              step[..., :-1] * right / left) /
+                             (left + right))
+        slopes[..., 0] = step[..., 0] / width[..., 0]
+        slopes[..., -1] = step[..., -1] / width[..., -1]
+    else:
+        raise ValueError("Unknown integration rule: " + str(rule))
+    return slopes
+
+
+# Accumulates the mean and spread over scans of any number of traces at once,
+# using Welford's running sums. Scans can be added in batches, with the
+# batches merged by Chan's pairwise update, or added and removed one at a time
+# in O(positions). Each scan is an array of the same shape, typically
+# [data type, position-index].
+class RunningStats:
+    count = 0  # Number of scans accumulated
+    mean = np.zeros(0)  # Format is the shape of one scan
+    m2 = np.zeros(0)  # Summed squared deviation from mean, shape of one scan
+
+    # Starts the accumulator, optionally with a batch of scans, Format is
+    # [ScanNumber, ...]
+    def __init__(self, scans=None):
+        self.count = 0
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        if scans is not None:
+            self.AddScans(scans)
+
+    # Merges a batch of scans in, Format is [ScanNumber, ...]
+    def AddScans(self, scans):
+        scans = np.asarray(scans, dtype=float)
+        count = len(scans)
+        if count == 0:
+            if self.count == 0:
+                self.mean = np.zeros(scans.shape[1:])
+                self.m2 = np.zeros(scans.shape[1:])
+            return
+        mean = np.sum(scans / count, axis=0)
+        m2 = np.sum((scans - mean)**2, axis=0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta**2 * (self.count * count / total)
+        self.count = total
+
+    # Adds a single scan, the classic Welford step
+    def AddScan(self, scan):
+        scan = np.asarray(scan, dtype=float)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = 1, scan.copy(), np.zeros(scan.shape)
+            return
+        self.count += 1
+        delta = scan - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (scan - self.mean)
+
+    # A separate accumulator with the same scans, to add to or take from
+    # while this one is kept as it is
+    def Copy(self):
+        stats = RunningStats()
+        stats.count, stats.mean, stats.m2 = self.count, self.mean, self.m2
+        return stats
+
+    # A separate accumulator for the same scans, cut down to the points keep
+    # (a slice or mask) along the last axis
+    def Select(self, keep):
+        stats = RunningStats()
+        stats.count = self.count
+        stats.mean = self.mean[..., keep]
+        stats.m2 = self.m2[..., keep]
+        return stats
+
+    # Takes a single scan back out, undoing AddScan for it
+    def RemoveScan(self, scan):
+        scan = np.asarray(scan, dtype=float)
+        if self.count <= 1:
+            self.__init__()
+            return
+        self.count -= 1
+        delta = scan - self.mean
+        self.mean = self.mean - delta / self.count
+        self.m2 = self.m2 - delta * (scan - self.mean)
+
+    # RMS over scans at each point. Removing scans can leave rounding error
+    # just below zero, so that is clipped before the root.
+    def GetSigmas(self):
+        if self.count == 0:
+            return self.m2
+        return np.sqrt(np.maximum(self.m2, 0) / self.count)
+
+    # Average, RMS and peak-to-valley of the mean scan along its last axis,
+    # Format is [..., {0:average, 1:RMS, 2:p-v}]
+    def GetResults(self):
+        average = np.mean(self.mean, axis=-1)
+        std = np.sqrt(np.mean((self.mean - average[..., np.newaxis])**2,
+                              axis=-1))
+        p2v = np.max(self.mean, axis=-1) - np.min(self.mean, axis=-1)
+        return np.array([average, std, p2v]).T.tolist()
+
+
+# Grows a [ScanNumber, ...] array a scan at a time without copying it each
+# time. The rows live in a larger buffer, and a scan is written just past
+# the rows handed out so far, which no array held elsewhere (as by History)
+# can see. Given any other array, or once full, the rows move to a new buffer
+# of twice the size, so adding n scans copies O(n) of them in all.
+class ScanBuffer:
+    rows = np.zeros((0, 0))  # Format is [ScanNumber, ...], the whole buffer
+    used = 0  # Format is number of rows handed out
+
+    def __init__(self):
+        self.rows = np.zeros((0, 0))
+        self.used = 0
+
+    # Returns scans with scan added as the last row
+    def Append(self, scans, scan):
+        scan = np.asarray(scan, dtype=float)
+        if not (len(scans) == self.used < len(self.rows) and
+                scans.base is self.rows and scans.strides == self.rows.strides
+                and scans.shape[1:] == self.rows.shape[1:] and
+                scans.__array_interface__["data"][0] ==
+                self.rows.__array_interface__["data"][0]):
+            self.rows = np.empty((2 * len(scans) + 1,) + scan.shape)
+            self.rows[:len(scans)] = scans
+            self.used = len(scans)
+        self.rows[self.used] = scan
+        self.used += 1
+        return self.rows[:self.used]
+
+
+# Keeps the states a Raven object has been through, for N-level undo and redo
+# along with a pinned start point. States are dictionaries of arrays (and
+# small lists), stored by reference: arrays are made read-only as they come
+# in, so states can share any arrays an action left alone. Once the old data
+# held goes over budget bytes, the oldest states are dropped first.
+class History:
+    budget = 512 * 2**20  # Format is bytes
+    undo_states = []  # Format is [state], oldest first
+    redo_states = []  # Format is [state], most recently undone last
+    pinned = None  # Format is state
+
+    def __init__(self, budget=budget):
+        self.budget = budget
+        self.undo_states = []
+        self.redo_states = []
+        self.pinned = None
+
+    # Adds a state from before an action. Anything undone is now lost.
+    def Record(self, state):
+        self.undo_states.append(self.__Freeze(state))
+        self.redo_states = []
+        self.Trim(state)
+
+    # Trades the current state for the last recorded one, or returns None
+    def Undo(self, state):
+        if len(self.undo_states) == 0:
+            return None
+        self.redo_states.append(self.__Freeze(state))
+        return self.undo_states.pop()
+
+    # Trades the current state for the last undone one, or returns None
+    def Redo(self, state):
+        if len(self.redo_states) == 0:
+            return None
+        self.undo_states.append(self.__Freeze(state))
+        return self.redo_states.pop()
+
+    # Keeps a state aside to go back to, which is never dropped
+    def Pin(self, state):
+        self.pinned = self.__Freeze(state)
+
+    # Bytes held by the undo and redo states beyond those of the live state
+    # given and the start point, which are kept regardless. Arrays are
+    # counted by the memory they are views into, such as the rows of a
+    # ScanBuffer, so it is counted once however many states see into it.
+    def Size(self, state={}):
+        counted = set(id(self.__Root(value)) for value in state.values())
+        if self.pinned is not None:
+            counted.update(id(self.__Root(value))
+                           for value in self.pinned.values())
+        size = 0
+        for old in self.undo_states + self.redo_states:
+            for value in old.values():
+                root = self.__Root(value)
+                if isinstance(root, np.ndarray) and id(root) not in counted:
+                    counted.add(id(root))
+                    size += root.nbytes
+        return size
+
+    # Drops the oldest states until the history fits in its budget
+    def Trim(self, state={}):
+        while len(self.undo_states) > 0 and self.Size(state) > self.budget:
+            del self.undo_states[0]
+
+    # The array value is a view into, or value itself if it is none
+    def __Root(self, value):
+        while (isinstance(value, np.ndarray) and
+               isinstance(value.base, np.ndarray)):
+            value = value.base
+        return value
+
+    # Makes the arrays in a state read-only, so nothing can change them while
+    # the history holds them
+    def __Freeze(self, state):
+        state = dict(state)
+        for key, value in state.items():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            elif isinstance(value, list):
+                state[key] = list(value)
+        return state
+
+
+# Circle Functions for fitting. As throughout, x is in mm, heights in nm and
+# slopes in microradians. HeightCircle has its center x0 in mm, y0 in m, and
+# radius R in km, with sign 1 for a circle below its center (concave), and -1
+# for one above it.
+def HeightCircle(x, x0, y0, R, sign=1):
+    out = (R * 1000)**2 - ((x-x0) * 0.001)**2
+    # out += (abs(out) - out)*123412345678909876543212345 # This is so tiny
+    #                                                 circles don't happen.
+    out = (abs(out) + out) * 0.5
+    return -1000000000*sign*(np.sqrt(out) - y0)
+
+
+# The slope of a circle, given the straight line a*x + b it nearly is. The
+# line is the tangent of the angle around the circle at small angles, so the
+# exact slope is the line over the cosine of that angle.
+def SlopeCircle(x, a, b):
+    line = a*x + b
+    return line / np.sqrt(1 - (line * 0.000001)**2)
+
+
+# Fits circles to every row of heights, along the matching row of x (or one
+# shared row), all at once. This is an algebraic (Kasa) fit: the circle
+# x^2 + y^2 + D*x + E*y + F = 0 is linear in D, E and F, so each scan takes a
+# single 3x3 solve. Mirrors are very shallow arcs, so rather than the usual
+# form, it is solved for y = -(x^2 + y^2 + D*x + F) / E, keeping the errors
+# along y where the noise is. Positions are centered first and the columns
+# scaled to keep those solves well conditioned.
+# Format is [..., {0:x0, 1:y0, 2:R, 3:sign}], as for HeightCircle.
+def FitHeightCircles(x, heights):
+    heights = np.asarray(heights, dtype=float)
+    y = heights * 0.000000001
+    x = np.asarray(x, dtype=float) * 0.001 * np.ones(y.shape)
+    x_mid = np.mean(x, axis=-1)[..., np.newaxis]
+    y_mid = np.mean(y, axis=-1)[..., np.newaxis]
+    u = x - x_mid
+    v = y - y_mid
+    w = u**2 + v**2
+    u_scale = np.sqrt(np.mean(u**2, axis=-1))[..., np.newaxis]
+    w_scale = np.sqrt(np.mean(w**2, axis=-1))[..., np.newaxis]
+    u_scale[u_scale == 0] = 1
+    w_scale[w_scale == 0] = 1
+    A = np.concatenate(((w / w_scale)[..., np.newaxis],
+                        (u / u_scale)[..., np.newaxis],
+                        np.ones(u.shape + (1,))), axis=-1)
+    normal = np.einsum("...pi,...pj->...ij", A, A)
+    target = np.einsum("...pi,...p->...i", A, v)
+    try:
+        solution = np.linalg.solve(normal, target[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        # Only scans without any spread in x get here, so one by one is fine
+        solution = np.array([np.linalg.lstsq(m, t)[0] for m, t in
+                             zip(normal.reshape(-1, 3, 3),
+                                 target.reshape(-1, 3))])
+        solution = solution.reshape(target.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        E = -w_scale[..., 0] / solution[..., 0]
+        D = -solution[..., 1] / u_scale[..., 0] * E
+        F = -solution[..., 2] * E
+        u_center = -D / 2
+        v_center = -E / 2
+        radius = np.sqrt(u_center**2 + v_center**2 - F)
+    sign = np.where(v_center >= 0, 1., -1.)
+    x0 = (u_center + x_mid[..., 0]) * 1000
+    y0 = sign * (v_center + y_mid[..., 0])
+    return np.concatenate((x0[..., np.newaxis], y0[..., np.newaxis],
+                           radius[..., np.newaxis] * 0.001,
+                           sign[..., np.newaxis]), axis=-1)
+
+
+# Fits the slope of a circle to every row of slopes, as FitHeightCircles. The
+# slope is nearly the straight line a*x + b, with the radius 1/a km, so this
+# is a least squares line for each scan. Format is [..., {0:a, 1:b}], as for
+# SlopeCircle.
+def FitSlopeCircles(x, slopes):
+    slopes = np.asarray(slopes, dtype=float)
+    x = np.asarray(x, dtype=float) * np.ones(slopes.shape)
+    x_mid = np.mean(x, axis=-1)[..., np.newaxis]
+    slope_mid = np.mean(slopes, axis=-1)[..., np.newaxis]
+    spread = np.sum((x - x_mid)**2, axis=-1)
+    spread = np.where(spread == 0, 1, spread)
+    a = np.sum((x - x_mid) * (slopes - slope_mid), axis=-1) / spread
+    b = slope_mid[..., 0] - a * x_mid[..., 0]
+    return np.concatenate((a[..., np.newaxis], b[..., np.newaxis]), axis=-1)
+
+
+# Refines a single FitHeightCircles result by Levenberg-Marquardt, with the
+# Jacobian worked out analytically. The sign is kept as it was. Since y0 and R
+# nearly cancel for shallow arcs, the fit is done on the lowest point of the
+# circle, y0 - R, in place of y0.
+def PolishHeightCircle(x, heights, guess):
+    x = np.asarray(x, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+    sign = guess[3]
+
+    def residual(params):
+        x0, bottom, R = params
+        return HeightCircle(x, x0, bottom + R*1000, R, sign) - heights
+
+    def jacobian(params):
+        x0, bottom, R = params
+        u = (x-x0) * 0.001
+        root = np.sqrt(np.maximum((R * 1000)**2 - u**2, 1e-300))
+        return np.array([-1000*sign*(x-x0) / root,
+                         1000000000*sign*np.ones(x.shape),
+                         -1e12*sign*u**2 / ((R*1000 + root) * root)]).T
+
+    guess = np.asarray(guess, dtype=float)
+    start = [guess[0], guess[1] - guess[2]*1000, guess[2]]
+    x0, bottom, R = chisquarefit.leastsq(residual, start, Dfun=jacobian)[0]
+    return np.array([x0, bottom + R*1000, R, sign])
+
+
+# Refines a single FitSlopeCircles result by Levenberg-Marquardt, as above
+def PolishSlopeCircle(x, slopes, guess):
+    x = np.asarray(x, dtype=float)
+    slopes = np.asarray(slopes, dtype=float)
+
+    def residual(params):
+        return SlopeCircle(x, *params) - slopes
+
+    def jacobian(params):
+        line = params[0]*x + params[1]
+        scale = (1 - (line * 0.000001)**2)**-1.5
+        return np.array([x * scale, scale]).T
+
+    return chisquarefit.leastsq(residual, guess, Dfun=jacobian)[0]
+
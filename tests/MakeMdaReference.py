@@ -0,0 +1,91 @@
+import glob
+import json
+import os
+
+from mdaviz.synApps_mdalib import mda
+
+# Writes Test Data/APS MDA/reference.json: what the synApps MDA reader, which
+# shares no code with Medium's, reads from each .mda file there. Needs the
+# synApps mda.py, as shipped in mdaviz (pip install mdaviz):
+#     python tests/MakeMdaReference.py
+#
+# Format is {file name: {"version", "scan_number", "rank", "dimensions",
+# "extras": [[name, description, unit, DBR type, value]], "scans":
+# [{"positioners": [[number, name, desc, step mode, unit, readback name,
+# readback desc, readback unit]], "detectors": [[number, name, desc, unit]],
+# "triggers": [[number, name, command]], "completed", "data": [column,
+# point]}] for every 1-D scan, outermost point first}, the data columns
+# being the positioners, then the detectors, of the points actually taken.
+
+
+reference_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "Test Data", "APS MDA")
+
+
+def __Text(value):
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+    return value
+
+
+# The 1-D scans of the scan at position of handle, read by mda.readScan
+def ReadScans(handle, position):
+    handle.seek(position)
+    scan = mda.readScan(handle, out=open(os.devnull, "w"))[0]
+    if scan.rank > 1:
+        output = []
+        for lower in scan.plower_scans[:scan.curr_pt]:
+            if lower > 0:
+                output += ReadScans(handle, lower)
+        return output
+    completed = scan.curr_pt
+    return [{"positioners": [[positioner.number] + [__Text(field) for field in
+                             [positioner.name, positioner.desc,
+                              positioner.step_mode, positioner.unit,
+                              positioner.readback_name,
+                              positioner.readback_desc,
+                              positioner.readback_unit]]
+                             for positioner in scan.p],
+             "detectors": [[detector.number, __Text(detector.name),
+                            __Text(detector.desc), __Text(detector.unit)]
+                           for detector in scan.d],
+             "triggers": [[trigger.number, __Text(trigger.name),
+                           trigger.command] for trigger in scan.t],
+             "completed": completed,
+             "data": [[float(value) for value in array.data[:completed]]
+                      for array in scan.p + scan.d]}]
+
+
+def ReadReference(filename):
+    read = mda.readMDA(filename, maxdim=1, outFile=os.devnull)
+    header = read[0]
+    extras = []
+    for name in header:
+        if name in header["ourKeys"]:
+            continue
+        description, unit, value, dbr_type, count = header[name]
+        if dbr_type in (0, 32):
+            if isinstance(value, list):
+                value = "".join(chr(char) for char in value).split("\0")[0]
+            value = __Text(value)
+        else:
+            value = [float(number) for number in value]
+        extras.append([__Text(name), __Text(description), __Text(unit),
+                       dbr_type, value])
+    with open(filename, "rb") as handle:
+        # The first scan follows the header: the version, scan number and
+        # rank, the dimensions, and whether regular and where the extra PVs
+        # are
+        scans = ReadScans(handle, 4 * (5 + header["rank"]))
+    return {"version": header["version"],
+            "scan_number": header["scan_number"], "rank": header["rank"],
+            "dimensions": list(header["dimensions"]), "extras": extras,
+            "scans": scans}
+
+
+if __name__ == "__main__":
+    reference = {}
+    for name in sorted(glob.glob(os.path.join(reference_dir, "*.mda"))):
+        reference[os.path.basename(name)] = ReadReference(name)
+    with open(os.path.join(reference_dir, "reference.json"), "w") as output:
+        json.dump(reference, output, indent=1, sort_keys=True)
@@ -0,0 +1,203 @@
+import numpy as np
+import os
+import re
+import struct
+
+import Medium
+
+# Builds an MDA file out of the mda2ascii files of a run, as saveData would
+# have written it, and checks that Medium reads it back the same as the
+# ASCII files (see test_medium.py). Being written by this, it only checks
+# the reader against what this takes the format to be; the files in
+# Test Data/APS MDA, written by saveData itself, check it against that.
+#
+# mda2ascii doesn't write the DBR type of the extra PVs, so they are written
+# as those types saveData would give them: a value with a unit is a
+# DBR_CTRL_LONG if a whole number and a DBR_CTRL_DOUBLE otherwise, those in
+# mda_char_pvs are DBR_CTRL_CHAR, and any other is a DBR_STRING.
+
+
+# Extra PVs saveData writes as arrays of chars rather than strings
+mda_char_pvs = ["ltp:saveData_comment1", "ltp:saveData_comment2",
+                "ltp:saveData_fileSystem"]
+mda_char_count = 40  # Format is the chars written for each, at least
+
+
+# The parts of an mda2ascii file needed to write it back. Returns {"version",
+# "scan_number", "dimensions", "extras": [[name, description, value, unit or
+# None]], "levels": [[rank, point, points, scanner, time]] of the scans
+# above the 1-D one, outermost first, "scanner", "time", "points",
+# "completed", "columns": [[kind, number, fields]] of the 1-D scan, "data"}
+def ReadAsciiLayout(filename):
+    with open(filename, "r") as fileInQuestion:
+        text = fileInQuestion.read()
+    layout = {"version": float(re.search(r"# MDA File Version = (.*)",
+                                         text).group(1)),
+              "scan_number": int(re.search(r"# Scan number = (\d+)",
+                                           text).group(1)),
+              "dimensions": [int(dimension) for dimension in re.search(
+                  r"# Total requested scan size = (.*)",
+                  text).group(1).split(" x ")],
+              "extras": [], "levels": [], "columns": []}
+    for extra in re.finditer(r'^# Extra PV \d+: (.*?), (.*?), "(.*)"'
+                             r'(, (.*))?$', text, re.M):
+        layout["extras"].append([extra.group(1), extra.group(2),
+                                 extra.group(3), extra.group(5)])
+    for level in re.finditer(r"^# (\d)-D Scan Point\n# Current point = "
+                             r"(\d+) of (\d+)\n# Scanner = (.*)\n"
+                             r"# Scan time = (.*)$", text, re.M):
+        layout["levels"].append([int(level.group(1)), int(level.group(2)),
+                                 int(level.group(3)), level.group(4),
+                                 level.group(5)])
+    scan = re.search(r"^# 1-D Scan\n# Points completed = (\d+) of (\d+)\n"
+                     r"# Scanner = (.*)\n# Scan time = (.*)$", text, re.M)
+    layout["completed"] = int(scan.group(1))
+    layout["points"] = int(scan.group(2))
+    layout["scanner"] = scan.group(3)
+    layout["time"] = scan.group(4)
+    columns = text[text.rfind("# Column Descriptions:"):]
+    for column in re.finditer(r"^#\s*\d+\s*\[1-D (Positioner|Detector)\s*"
+                              r"(\d+)\]  (.*)$", columns, re.M):
+        layout["columns"].append([column.group(1), int(column.group(2)) - 1,
+                                  column.group(3).split(", ")])
+    layout["data"] = Medium.ParseMdaAscii(text)[1]
+    return layout
+
+
+# Writes the mda2ascii files of one run, given in any order, as one MDA file
+def WriteMdaFixture(filename, ascii_files):
+    layouts = [ReadAsciiLayout(name) for name in ascii_files]
+    layouts.sort(key=lambda layout: [level[1] for level in layout["levels"]])
+    first = layouts[0]
+    output = bytearray()
+    output += struct.pack(">fii", first["version"], first["scan_number"],
+                          len(first["dimensions"]))
+    output += struct.pack(">%di" % len(first["dimensions"]),
+                          *first["dimensions"])
+    output += struct.pack(">i", 1)
+    extra_position = len(output)
+    output += struct.pack(">i", 0)
+    __WriteScan(output, layouts, 0)
+    struct.pack_into(">i", output, extra_position, len(output))
+    __WriteExtras(output, first["extras"])
+    with open(filename, "wb") as fileInQuestion:
+        fileInQuestion.write(bytes(output))
+
+
+# Writes the scan at depth (0 being the outermost) holding the 1-D scans of
+# layouts, then those below it, each where its offset says
+def __WriteScan(output, layouts, depth):
+    first = layouts[0]
+    if depth == len(first["levels"]):
+        output += struct.pack(">iii", 1, first["points"], first["completed"])
+        output += __String(first["scanner"]) + __String(first["time"])
+        positioners = [column for column in first["columns"] if
+                       column[0] == "Positioner"]
+        detectors = [column for column in first["columns"] if
+                     column[0] == "Detector"]
+        output += struct.pack(">iii", len(positioners), len(detectors), 0)
+        for kind, number, fields in positioners + detectors:
+            output += struct.pack(">i", number)
+            output += b"".join(__String(field) for field in fields)
+        data = np.zeros((len(first["columns"]), first["points"]))
+        data[:, :first["completed"]] = first["data"][1:]
+        output += data[:len(positioners)].astype(">f8").tobytes()
+        output += data[len(positioners):].astype(">f4").tobytes()
+        return
+
+    rank, point, points, scanner, time = first["levels"][depth]
+    groups = []
+    for layout in layouts:
+        if len(groups) == 0 or (layout["levels"][depth][1] !=
+                                groups[-1][0]["levels"][depth][1]):
+            groups.append([])
+        groups[-1].append(layout)
+    output += struct.pack(">iii", rank, points, len(groups))
+    offsets = len(output)
+    output += struct.pack(">%di" % points, *([0] * points))
+    output += __String(scanner) + __String(time)
+    output += struct.pack(">iii", 0, 0, 0)
+    for i, group in enumerate(groups):
+        struct.pack_into(">i", output, offsets + 4 * i, len(output))
+        __WriteScan(output, group, depth + 1)
+
+
+# Writes the extra PVs in the form ReadMda reads them
+def __WriteExtras(output, extras):
+    output += struct.pack(">i", len(extras))
+    for name, description, value, unit in extras:
+        output += __String(name) + __String(description)
+        if unit is not None and re.match(r"^-?\d+$", value):
+            output += struct.pack(">ii", 33, 1) + __String(unit)
+            output += struct.pack(">i", int(value))
+        elif unit is not None:
+            output += struct.pack(">ii", 34, 1) + __String(unit)
+            output += struct.pack(">d", float(value))
+        elif name in mda_char_pvs:
+            chars = [ord(char) for char in value]
+            chars += [0] * max(mda_char_count - len(chars), 1)
+            output += struct.pack(">ii", 32, len(chars)) + __String("")
+            output += struct.pack(">%di" % len(chars), *chars)
+        else:
+            output += struct.pack(">i", 0) + __String(value)
+
+
+# An XDR counted string as MDA writes it (see Medium.XdrReader)
+def __String(text):
+    text = text.encode("latin-1")
+    if len(text) == 0:
+        return struct.pack(">i", 0)
+    return (struct.pack(">ii", len(text), len(text)) + text +
+            b"\0" * (-len(text) % 4))
+
+
+# Writes the MDA file of ascii_files to filename and reads it back with
+# Medium, returning a list of what doesn't match the ASCII files. The data
+# is written as saveData does, positioners as doubles and detectors as
+# floats, so the detectors are only compared to float precision.
+def CheckMdaFixture(filename, ascii_files):
+    WriteMdaFixture(filename, ascii_files)
+    layouts = [ReadAsciiLayout(name) for name in ascii_files]
+    order = sorted(range(len(layouts)), key=lambda i: [
+        level[1] for level in layouts[i]["levels"]])
+    layouts = [layouts[i] for i in order]
+    names = [ascii_files[i] for i in order]
+    problems = []
+    header, extras, scan = Medium.ReadMda(filename)
+    if header["dimensions"] != layouts[0]["dimensions"]:
+        problems.append("dimensions " + str(header["dimensions"]))
+    if header["scan_number"] != layouts[0]["scan_number"]:
+        problems.append("scan number " + str(header["scan_number"]))
+
+    if list(extras) != [extra[0] for extra in layouts[0]["extras"]]:
+        problems.append("extra PV names " + str(list(extras)))
+    for name, description, value, unit in layouts[0]["extras"]:
+        if name not in extras:
+            continue
+        read = extras[name]
+        if unit is not None:
+            matches = (read[:2] == [description, unit] and len(read[2]) == 1
+                       and float(read[2][0]) == float(value))
+        else:
+            matches = read == [description, "", value]
+        if not matches:
+            problems.append("extra PV " + name + " " + str(read))
+
+    scans = Medium.ReadMdaScans(filename)
+    if len(scans) != len(names):
+        problems.append(str(len(scans)) + " scans")
+    for name, layout, [descriptions, data] in zip(names, layouts, scans):
+        ascii_descriptions, ascii_data = Medium.ReadMdaAscii(name)
+        positioners = 1 + len([column for column in layout["columns"] if
+                               column[0] == "Positioner"])
+        if descriptions != ascii_descriptions:
+            problems.append(os.path.basename(name) + " descriptions")
+        if data.shape != ascii_data.shape:
+            problems.append(os.path.basename(name) + " shape " +
+                            str(data.shape))
+        elif not (np.array_equal(data[:positioners],
+                                 ascii_data[:positioners]) and
+                  np.allclose(data[positioners:], ascii_data[positioners:],
+                              rtol=1e-6, atol=0)):
+            problems.append(os.path.basename(name) + " data")
+    return problems
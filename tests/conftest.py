@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules are imported from the top of the repository. It is put last on
+# the path, so numpy and scipy are those installed, if any, before those
+# bundled there.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import numpy as np
+import copy
+
+import Lightning
+
+
+# Segments along a mirror, each overlapping the two after it
+def Segments(count=12, points=200):
+    random = np.random.RandomState(0)
+    output = []
+    for i in range(count):
+        x = np.linspace(i * 30, i * 30 + 70, points)
+        y = np.sin(x / 150.) + 0.01 * random.randn(points) + 0.2 * i
+        output.append([x.tolist(), y.tolist()])
+    return output
+
+
+def Stitched(segments, mode):
+    stitcher = Lightning.Lightning()
+    stitcher.SetStitchMode(mode)
+    for segment in segments:
+        stitcher.AddSegment(copy.deepcopy(segment), True)
+    stitcher.StitchAll()
+    return stitcher
+
+
+# Counts the calls to FitSegments while the test goes on
+def CountFits(monkeypatch):
+    calls = [0]
+    fit_segments = Lightning.Lightning.FitSegments
+
+    def Counted(self, *args, **kwargs):
+        calls[0] += 1
+        return fit_segments(self, *args, **kwargs)
+    monkeypatch.setattr(Lightning.Lightning, "FitSegments", Counted)
+    return calls
+
+
+def test_remove_middle_segment_uses_the_fits_already_made(monkeypatch):
+    segments = Segments()
+    stitcher = Stitched(segments, "global")
+    calls = CountFits(monkeypatch)
+    stitcher.RemoveSegment(5)
+    # Every overlap left was already fit, the two around the gap included
+    assert calls[0] == 0
+    assert stitcher.segment_counter == len(segments) - 2
+    assert ([segment[2] for segment in stitcher.unstitched_segments] ==
+            list(range(len(segments) - 1)))
+    fresh = Stitched(segments[:5] + segments[6:], "global")
+    assert stitcher.segments == fresh.segments
+    assert stitcher.conglomerate == fresh.conglomerate
+
+
+def test_remove_segment_in_chain_mode():
+    segments = Segments()
+    stitcher = Stitched(segments, "chain")
+    stitcher.RemoveSegment(0)
+    stitcher.RemoveSegment(4)
+    stitcher.RemoveSegment()
+    remaining = segments[1:5] + segments[6:-1]
+    assert ([segment[2] for segment in stitcher.unstitched_segments] ==
+            list(range(len(remaining))))
+    fresh = Stitched(remaining, "chain")
+    assert stitcher.segments == fresh.segments
+
+def test_edit_refits_only_its_own_overlaps_in_global_mode(monkeypatch):
+    segments = Segments()
+    stitcher = Stitched(segments, "global")
+    calls = CountFits(monkeypatch)
+    stitcher.AddSegment(copy.deepcopy(segments[5]))
+    assert calls[0] == 0
+    edited = copy.deepcopy(segments[5])
+    edited[1] = [y + 0.001 * i for i, y in enumerate(edited[1])]
+    stitcher.AddSegment(edited)
+    # Only those of it with the two segments each side of it
+    assert calls[0] == 4
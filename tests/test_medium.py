@@ -0,0 +1,66 @@
+import numpy as np
+import glob
+import json
+import os
+
+import Medium
+import MdaFixture
+
+test_data = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "Test Data")
+aps_mda = os.path.join(test_data, "APS MDA")
+
+
+def Reference():
+    with open(os.path.join(aps_mda, "reference.json"), "r") as reference:
+        return json.load(reference)
+
+
+# The 1-D scans below scan, as ReadMda gives them, outermost point first
+def LowestScans(scan):
+    if scan["rank"] == 1:
+        return [scan]
+    return [lowest for lower in scan["lower"] for lowest in LowestScans(lower)]
+
+
+def test_mda_fixture_reads_as_the_ascii_files(tmpdir):
+    ascii_files = glob.glob(os.path.join(test_data, "*_1.asc"))
+    assert len(ascii_files) == 20
+    assert MdaFixture.CheckMdaFixture(str(tmpdir.join("fixture.mda")),
+                                      ascii_files) == []
+
+
+def test_mda_header_and_extras_read_as_synapps_does():
+    for name, expected in Reference().items():
+        header, extras, scan = Medium.ReadMda(os.path.join(aps_mda, name))
+        assert header["version"] == round(expected["version"], 4)
+        assert header["scan_number"] == expected["scan_number"]
+        assert header["rank"] == expected["rank"]
+        assert header["dimensions"] == expected["dimensions"]
+        assert list(extras) == [extra[0] for extra in expected["extras"]]
+        for pv, description, unit, dbr_type, value in expected["extras"]:
+            read = extras[pv]
+            assert read[:2] == [description, unit], pv
+            if dbr_type in (0, 32):
+                assert read[2] == value, pv
+            else:
+                assert [float(number) for number in read[2]] == value, pv
+
+
+def test_mda_scans_read_as_synapps_does():
+    for name, expected in Reference().items():
+        filename = os.path.join(aps_mda, name)
+        scans = Medium.ReadMdaScans(filename)
+        lowest = LowestScans(Medium.ReadMda(filename)[2])
+        assert len(scans) == len(lowest) == len(expected["scans"])
+        for [descriptions, data], scan, reference in zip(scans, lowest,
+                                                         expected["scans"]):
+            completed = reference["completed"]
+            assert scan["positioners"] == reference["positioners"]
+            assert scan["detectors"] == reference["detectors"]
+            assert scan["triggers"] == reference["triggers"]
+            assert data.shape == (1 + len(reference["data"]), completed)
+            assert np.array_equal(data[0], np.arange(1, completed + 1))
+            assert np.array_equal(data[1:], np.reshape(reference["data"],
+                                                       (-1, completed)))
+            assert len(descriptions) == data.shape[0]
@@ -0,0 +1,54 @@
+import numpy as np
+
+import Raven
+
+
+def test_history_counts_views_into_the_same_rows_once():
+    history = Raven.History()
+    rows = np.zeros((8, 100))
+    for used in range(1, 6):
+        history.Record({"scans": rows[:used], "fit": rows[used - 1]})
+    # Every state recorded sees into the same rows, as those of a
+    # ScanBuffer do, so they are held once, and not at all beyond a live
+    # state that sees into them too
+    assert history.Size() == rows.nbytes
+    assert history.Size({"scans": rows[:6]}) == 0
+
+
+def test_history_counts_arrays_held_only_by_old_states():
+    history = Raven.History()
+    old = np.zeros(100)
+    history.Record({"scans": old, "fit": old[:10]})
+    history.Record({"scans": old[5:], "fit": np.zeros(20)})
+    assert history.Size() == old.nbytes + 20 * 8
+    assert history.Size({"scans": old}) == 20 * 8
+
+
+def test_a_batch_of_scans_is_undone_as_one():
+    x = np.linspace(0, 100, 50)
+    random = np.random.RandomState(0)
+    run = Raven.Raven([])
+    run.AddScan(random.randn(50), x)
+    run.SetUndo()
+    for i in range(4):
+        run.AddScan(random.randn(50), undo=False)
+    assert run.scan_list == [0, 1, 2, 3, 4]
+    assert run.Undo()
+    assert run.scan_list == [0]
+    assert not run.Undo()
+
+
+def test_scan_buffer_keeps_its_rows_once_recorded():
+    buffer = Raven.ScanBuffer()
+    history = Raven.History()
+    scans = np.zeros((0, 100))
+    rows = set()
+    for i in range(8):
+        history.Record({"scans": scans})
+        scans = buffer.Append(scans, np.full(100, i))
+        rows.add(id(buffer.rows))
+    # Recording the rows handed out makes them read-only, which doesn't stop
+    # the next scan going in just past them, so only filling the buffer
+    # moves them, to one of 1, 3, 7 and then 15 rows
+    assert len(rows) == 4
+    assert np.array_equal(scans[:, 0], np.arange(8))